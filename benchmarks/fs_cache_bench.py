@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compares FileSystemCache get/set rates against the previous list-recency, rewrite-per-access design.
+Usage: python benchmarks/fs_cache_bench.py [operations] [threshold]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from pickle import Pickler, Unpickler
+
+HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.abspath(os.path.join(HERE_DIR, "..", "src"))
+sys.path.insert(0, SRC_DIR)
+
+from filesystem_session_interface import FileSystemCache  # noqa: E402
+
+
+class ListRecencyCache(object):
+    """
+    The previous design: recency in a list, the whole cache is pickled again on every change.
+    """
+    def __init__(self, filename, threshold):
+        self.filename = filename
+        self.threshold = threshold
+        self._dump({'_fsc_key_list': []})
+
+    def _dump(self, obj):
+        with open(self.filename, 'wb') as f:
+            Pickler(f, 4).dump(obj)
+
+    def _load(self):
+        with open(self.filename, 'rb') as f:
+            return Unpickler(f).load()
+
+    def get(self, key):
+        cache = self._load()
+        key_list = cache['_fsc_key_list']
+        obj = cache[key]
+        if key_list.index(key) < len(key_list) - 1:
+            key_list.remove(key)
+            key_list.append(key)
+            self._dump(cache)
+        return obj
+
+    def set(self, key, value):
+        cache = self._load()
+        key_list = cache['_fsc_key_list']
+        try:
+            key_list.remove(key)
+        except ValueError:
+            pass
+        cache[key] = value
+        key_list.append(key)
+        while len(key_list) > self.threshold:
+            del cache[key_list.pop(0)]
+        self._dump(cache)
+
+
+def workload(operations, threshold, seed=1):
+    """
+    80% reads, over a key space twice the threshold so evictions happen.
+    """
+    rnd = random.Random(seed)
+    keys = ["token_{}".format(i) for i in range(threshold * 2)]
+    return [(rnd.random() < 0.8, rnd.choice(keys)) for _ in range(operations)]
+
+
+def run_new(directory, threshold, ops):
+    cache = FileSystemCache(directory, threshold=threshold)
+    start = time.perf_counter()
+    for is_read, key in ops:
+        if is_read:
+            getattr(cache, key, None)
+        else:
+            setattr(cache, key, {"access_token": key, "expires": 3600})
+    return time.perf_counter() - start
+
+
+def run_old(directory, threshold, ops):
+    cache = ListRecencyCache(os.path.join(directory, "old_cache.pickle"), threshold)
+    start = time.perf_counter()
+    for is_read, key in ops:
+        if is_read:
+            try:
+                cache.get(key)
+            except KeyError:
+                pass
+        else:
+            cache.set(key, {"access_token": key, "expires": 3600})
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threshold = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    ops = workload(operations, threshold)
+    with tempfile.TemporaryDirectory() as directory:
+        new_elapsed = run_new(directory, threshold, ops)
+        # the old design is much slower, a tenth of the operations is enough to measure it
+        old_ops = ops[:max(1, operations // 10)]
+        old_elapsed = run_old(directory, threshold, old_ops)
+    new_rate = operations / new_elapsed
+    old_rate = len(old_ops) / old_elapsed
+    print("threshold {}, {} operations, 80% reads".format(threshold, operations))
+    print("{:>24s} {:>14,.0f} ops/s".format("list recency, rewrite", old_rate))
+    print("{:>24s} {:>14,.0f} ops/s".format("ordered map, append log", new_rate))
+    print("{:>24s} {:>13.1f}x".format("speedup", new_rate / old_rate))
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Stand-in for the InfluxDB 1.x HTTP /query endpoint, serving synthetic hourly series for every site.
+Understands the query shapes the app sends: SHOW FIELD KEYS, SELECT with a site_no filter, time range,
+ORDER BY time, LIMIT/OFFSET, GROUP BY time() aggregates, GROUP BY "site_no", chunked responses and epoch.
+Usage: python fake_influx.py [--port 18086] [--sites 50] [--hours 17520]
+"""
+import argparse
+import asyncio
+import calendar
+import datetime
+import os
+import re
+import sys
+import time
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
+
+from orjson import dumps as fast_dumps
+
+HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.abspath(os.path.join(HERE_DIR, "..", "..", "src"))
+sys.path.insert(0, SRC_DIR)
+
+from serializers import OBSERVATION_SPECS  # noqa: E402
+
+HOUR = 3600
+STRING_FIELDS = {"flag"}
+EPOCH_DIVISORS = {"ns": 1, "u": 1000, "ms": 1000000, "s": 1000000000}
+
+MEASUREMENT_RE = re.compile(r'FROM\s+"(\w+)"')
+SITE_RE = re.compile(r'"site_no"\s*=\s*\'(\d+)\'')
+LIMIT_RE = re.compile(r'LIMIT\s+(\d+)')
+OFFSET_RE = re.compile(r'OFFSET\s+(\d+)')
+TIME_RE = re.compile(r'time\s*(>=|>|<=|<)\s*\'([^\']+)\'')
+GRAIN_RE = re.compile(r'GROUP BY time\((\d+)([smhdw])\)')
+GRAIN_SECONDS = {"s": 1, "m": 60, "h": HOUR, "d": 86400, "w": 604800}
+
+
+def level_fields(measurement):
+    """
+    :return: sorted field names of a "levelN" measurement
+    """
+    level = int(measurement[len("level"):]) if measurement.startswith("level") else 0
+    spec = OBSERVATION_SPECS.get(level, OBSERVATION_SPECS[0])
+    return sorted(c[0] for c in spec[0] if c[0] != "time")
+
+
+def parse_time(s):
+    s = s.rstrip("Z")
+    if "." in s:
+        s = s.split(".", 1)[0]
+    return calendar.timegm(datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S").timetuple())
+
+
+def format_time(seconds, epoch):
+    if epoch:
+        return seconds * (1000000000 // EPOCH_DIVISORS.get(epoch, 1))
+    return datetime.datetime.utcfromtimestamp(seconds).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def field_value(field, site_no, hour, j):
+    if field in STRING_FIELDS:
+        return ""
+    return ((site_no * 131 + hour * 17 + j * 7) % 10000) / 10.0
+
+
+class FakeInflux(object):
+    def __init__(self, sites, hours):
+        self.sites = sites
+        self.hours = hours
+        # the series end at the current hour, so the API's default date ranges find data
+        self.start = (int(time.time()) // HOUR + 1 - hours) * HOUR
+
+    def _hour_range(self, sql):
+        first, last = 0, self.hours
+        for op, value in TIME_RE.findall(sql):
+            h = (parse_time(value) - self.start) / HOUR
+            if op == ">=":
+                first = max(first, int(-(-h // 1)))
+            elif op == ">":
+                first = max(first, int(h // 1) + 1)
+            elif op == "<=":
+                last = min(last, int(h // 1) + 1)
+            else:
+                last = min(last, int(-(-h // 1)))
+        return first, max(first, last)
+
+    def _select_columns(self, sql, fields):
+        select = sql.split("SELECT", 1)[1].split("FROM", 1)[0].strip()
+        if select == "*":
+            return None
+        return [c.strip().strip('"') for c in select.split(",") if c.strip() and c.strip() != "time"]
+
+    def series_for_site(self, sql, measurement, site_no, epoch, grouped_by_site=False):
+        fields = level_fields(measurement)
+        first, last = self._hour_range(sql)
+        grain = GRAIN_RE.search(sql)
+        limit = LIMIT_RE.search(sql)
+        offset = OFFSET_RE.search(sql)
+        limit = int(limit.group(1)) if limit else None
+        offset = int(offset.group(1)) if offset else 0
+        descending = "DESC" in sql
+        if grain:
+            step = int(grain.group(1)) * GRAIN_SECONDS[grain.group(2)] // HOUR or 1
+            wanted = [f for f in fields if f not in STRING_FIELDS]
+            if "MEAN(*)" not in sql:
+                wanted = [f for f in wanted if "({})".format(f) in sql]
+            columns = ["time"] + ["{}_{}".format(fn, f) for fn in ("mean", "min", "max", "count") for f in wanted]
+            hours = range(first - first % step, last, step)
+        else:
+            selected = self._select_columns(sql, fields)
+            if selected is None:
+                wanted = fields
+                columns = ["time"] + sorted(fields + ([] if grouped_by_site else ["site_no"]))
+            else:
+                wanted = [f for f in selected if f in fields]
+                columns = ["time"] + selected
+            hours = range(first, last)
+        if descending:
+            hours = hours[::-1]
+        hours = hours[offset:offset + limit] if limit is not None else hours[offset:]
+        index = {f: j for j, f in enumerate(fields)}
+        values = []
+        for h in hours:
+            row = [format_time(self.start + h * HOUR, epoch)]
+            for c in columns[1:]:
+                if c == "site_no":
+                    row.append(str(site_no))
+                elif grain:
+                    fn, f = c.split("_", 1)
+                    v = field_value(f, site_no, h, index[f])
+                    row.append(float(step) if fn == "count" else v)
+                else:
+                    row.append(field_value(c, site_no, h, index.get(c, 0)))
+            values.append(row)
+        series = {"name": measurement, "columns": columns, "values": values}
+        if grouped_by_site:
+            series["tags"] = {"site_no": str(site_no)}
+        return series
+
+    def query(self, sql, epoch=None):
+        """
+        :return: list of series for one statement
+        """
+        sql = sql.strip()
+        measurement = MEASUREMENT_RE.search(sql)
+        measurement = measurement.group(1) if measurement else "level3"
+        if sql.upper().startswith("SHOW FIELD KEYS"):
+            return [{"name": measurement, "columns": ["fieldKey", "fieldType"],
+                     "values": [[f, "string" if f in STRING_FIELDS else "float"] for f in level_fields(measurement)]}]
+        if not sql.upper().startswith("SELECT") or " INTO " in sql.upper():
+            return []
+        site = SITE_RE.search(sql)
+        if site:
+            return [self.series_for_site(sql, measurement, int(site.group(1)), epoch)]
+        if 'GROUP BY "site_no"' in sql:
+            return [self.series_for_site(sql, measurement, s, epoch, True) for s in range(1, self.sites + 1)]
+        return []
+
+    def respond(self, params):
+        return self._respond(params.get("q", [""])[0], params.get("epoch", [None])[0],
+                             params.get("chunked", ["false"])[0] == "true", int(params.get("chunk_size", ["10000"])[0]))
+
+    # the driver repeats the same queries, caching the bodies keeps this stand-in's CPU use out of the results
+    @lru_cache(maxsize=512)
+    def _respond(self, sql, epoch, chunked, chunk_size):
+        statements = [s for s in sql.split(";") if s.strip()]
+        results = []
+        for i, statement in enumerate(statements):
+            series = self.query(statement, epoch)
+            results.append((i, series))
+        if not chunked:
+            body = {"results": [{"statement_id": i, "series": s} if s else {"statement_id": i} for i, s in results]}
+            return fast_dumps(body)
+        lines = []
+        for i, series in results:
+            for s in series:
+                values = s["values"]
+                for start in range(0, max(1, len(values)), chunk_size):
+                    chunk = dict(s, values=values[start:start + chunk_size])
+                    lines.append(fast_dumps({"results": [{"statement_id": i, "series": [chunk]}]}))
+            if not series:
+                lines.append(fast_dumps({"results": [{"statement_id": i}]}))
+        return b"\n".join(lines) + b"\n"
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        k, v = line.split(":", 1)
+                        headers[k.strip().lower()] = v.strip()
+                body = b""
+                length = int(headers.get("content-length", 0))
+                if length:
+                    body = await reader.readexactly(length)
+                url = urlsplit(target)
+                params = parse_qs(url.query)
+                if body:
+                    params.update(parse_qs(body.decode("utf-8")))
+                if url.path == "/ping":
+                    status, payload = "204 No Content", b""
+                else:
+                    status, payload = "200 OK", self.respond(params)
+                writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\nX-Influxdb-Version: 1.8.0\r\n"
+                             "Content-Length: {}\r\n\r\n".format(status, len(payload)).encode("latin-1") + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(port, sites, hours):
+    influx = FakeInflux(sites, hours)
+    server = await asyncio.start_server(influx.handle, "127.0.0.1", port)
+    print("Fake influx listening on 127.0.0.1:{}".format(port), flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[-1])
+    parser.add_argument("--port", type=int, default=18086)
+    parser.add_argument("--sites", type=int, default=50)
+    parser.add_argument("--hours", type=int, default=17520)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.port, args.sites, args.hours))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+In-process stand-in for the Motor client, with just the collection methods the app uses.
+Documents are kept as encoded BSON and decoded with the caller's codec options on every read,
+so the app pays the same decoding cost as it does against a real server.
+"""
+import asyncio
+import datetime
+import hashlib
+from collections import namedtuple
+from bson import encode as bson_encode, decode as bson_decode
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+UpdateResult = namedtuple("UpdateResult", ["matched_count", "modified_count", "upserted_id"])
+
+BENCH_APIKEY = "loadtest-apikey"
+BENCH_ACCESS_TOKEN = "loadtest-access-token"
+BENCH_ACCESS_TOKEN_SECRET = "loadtest-access-token-secret"
+BENCH_OAUTH_CLIENT = "csiro-to-ldap"
+
+
+COMPARISONS = {
+    '$gt': lambda a, b: a is not None and a > b,
+    '$gte': lambda a, b: a is not None and a >= b,
+    '$lt': lambda a, b: a is not None and a < b,
+    '$lte': lambda a, b: a is not None and a <= b,
+    '$ne': lambda a, b: a != b,
+}
+
+
+def _matches_value(value, condition):
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        return all(COMPARISONS[op](value, operand) for op, operand in condition.items())
+    return value == condition
+
+
+def _matches(doc, query):
+    return all(_matches_value(doc.get(k, None), v) for k, v in (query or {}).items())
+
+
+def _apply_update(doc, update):
+    doc.update(update.get('$set', {}))
+    for k, v in update.get('$inc', {}).items():
+        doc[k] = doc.get(k, 0) + v
+
+
+def _project(doc, projection):
+    if not projection:
+        return doc
+    include = [k for k, v in projection.items() if v and k != '_id']
+    if include:
+        out = {k: doc[k] for k in include if k in doc}
+        if projection.get('_id', True) and '_id' in doc:
+            out['_id'] = doc['_id']
+        return out
+    return {k: v for k, v in doc.items() if projection.get(k, True)}
+
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self._docs = docs
+        self._i = 0
+
+    @property
+    def fetch_next(self):
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(self._i < len(self._docs))
+        return future
+
+    def next_object(self):
+        doc = self._docs[self._i]
+        self._i += 1
+        return doc
+
+    async def to_list(self, length=None):
+        docs = self._docs[self._i:] if length is None else self._docs[self._i:self._i + length]
+        self._i += len(docs)
+        return docs
+
+
+class FakeCollection(object):
+    def __init__(self, name, store, codec_options=DEFAULT_CODEC_OPTIONS):
+        self.name = name
+        # list of [plain decoded document, encoded document]
+        self._store = store
+        self.codec_options = codec_options
+
+    def with_options(self, codec_options=None, **kwargs):
+        return FakeCollection(self.name, self._store, codec_options or self.codec_options)
+
+    def _read(self, query, projection):
+        docs = []
+        for plain, raw in self._store:
+            if not _matches(plain, query):
+                continue
+            if projection:
+                raw = bson_encode(_project(plain, projection))
+            docs.append(bson_decode(raw, codec_options=self.codec_options))
+        return docs
+
+    def find(self, filter=None, projection=None, **kwargs):
+        return FakeCursor(self._read(filter, projection))
+
+    async def find_one(self, filter=None, projection=None, **kwargs):
+        docs = self._read(filter, projection)
+        return docs[0] if docs else None
+
+    async def count_documents(self, filter, **kwargs):
+        return sum(1 for plain, _ in self._store if _matches(plain, filter))
+
+    async def distinct(self, key, filter=None, **kwargs):
+        values = []
+        for plain, _ in self._store:
+            if key in plain and _matches(plain, filter) and plain[key] not in values:
+                values.append(plain[key])
+        return values
+
+    def insert(self, doc):
+        doc = dict(doc)
+        doc.setdefault('_id', ObjectId())
+        self._store.append([doc, bson_encode(doc)])
+        return doc['_id']
+
+    async def update_one(self, filter, update, upsert=False, **kwargs):
+        for entry in self._store:
+            if _matches(entry[0], filter):
+                _apply_update(entry[0], update)
+                entry[1] = bson_encode(entry[0])
+                return UpdateResult(1, 1, None)
+        if not upsert:
+            return UpdateResult(0, 0, None)
+        doc = {k: v for k, v in filter.items() if not isinstance(v, dict)}
+        _apply_update(doc, update)
+        return UpdateResult(0, 0, self.insert(doc))
+
+    async def update_many(self, filter, update, upsert=False, **kwargs):
+        matched = 0
+        for entry in self._store:
+            if _matches(entry[0], filter):
+                _apply_update(entry[0], update)
+                entry[1] = bson_encode(entry[0])
+                matched += 1
+        if matched or not upsert:
+            return UpdateResult(matched, matched, None)
+        return await self.update_one(filter, update, upsert=True)
+
+
+class FakeSession(object):
+    async def end_session(self):
+        pass
+
+
+class FakeDatabase(object):
+    def __init__(self, collections):
+        self._collections = collections
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return FakeCollection(name, self._collections.setdefault(name, []))
+
+    async def command(self, command, collections=None, **kwargs):
+        if command != "dbHash":
+            raise NotImplementedError(command)
+        hashes = {}
+        for name in collections or list(self._collections):
+            h = hashlib.md5()
+            for _, raw in self._collections.get(name, []):
+                h.update(raw)
+            hashes[name] = h.hexdigest()
+        return {'collections': hashes, 'md5': hashlib.md5("".join(sorted(hashes.values())).encode()).hexdigest()}
+
+
+class FakeMotorClient(object):
+    def __init__(self, databases=None):
+        self._databases = databases if databases is not None else {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return FakeDatabase(self._databases.setdefault(name, {}))
+
+    async def start_session(self, **kwargs):
+        return FakeSession()
+
+    def close(self):
+        pass
+
+
+def make_station(site_no):
+    return {
+        'site_no': site_no,
+        'site_name': "Benchmark site {}".format(site_no),
+        'network': "COSMOZ",
+        'latitude': Decimal128("-{}.{:03d}".format(20 + site_no % 20, site_no * 37 % 1000)),
+        'longitude': Decimal128("{}.{:03d}".format(115 + site_no % 35, site_no * 53 % 1000)),
+        'altitude': Decimal128("{}.5".format(100 + site_no)),
+        'installation_date': datetime.datetime(2010 + site_no % 10, 1 + site_no % 12, 1),
+        'timezone': "10",
+        'nmdb': "JUNG",
+        'calibration_type': "V",
+        'lattice_water_g_g': Decimal128("0.05"),
+        'soil_organic_matter_g_g': Decimal128("0.02"),
+        'bulk_density': Decimal128("1.4"),
+        'cutoff_rigidity': Decimal128("4.5"),
+        'n0_cal': Decimal128("2500.0"),
+        'ref_pressure': Decimal128("1000.0"),
+        'ref_intensity': Decimal128("150.0"),
+        'elev_scaling': Decimal128("1.01"),
+        'latit_scaling': Decimal128("0.99"),
+        'beta': Decimal128("0.0077"),
+        'sat_data_select': "none",
+        'site_description': "Synthetic station for load testing",
+        'tube_type': "CRS-1000",
+        'status': "Active",
+    }
+
+
+def make_calibration(site_no, i):
+    return {
+        'site_no': site_no,
+        'date': datetime.datetime(2018, 1 + i % 12, 1 + i % 28),
+        'label': "A{}".format(i),
+        'loc': "N",
+        'depth': "0-5",
+        'vol': "100",
+        'total_wet': Decimal128("150.25"),
+        'total_dry': Decimal128("120.75"),
+        'tare': Decimal128("20.5"),
+        'soil_wet': Decimal128("129.75"),
+        'soil_dry': Decimal128("100.25"),
+        'gwc': Decimal128("0.29"),
+        'bd': Decimal128("1.35"),
+        'vwc': Decimal128("0.39"),
+    }
+
+
+def make_dataset(db_name, sites, calibrations_per_site=12):
+    """
+    :return: databases dict for FakeMotorClient, with all_stations, stations_calibration and api_keys
+    """
+    client = FakeMotorClient()
+    db = getattr(client, db_name)
+    for site_no in range(1, sites + 1):
+        db.all_stations.insert(make_station(site_no))
+        for i in range(calibrations_per_site):
+            db.stations_calibration.insert(make_calibration(site_no, i))
+    now = datetime.datetime.utcnow()
+    db.api_keys.insert({
+        'apikey': BENCH_APIKEY,
+        'access_token': BENCH_ACCESS_TOKEN,
+        'access_token_secret': BENCH_ACCESS_TOKEN_SECRET,
+        'scopes': "none",
+        'oauth_v': "1.0a",
+        'oauth_client': BENCH_OAUTH_CLIENT,
+        'created': now,
+        'expires': now + datetime.timedelta(days=365),
+    })
+    return client._databases
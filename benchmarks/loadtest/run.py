@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+End-to-end load test. Starts the fake Influx server and the app (see serve.py), drives each route at a fixed
+concurrency over keep-alive connections, and reports req/s, p50/p99 latency and peak server RSS
+against the stored baselines in baselines.json.
+Baselines are machine specific, record new ones with --save-baselines before comparing on another machine.
+Usage: python benchmarks/loadtest/run.py [--duration 10] [--concurrency 32] [--workers 1] [--only stations,...]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINES_FILE = os.path.join(HERE_DIR, "baselines.json")
+sys.path.insert(0, HERE_DIR)
+
+from fake_mongo import BENCH_APIKEY  # noqa: E402
+
+DEFAULT_HEADERS = {"Accept": "*/*"}
+BENCH_ADMIN_APIKEY = "loadtest-admin-apikey"
+# name -> (method, path template, extra request headers), {site} is replaced by a rotating station number
+SCENARIOS = [
+    ("stations", "GET", "/rest/stations", {}),
+    ("station", "GET", "/rest/stations/{site}", {}),
+    ("observations_json", "GET", "/rest/stations/{site}/observations?processing_level=3&count=2000", {}),
+    ("observations_csv", "GET", "/rest/stations/{site}/observations?processing_level=3&count=2000",
+     {"Accept": "text/csv"}),
+    ("observations_txt", "GET", "/rest/stations/{site}/observations?processing_level=3&count=2000",
+     {"Accept": "text/plain"}),
+    ("lastobservations", "GET", "/rest/stations/{site}/lastobservations?processing_level=3", {}),
+    ("checkapikey", "GET", "/checkapikey", {"X-API-Key": BENCH_APIKEY}),
+    ("cache_invalidate", "POST", "/rest/cache/invalidate?station_no={site}&processing_level=3",
+     {"X-API-Key": BENCH_ADMIN_APIKEY}),
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Connection(object):
+    """
+    Minimal keep-alive HTTP/1.1 client, so the driver costs as little as possible.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, path, headers, method="GET"):
+        """
+        :return: (status, body length)
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        lines = ["{} {} HTTP/1.1".format(method, path), "Host: 127.0.0.1:{}".format(self.port)]
+        if method != "GET":
+            lines.append("Content-Length: 0")
+        # the API needs an Accept header, send */* like curl does unless the scenario sets one
+        lines.extend("{}: {}".format(k, v) for k, v in dict(DEFAULT_HEADERS, **headers).items())
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        head = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        status = int(head[0].split(" ", 2)[1])
+        response_headers = {}
+        for line in head[1:]:
+            if ":" in line:
+                k, v = line.split(":", 1)
+                response_headers[k.strip().lower()] = v.strip().lower()
+        length = 0
+        if response_headers.get("transfer-encoding", "") == "chunked":
+            while True:
+                size = int((await self.reader.readuntil(b"\r\n")).split(b";", 1)[0], 16)
+                await self.reader.readexactly(size + 2)
+                length += size
+                if size == 0:
+                    break
+        else:
+            length = int(response_headers.get("content-length", 0))
+            if length:
+                await self.reader.readexactly(length)
+        if response_headers.get("connection", "") == "close":
+            self.close()
+        return status, length
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def process_tree_rss(pid):
+    """
+    :return: resident set size in bytes of the process and all its descendants
+    """
+    total = 0
+    pending = [pid]
+    while pending:
+        p = pending.pop()
+        try:
+            with open("/proc/{}/status".format(p)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+            with open("/proc/{0}/task/{0}/children".format(p)) as f:
+                pending.extend(int(c) for c in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+async def run_scenario(port, server_pid, method, path, headers, concurrency, duration, warmup, sites):
+    latencies = []
+    statuses = {}
+    counter = [0]
+    peak_rss = [0]
+
+    async def sample_rss(stop):
+        while not stop.is_set():
+            peak_rss[0] = max(peak_rss[0], process_tree_rss(server_pid))
+            await asyncio.sleep(0.1)
+
+    async def worker(record_after, deadline):
+        conn = Connection(port)
+        try:
+            while True:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                counter[0] += 1
+                site = 1 + counter[0] % sites
+                start = time.perf_counter()
+                status, _ = await conn.request(path.format(site=site), headers, method)
+                elapsed = time.perf_counter() - start
+                if start >= record_after:
+                    latencies.append(elapsed)
+                    statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            conn.close()
+
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_rss(stop))
+    started = time.perf_counter()
+    record_after = started + warmup
+    deadline = record_after + duration
+    await asyncio.gather(*[worker(record_after, deadline) for _ in range(concurrency)])
+    stop.set()
+    await sampler
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "req_per_s": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 50) * 1000.0,
+        "p99_ms": percentile(latencies, 99) * 1000.0,
+        "peak_rss_mb": peak_rss[0] / 1048576.0,
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+async def wait_until_up(port, timeout=60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        conn = Connection(port)
+        try:
+            status, _ = await conn.request("/rest/stations?count=1", {})
+            if status == 200:
+                return
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            conn.close()
+        await asyncio.sleep(0.25)
+    raise RuntimeError("The app did not start within {} seconds".format(timeout))
+
+
+def compare(results, baselines, tolerance):
+    """
+    :return: list of (scenario, metric, baseline, result) that are worse than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baselines.get(name, None)
+        if base is None:
+            continue
+        if result["req_per_s"] < base["req_per_s"] * (1.0 - tolerance):
+            regressions.append((name, "req_per_s", base["req_per_s"], result["req_per_s"]))
+        for metric in ("p99_ms", "peak_rss_mb"):
+            if result[metric] > base[metric] * (1.0 + tolerance):
+                regressions.append((name, metric, base[metric], result[metric]))
+    return regressions
+
+
+def print_report(results, baselines):
+    print("{:>18s} {:>10s} {:>9s} {:>9s} {:>9s} {:>9s}  {}".format(
+        "scenario", "req/s", "p50 ms", "p99 ms", "rss MB", "vs base", "statuses"))
+    for name, r in results.items():
+        base = baselines.get(name, None)
+        delta = "{:+.1f}%".format((r["req_per_s"] / base["req_per_s"] - 1.0) * 100.0) if base else "-"
+        print("{:>18s} {:>10,.1f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9s}  {}".format(
+            name, r["req_per_s"], r["p50_ms"], r["p99_ms"], r["peak_rss_mb"], delta, r["statuses"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test against local stand-ins.")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured per scenario")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds run before measuring")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=1, help="app worker processes")
+    parser.add_argument("--sites", type=int, default=50)
+    parser.add_argument("--only", default="", help="comma delimited scenario names")
+    parser.add_argument("--cache", action="store_true", help="keep the observations cache on")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed fraction worse than the baseline")
+    parser.add_argument("--save-baselines", action="store_true")
+    parser.add_argument("--report", default=None, help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.only:
+        wanted = set(args.only.split(","))
+        scenarios = [s for s in SCENARIOS if s[0] in wanted]
+    influx_port = free_port()
+    app_port = free_port()
+    workdir = tempfile.TemporaryDirectory()
+    env = dict(os.environ)
+    env.update({
+        "INFLUX_DB_HOST": "127.0.0.1",
+        "INFLUX_DB_PORT": str(influx_port),
+        "REST_API_INTERNAL_PORT": str(app_port),
+        "REST_API_WORKERS": str(args.workers),
+        "LOADTEST_SITES": str(args.sites),
+        "ROLLUPS_ENABLED": "false",
+        "RATE_LIMIT_ENABLED": "false",
+        "OAUTH_VERIFY_CACHE_TTL": "86400",
+        "ADMIN_API_KEY": BENCH_ADMIN_APIKEY,
+        # access logs and the session store go in a scratch directory
+        "METRICS_DIRECTORY": workdir.name,
+        "LOADTEST_WORKDIR": workdir.name,
+    })
+    if not args.cache:
+        env["OBSERVATIONS_CACHE_TTL"] = "0"
+    influx = subprocess.Popen([sys.executable, os.path.join(HERE_DIR, "fake_influx.py"),
+                               "--port", str(influx_port), "--sites", str(args.sites)], env=env)
+    server = subprocess.Popen([sys.executable, os.path.join(HERE_DIR, "serve.py")], env=env)
+    results = {}
+    try:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(wait_until_up(app_port))
+        for name, method, path, headers in scenarios:
+            results[name] = loop.run_until_complete(run_scenario(
+                app_port, server.pid, method, path, headers, args.concurrency, args.duration, args.warmup,
+                args.sites))
+    finally:
+        server.terminate()
+        influx.terminate()
+        server.wait()
+        influx.wait()
+        workdir.cleanup()
+
+    try:
+        with open(BASELINES_FILE) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        stored = {}
+    baselines = stored.get("scenarios", {})
+    print_report(results, baselines)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"scenarios": results}, f, indent=2, sort_keys=True)
+    if args.save_baselines:
+        stored = {
+            "machine": {"python": platform.python_version(), "cpus": os.cpu_count(), "platform": platform.platform()},
+            "settings": {"concurrency": args.concurrency, "duration": args.duration, "workers": args.workers,
+                         "sites": args.sites, "cache": args.cache},
+            "scenarios": dict(baselines, **results),
+        }
+        with open(BASELINES_FILE, "w") as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+        print("Saved baselines to {}".format(BASELINES_FILE))
+        return 0
+    regressions = compare(results, baselines, args.tolerance)
+    for name, metric, base, result in regressions:
+        print("REGRESSION {} {}: {:.2f} -> {:.2f}".format(name, metric, base, result))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Runs the app against the load-test stand-ins: the in-process fake Mongo, and the fake Influx server
+given by INFLUX_DB_HOST/INFLUX_DB_PORT. Started by run.py, which sets the environment.
+"""
+import os
+import sys
+
+HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.abspath(os.path.join(HERE_DIR, "..", "..", "src"))
+sys.path.insert(0, SRC_DIR)
+os.chdir(os.getenv("LOADTEST_WORKDIR", SRC_DIR))
+
+import config  # noqa: E402
+import clients  # noqa: E402
+from fake_mongo import FakeMotorClient, make_dataset, BENCH_OAUTH_CLIENT, BENCH_ACCESS_TOKEN, \
+    BENCH_ACCESS_TOKEN_SECRET  # noqa: E402
+
+databases = make_dataset(config.MONGODB_NAME, int(os.getenv("LOADTEST_SITES", 50)))
+# every worker gets a client over the same documents
+clients._make_mongo_client = lambda loop: FakeMotorClient(databases)
+
+from app import app  # noqa: E402
+from oauth_verification import token_verifier, _token_key  # noqa: E402
+
+# /checkapikey would call the real OAuth provider, the benchmark measures the cached verification instead
+token_verifier.results.set(_token_key(BENCH_OAUTH_CLIENT, (BENCH_ACCESS_TOKEN, BENCH_ACCESS_TOKEN_SECRET)), True)
+
+if __name__ == "__main__":
+    app.run(host="127.0.0.1", port=int(config.LISTEN_PORT), workers=config.WORKERS,
+            debug=False, access_log=False, auto_reload=False)
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Microbenchmarks for the request-path helpers and serializers, each one timed over synthetic inputs of
+every size (rows, headers, datetimes or documents per call). Writes a JSON report that a later run can be
+compared against, so a change to one of these functions can be checked in isolation.
+Usage: python benchmarks/microbench.py [--sizes 1,10,...,1000000] [--only accept,jinja] [--output report.json]
+                                       [--compare baseline.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+from functools import lru_cache
+
+HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.abspath(os.path.join(HERE_DIR, "..", "src"))
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, HERE_DIR)
+sys.path.insert(0, os.path.join(HERE_DIR, "loadtest"))
+
+from bson import encode as bson_encode, decode_all as bson_decode_all  # noqa: E402
+from orjson import dumps as fast_dumps  # noqa: E402
+
+from api import get_accept_mediatypes_in_order, match_accept_mediatypes_to_provides, orjson_option, \
+    Observations  # noqa: E402
+from bson_codecs import codec_options_for  # noqa: E402
+from functions import observation_columns  # noqa: E402
+from serializers import CSV, TXT, OBSERVATION_SPECS, observation_serializer, calibration_serializers  # noqa: E402
+from util import datetime_to_iso, datetime_from_iso  # noqa: E402
+from serializers_bench import env, observation_template, make_observations, make_calibrations  # noqa: E402
+from fake_mongo import make_station  # noqa: E402
+
+DEFAULT_SIZES = (1, 10, 100, 1000, 10000, 100000, 1000000)
+# Accept headers as sent by browsers, curl, the python requests library and the API's own clients
+ACCEPT_HEADERS = [
+    "*/*",
+    "application/json",
+    "text/csv",
+    "text/plain, */*;q=0.5",
+    "application/json, text/plain, */*",
+    "text/csv;q=1.0, application/json;q=0.5",
+    "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "application/vnd.apache.arrow.file, application/json;q=0.1",
+]
+
+
+class FakeRequest(object):
+    __slots__ = ("headers",)
+
+    def __init__(self, accept):
+        self.headers = {"Accept": accept}
+
+
+@lru_cache(maxsize=2)
+def observation_data(processing_level, size):
+    """
+    :return: (columns, values, list of row dicts), the last two sizes are kept for the cases that share them
+    """
+    columns, values = make_observations(processing_level, size)
+    return columns, values, [dict(zip(columns, v)) for v in values]
+
+
+@lru_cache(maxsize=1)
+def calibration_data(size):
+    return make_calibrations(size)
+
+
+@lru_cache(maxsize=1)
+def accept_requests(size):
+    return [FakeRequest(ACCEPT_HEADERS[i % len(ACCEPT_HEADERS)]) for i in range(size)]
+
+
+@lru_cache(maxsize=1)
+def datetimes(size, seed=3):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+    # a quarter have microseconds, as the influx and mongo timestamps do
+    return [start + datetime.timedelta(seconds=rnd.randint(0, 86400 * 365),
+                                       microseconds=rnd.randint(1, 999999) if i % 4 == 0 else 0)
+            for i in range(size)]
+
+
+@lru_cache(maxsize=1)
+def iso_strings(size):
+    return [datetime_to_iso(d) for d in datetimes(size)]
+
+
+@lru_cache(maxsize=1)
+def station_bson(size):
+    """
+    :return: the stations as one buffer of concatenated BSON documents, the way a Motor batch arrives
+    """
+    return b"".join(bson_encode(make_station(1 + i % 1000)) for i in range(size))
+
+
+@lru_cache(maxsize=1)
+def stations(size):
+    return bson_decode_all(station_bson(size), codec_options=codec_options_for(False, "txt"))
+
+
+def observations_response(observations, size):
+    return {'meta': {'site_no': 21, 'processing_level': 3, 'count': size, 'offset': 0,
+                     'start_date': datetime.datetime(2019, 1, 1), 'end_date': datetime.datetime(2020, 1, 1),
+                     'next_cursor': None},
+            'observations': observations}
+
+
+def accept_in_order_case(size):
+    requests = accept_requests(size)
+    return lambda: [get_accept_mediatypes_in_order(r) for r in requests]
+
+
+def accept_match_case(size):
+    requests = accept_requests(size)
+    provides = Observations.accept_types
+    return lambda: [match_accept_mediatypes_to_provides(r, provides) for r in requests]
+
+
+def to_iso_case(size):
+    values = datetimes(size)
+    return lambda: [datetime_to_iso(d) for d in values]
+
+
+def from_iso_case(size):
+    values = iso_strings(size)
+    return lambda: [datetime_from_iso(s) for s in values]
+
+
+def decode_case(json_safe, jinja_safe):
+    def case(size):
+        data = station_bson(size)
+        codec_options = codec_options_for(json_safe, jinja_safe)
+        return lambda: bson_decode_all(data, codec_options=codec_options)
+    return case
+
+
+def dumps_rows_case(size):
+    columns, values, dicts = observation_data(3, size)
+    res = observations_response(dicts, size)
+    return lambda: fast_dumps(res, option=orjson_option)
+
+
+def dumps_columns_case(size):
+    columns, values, dicts = observation_data(3, size)
+    res = observations_response(observation_columns(columns, values), size)
+    return lambda: fast_dumps(res, option=orjson_option)
+
+
+def jinja_observations_case(processing_level, kind):
+    def case(size):
+        columns, values, dicts = observation_data(processing_level, size)
+        template = env.get_template(observation_template(processing_level, kind))
+        return lambda: template.render(observations=dicts)
+    return case
+
+
+def serializer_observations_case(processing_level, kind):
+    def case(size):
+        columns, values, dicts = observation_data(processing_level, size)
+        serializer = observation_serializer(processing_level, kind)
+        return lambda: serializer.rows_from_values(columns, values)
+    return case
+
+
+def jinja_calibrations_case(kind):
+    def case(size):
+        calibrations = calibration_data(size)
+        template = env.get_template("site_data_cal_{}.html".format(kind))
+        return lambda: template.render(calibrations=calibrations)
+    return case
+
+
+def serializer_calibrations_case(kind):
+    def case(size):
+        calibrations = calibration_data(size)
+        return lambda: calibration_serializers[kind].render_dicts(calibrations)
+    return case
+
+
+def jinja_site_values_case(size):
+    docs = stations(size)
+    template = env.get_template("site_values_txt.html")
+    return lambda: [template.render(**s) for s in docs]
+
+
+def all_cases():
+    """
+    :return: list of (name, setup), setup(size) returns the callable that is timed.
+    Cases that share their input data are next to each other, so it is only built once per size.
+    """
+    cases = [
+        ("accept.in_order", accept_in_order_case),
+        ("accept.match", accept_match_case),
+        ("datetime.to_iso", to_iso_case),
+        ("datetime.from_iso", from_iso_case),
+        ("decimal128.decode_orjson", decode_case("orjson", False)),
+        ("decimal128.decode_json", decode_case(True, False)),
+        ("decimal128.decode_jinja", decode_case(False, "txt")),
+        ("decimal128.decode_native", decode_case(False, False)),
+        ("jinja.site_values_txt", jinja_site_values_case),
+        ("fast_dumps.observations_rows", dumps_rows_case),
+        ("fast_dumps.observations_columns", dumps_columns_case),
+    ]
+    for processing_level in sorted(OBSERVATION_SPECS):
+        for kind in (CSV, TXT):
+            cases.append(("jinja.level{}_{}".format(processing_level, kind),
+                          jinja_observations_case(processing_level, kind)))
+            cases.append(("serializer.level{}_{}".format(processing_level, kind),
+                          serializer_observations_case(processing_level, kind)))
+    for kind in (CSV, TXT):
+        cases.append(("jinja.calibration_{}".format(kind), jinja_calibrations_case(kind)))
+        cases.append(("serializer.calibration_{}".format(kind), serializer_calibrations_case(kind)))
+    return cases
+
+
+def time_call(fn, min_time, repeat):
+    """
+    Best of `repeat` rounds, each round calls fn enough times to last at least min_time.
+    A single call that already takes over a second is only timed once per round, and for one round.
+    :return: (seconds per call, total calls)
+    """
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    if first >= 1.0:
+        return first, 1
+    number = max(1, int(min_time / max(first, 1e-9)))
+    best = first
+    calls = 1
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+        calls += number
+    return best, calls
+
+
+def run(cases, sizes, min_time, repeat, max_call_seconds):
+    """
+    A case whose single call took over max_call_seconds is not run at the larger sizes.
+    :return: {case: {size: {"seconds": per call, "ns_per_item", "items_per_s", "calls"}}}
+    """
+    results = {name: {} for name, _ in cases}
+    too_slow = set()
+    for size in sorted(sizes):
+        for name, setup in cases:
+            if name in too_slow:
+                print("{:>34s} {:>9d} skipped, too slow at a smaller size".format(name, size), flush=True)
+                continue
+            fn = setup(size)
+            seconds, calls = time_call(fn, min_time, repeat)
+            results[name][str(size)] = {
+                "seconds": seconds,
+                "ns_per_item": seconds * 1e9 / size,
+                "items_per_s": size / seconds,
+                "calls": calls,
+            }
+            if seconds > max_call_seconds:
+                too_slow.add(name)
+            print("{:>34s} {:>9d} {:>14,.1f} ns/item {:>14,.0f} items/s".format(
+                name, size, seconds * 1e9 / size, size / seconds), flush=True)
+        observation_data.cache_clear()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of (case, size, baseline ns/item, ns/item) slower than the baseline by more than tolerance
+    """
+    regressions = []
+    print("{:>34s} {:>9s} {:>12s} {:>12s} {:>8s}".format("case", "size", "base ns", "ns", "change"))
+    for name, by_size in results.items():
+        for size, r in by_size.items():
+            base = baseline.get(name, {}).get(size, None)
+            if base is None:
+                continue
+            change = r["ns_per_item"] / base["ns_per_item"] - 1.0
+            print("{:>34s} {:>9s} {:>12,.1f} {:>12,.1f} {:>+7.1f}%".format(
+                name, size, base["ns_per_item"], r["ns_per_item"], change * 100.0))
+            if change > tolerance:
+                regressions.append((name, size, base["ns_per_item"], r["ns_per_item"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the request-path helpers and serializers.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="comma delimited input sizes")
+    parser.add_argument("--only", default="", help="comma delimited regular expressions matched against case names")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing round")
+    parser.add_argument("--repeat", type=int, default=3, help="timing rounds, the best is reported")
+    parser.add_argument("--max-call-seconds", type=float, default=5.0,
+                        help="skip the larger sizes of a case once one call takes longer than this")
+    parser.add_argument("--output", default=None, help="write the JSON report here")
+    parser.add_argument("--compare", default=None, help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed fraction slower than the baseline")
+    parser.add_argument("--list", action="store_true", help="list the case names and exit")
+    args = parser.parse_args()
+
+    cases = all_cases()
+    if args.list:
+        for name, _ in cases:
+            print(name)
+        return 0
+    if args.only:
+        patterns = [re.compile(p) for p in args.only.split(",") if p]
+        cases = [c for c in cases if any(p.search(c[0]) for p in patterns)]
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    results = run(cases, sizes, args.min_time, args.repeat, args.max_call_seconds)
+    report = {
+        "machine": {"python": platform.python_version(), "cpus": os.cpu_count(), "platform": platform.platform()},
+        "settings": {"sizes": sizes, "min_time": args.min_time, "repeat": args.repeat,
+                     "max_call_seconds": args.max_call_seconds},
+        "created": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Wrote {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for name, size, base, result in regressions:
+            print("REGRESSION {} size {}: {:.1f} -> {:.1f} ns/item".format(name, size, base, result))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
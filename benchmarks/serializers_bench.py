@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Checks the CSV/TXT serializers produce the same bytes as the Jinja templates, then compares rows/second.
+Usage: python benchmarks/serializers_bench.py [rows]
+"""
+import os
+import random
+import sys
+import time
+
+HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.abspath(os.path.join(HERE_DIR, "..", "src"))
+sys.path.insert(0, SRC_DIR)
+
+from jinja2 import Environment, FileSystemLoader  # noqa: E402
+from serializers import CSV, TXT, OBSERVATION_SPECS, observation_serializer, calibration_serializers  # noqa: E402
+
+# Same environment options as the app, sanic_jinja2 doesn't turn on autoescape
+env = Environment(loader=FileSystemLoader(os.path.join(SRC_DIR, "templates")))
+
+
+def observation_template(processing_level, kind):
+    if processing_level == 0:
+        return "raw_data_{}.html".format(kind)
+    return "level{}_data_{}.html".format(processing_level, kind)
+
+
+def make_observations(processing_level, rows, seed=1):
+    rnd = random.Random(seed)
+    fields = [c[0] for c in OBSERVATION_SPECS[processing_level][0]]
+    columns = ["time"] + sorted(set(fields) - {"time"}) + ["site_no"]
+    values = []
+    for i in range(rows):
+        row = []
+        for c in columns:
+            if c == "time":
+                row.append("2019-{:02d}-{:02d}T{:02d}:00:00Z".format(1 + i % 12, 1 + i % 28, i % 24))
+            elif c == "site_no":
+                row.append("21")
+            elif c == "flag":
+                row.append(rnd.choice(["", "0", "F", "MH"]))
+            else:
+                row.append(rnd.choice([rnd.uniform(-1e4, 1e5), float(rnd.randint(0, 5000)), -0.0004, 0.0]))
+        values.append(row)
+    return columns, values
+
+
+def make_calibrations(rows, seed=2):
+    rnd = random.Random(seed)
+    calibrations = []
+    for i in range(rows):
+        calibrations.append({
+            "date": rnd.choice(["2018-02-{:02d}T00:00:00Z".format(1 + i % 28), "2018-02-01", "2018 02 01 10:00"]),
+            "label": rnd.choice(["A1", "B12", "core 3"]),
+            "loc": rnd.choice(["N", "SW", "centre"]),
+            "depth": rnd.choice(["0-5", "5-10", "10-15cm"]),
+            "vol": rnd.choice(["", "100", "n/a"]),
+            "total_wet": rnd.uniform(0, 500), "total_dry": rnd.uniform(0, 500), "tare": rnd.uniform(0, 50),
+            "soil_wet": rnd.uniform(0, 500), "soil_dry": rnd.uniform(0, 500), "gwc": rnd.uniform(0, 1),
+            "bd": rnd.uniform(0, 2), "vwc": rnd.uniform(0, 1),
+        })
+    return calibrations
+
+
+def check_identical(rows):
+    failures = 0
+    for processing_level in sorted(OBSERVATION_SPECS):
+        columns, values = make_observations(processing_level, rows)
+        observations = [dict(zip(columns, v)) for v in values]
+        for kind in (CSV, TXT):
+            expected = env.get_template(observation_template(processing_level, kind)).render(observations=observations)
+            serializer = observation_serializer(processing_level, kind)
+            for name, got in (("values", serializer.header + serializer.rows_from_values(columns, values)),
+                              ("dicts", serializer.render_dicts(observations))):
+                if got != expected:
+                    failures += 1
+                    print("MISMATCH level {} {} from {}".format(processing_level, kind, name))
+    calibrations = make_calibrations(rows)
+    for kind in (CSV, TXT):
+        expected = env.get_template("site_data_cal_{}.html".format(kind)).render(calibrations=calibrations)
+        if calibration_serializers[kind].render_dicts(calibrations) != expected:
+            failures += 1
+            print("MISMATCH calibration {}".format(kind))
+    return failures
+
+
+def rate(fn, rows, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+
+def benchmark(rows):
+    print("{:>6s} {:>4s} {:>14s} {:>14s} {:>14s} {:>7s}".format(
+        "level", "kind", "jinja rows/s", "dicts rows/s", "values rows/s", "speedup"))
+    for processing_level in sorted(OBSERVATION_SPECS):
+        columns, values = make_observations(processing_level, rows)
+        observations = [dict(zip(columns, v)) for v in values]
+        for kind in (CSV, TXT):
+            template = env.get_template(observation_template(processing_level, kind))
+            serializer = observation_serializer(processing_level, kind)
+            jinja_rate = rate(lambda: template.render(observations=observations), rows)
+            dicts_rate = rate(lambda: serializer.render_dicts(observations), rows)
+            values_rate = rate(lambda: serializer.rows_from_values(columns, values), rows)
+            print("{:>6d} {:>4s} {:>14,.0f} {:>14,.0f} {:>14,.0f} {:>6.1f}x".format(
+                processing_level, kind, jinja_rate, dicts_rate, values_rate, values_rate / jinja_rate))
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    failures = check_identical(min(rows, 5000))
+    if failures:
+        print("{} outputs differ from the templates".format(failures))
+        sys.exit(1)
+    print("All outputs are byte-identical to the templates.")
+    benchmark(rows)
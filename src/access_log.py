@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Access log in the vcombined format, one file per UTC day in METRICS_DIRECTORY, same as sanic_metrics wrote.
+Requests only append a record to an in-memory buffer, a background task formats and writes the buffer
+in batches on a worker thread, so file I/O never holds up a response.
+"""
+import asyncio
+import datetime
+import fcntl
+import gzip
+import os
+import re
+import shutil
+import time
+from collections import deque
+
+import config
+from metrics_registry import registry, ACCESS_LOG_DROPPED
+
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+SEGMENT_RE = re.compile(r"^access_(\d{8})(?:\.(\d+))?\.txt(\.gz)?$")
+
+
+def _filename(directory, date, segment=None):
+    if segment is None:
+        return os.path.join(directory, "access_{:s}.txt".format(date))
+    return os.path.join(directory, "access_{:s}.{:d}.txt".format(date, segment))
+
+
+def format_record(record):
+    """
+    :param record: tuple made by log_request
+    :return: (UTC date as YYYYMMDD, vcombined log line)
+    """
+    (timestamp, host, client, method, path, qs, version, status, nbytes, referer, user_agent) = record
+    dt = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+    line = "{:s}: {:s} - - [{:s}] \"{:s} {:s}{:s} HTTP/{:s}\" {:d} {:d} \"{:s}\" \"{:s}\"".format(
+        host.lstrip('[').rstrip(']').replace(":", ""), client.lstrip('[').rstrip(']'),
+        dt.strftime("%d/%b/%Y:%H:%M:%S %z"), method, path, qs or "", version, status, nbytes, referer, user_agent)
+    return dt.strftime("%Y%m%d"), line
+
+
+class AccessLogWriter(object):
+    """
+    Bounded buffer of access log records, written out by run() every flush_interval seconds,
+    or sooner once the buffer is half full.
+    When the buffer is full the overflow policy applies: drop_newest discards the incoming record,
+    drop_oldest discards the oldest buffered one. Requests never wait for the log.
+    Files over max_bytes are moved aside to access_<date>.<n>.txt, rotated files and the files of
+    past days are gzipped when compress is on. Workers share the files, an flock serialises the writes.
+    """
+    __slots__ = ("directory", "max_buffer", "overflow", "flush_interval", "max_bytes", "compress",
+                 "_buffer", "_dropped", "_wakeup", "_compressed_for")
+
+    def __init__(self, directory, max_buffer, overflow, flush_interval, max_bytes, compress):
+        if overflow not in (DROP_NEWEST, DROP_OLDEST):
+            raise RuntimeError("Unknown access log overflow policy \"{}\"".format(overflow))
+        self.directory = directory
+        self.max_buffer = max(1, max_buffer)
+        self.overflow = overflow
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._buffer = deque()
+        self._dropped = 0
+        self._wakeup = None
+        # the UTC date that closed files were last compressed for
+        self._compressed_for = None
+
+    def append(self, record):
+        buffer = self._buffer
+        if len(buffer) >= self.max_buffer:
+            self._dropped += 1
+            registry.inc(ACCESS_LOG_DROPPED, ())
+            if self.overflow == DROP_NEWEST:
+                return
+            buffer.popleft()
+        buffer.append(record)
+        if self._wakeup is not None and len(buffer) * 2 >= self.max_buffer:
+            self._wakeup.set()
+
+    def _take(self):
+        records = self._buffer
+        dropped = self._dropped
+        self._buffer = deque()
+        self._dropped = 0
+        return records, dropped
+
+    def _next_segment(self, date):
+        segments = [0]
+        for name in os.listdir(self.directory):
+            m = SEGMENT_RE.match(name)
+            if m and m.group(1) == date and m.group(2):
+                segments.append(int(m.group(2)))
+        return max(segments) + 1
+
+    def _append(self, date, data):
+        """
+        :return: True if the file was rotated first
+        """
+        filename = _filename(self.directory, date)
+        rotated = False
+        if self.max_bytes > 0:
+            try:
+                size = os.stat(filename).st_size
+            except FileNotFoundError:
+                size = 0
+            if size and size + len(data) > self.max_bytes:
+                os.rename(filename, _filename(self.directory, date, self._next_segment(date)))
+                rotated = True
+        with open(filename, 'ab') as f:
+            f.write(data)
+        return rotated
+
+    def _compress_closed(self, today):
+        """
+        Gzips the rotated files, and the files of days before today.
+        """
+        for name in os.listdir(self.directory):
+            m = SEGMENT_RE.match(name)
+            if not m or m.group(3) or (m.group(2) is None and m.group(1) >= today):
+                continue
+            source = os.path.join(self.directory, name)
+            target = source + ".gz"
+            if os.path.exists(target):
+                # a late record reopened a day that was already compressed, keep both
+                target = _filename(self.directory, m.group(1), self._next_segment(m.group(1))) + ".gz"
+            tmp_target = target + ".tmp"
+            with open(source, 'rb') as f_in, gzip.open(tmp_target, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(tmp_target, target)
+            os.unlink(source)
+
+    def write(self, records, dropped=0):
+        """
+        Formats and appends the records, rotating and compressing as needed. Runs on a worker thread.
+        """
+        if dropped:
+            print("Access log buffer was full, {:d} records were dropped".format(dropped))
+        if not records:
+            return
+        lines = {}
+        for record in records:
+            (date, line) = format_record(record)
+            lines.setdefault(date, []).append(line)
+        os.makedirs(self.directory, exist_ok=True)
+        today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+        with open(os.path.join(self.directory, "access.lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                rotated = False
+                for date, date_lines in lines.items():
+                    rotated |= self._append(date, ("\n".join(date_lines) + "\n").encode('utf-8'))
+                if self.compress and (rotated or self._compressed_for != today or min(lines) < today):
+                    self._compress_closed(today)
+                    self._compressed_for = today
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    async def flush(self):
+        records, dropped = self._take()
+        if records or dropped:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.write, records, dropped)
+
+    async def run(self):
+        """
+        Background task of each worker, writes the buffer out until the worker stops.
+        """
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except OSError as e:
+                print("Writing the access log failed: {}".format(repr(e)))
+
+
+def log_request(request, response):
+    """
+    Buffers the access log record of a request. Called from response middleware,
+    request.ctx.override_metrics (set by POST /rest/metrics) replaces fields of the record.
+    """
+    if not config.ACCESS_LOG_ENABLED:
+        return
+    opt = request.args.get('metrics', None)
+    if opt is not None and opt not in config.TRUTHS:
+        return
+    ctx = request.ctx
+    override = getattr(ctx, 'override_metrics', None) or {}
+    if response is not None and not override.get('skip_response', False):
+        status = response.status
+        body = getattr(response, 'body', None)
+        nbytes = len(body) if body is not None else 0
+    else:
+        status = 500
+        nbytes = 0
+    qs = request.query_string
+    qs = "?" + qs if qs else None
+    writer.append((
+        override.get('timestamp_start', None) or getattr(ctx, 'started_at', None) or time.time(),
+        override.get('host', None) or request.server_name or "127.0.0.1",
+        request.remote_addr or request.ip or "0.0.0.0",
+        override.get('method', request.method),
+        override.get('path', request.path),
+        override.get('qs', qs),
+        request.version or "1.0",
+        int(override.get('status', status)),
+        nbytes,
+        request.headers.get('Referer', ""),
+        request.headers.get('User-Agent', ""),
+    ))
+
+
+writer = AccessLogWriter(config.METRICS_DIRECTORY,
+                         config.ACCESS_LOG_BUFFER_SIZE,
+                         config.ACCESS_LOG_OVERFLOW,
+                         config.ACCESS_LOG_FLUSH_INTERVAL,
+                         config.ACCESS_LOG_MAX_BYTES,
+                         config.ACCESS_LOG_COMPRESS)
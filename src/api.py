@@ -20,13 +20,25 @@ from datetime import datetime, timezone, timedelta
 from urllib.parse import urlsplit
 from sanic_restplus import Api, Resource, fields
 from sanic.response import json, text, stream, HTTPResponse
-from sanic.exceptions import ServiceUnavailable
+from sanic.exceptions import ServiceUnavailable, InvalidUsage, Unauthorized, NotFound
 from sanic_jinja2_spf import sanic_jinja2
 from orjson import dumps as fast_dumps, OPT_NAIVE_UTC, OPT_UTC_Z
 
-from config import TRUTHS
-from functions import get_observations_influx, get_station_mongo, get_stations_mongo, get_station_calibration_mongo, get_last_observations_influx
-from util import PY_36, datetime_from_iso
+from apikey import check_admin_apikey
+from cache import observations_cache
+from conditional import stations_validators, last_observations_validators, not_modified_response, \
+    add_validator_headers, validator_headers
+from columnar import COLUMNAR_MIMETYPES, FORMAT_ALIASES, FILE_EXTENSIONS, write_columnar_chunks
+from config import TRUTHS, BULK_OBSERVATIONS_MAX_STATIONS
+from metrics_registry import registry as metrics_registry, PROMETHEUS_CONTENT_TYPE
+from rollups import invalidate_rollups, rebuild_rollups
+from serializers import CSV, TXT, observation_serializer, calibration_serializers
+from latest import get_latest_observations
+from functions import get_observations_influx, get_station_mongo, get_stations_mongo, get_station_calibration_mongo, get_last_observations_influx, \
+    stream_observations_influx, stream_last_observations_influx, stream_observation_columns_influx, \
+    stream_last_observation_columns_influx, get_bulk_observations_influx
+from timing import NO_TIMINGS, request_timings, load_profile
+from util import PY_36, datetime_from_iso, decode_cursor
 
 try:
     # Test to see if this works...
@@ -75,6 +87,23 @@ def get_jinja2_for_api(_a):
     return assoc
 
 
+async def write_serialized_chunks(serializer, response, chunks, timings=NO_TIMINGS):
+    """
+    Writes the serializer header, then each chunk of observations straight to the response as it arrives,
+    so only one chunk is held in memory at a time.
+    :param serializer: serializers.TextSerializer
+    :param chunks: async iterator of influx (columns, values)
+    :param timings: timing.ServerTimings, gets the "render" and "write" spans
+    """
+    with timings.span("write"):
+        await response.write(serializer.header)
+    async for columns, values in chunks:
+        with timings.span("render"):
+            data = serializer.rows_from_values(columns, values)
+        with timings.span("write"):
+            await response.write(data)
+
+
 def get_accept_mediatypes_in_order(request):
     """
     Reads an Accept HTTP header and returns an array of Media Type string in descending weighted order
@@ -114,7 +143,10 @@ def get_accept_mediatypes_in_order(request):
             'You have requested a Media Type using an Accept header that is incorrectly formatted.')
 
 def match_accept_mediatypes_to_provides(request, provides):
-    order = get_accept_mediatypes_in_order(request)
+    with request_timings(request).span("accept"):
+        return _match_accept_mediatypes(get_accept_mediatypes_in_order(request), provides)
+
+def _match_accept_mediatypes(order, provides):
     for i in order:
         if i in provides:
             return i
@@ -150,6 +182,7 @@ class Stations(Resource):
     @ns.produces(["application/json"])
     async def get(self, request, *args, **kwargs):
         '''Get cosmoz stations.'''
+        timings = request_timings(request)
         property_filter = request.args.getlist('property_filter', None)
         if property_filter:
             property_filter = str(next(iter(property_filter))).split(',')
@@ -169,12 +202,18 @@ class Stations(Resource):
             "count": count,
             "offset": offset,
         }
+        etag, last_modified = await stations_validators(request, 'application/json')
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
         res = await get_stations_mongo(obs_params, json_safe='orjson')
+        with timings.span("serialize"):
+            body = fast_dumps(res, option=orjson_option)
         if use_body_bytes:
-            resp = HTTPResponse(None, status=200, content_type='application/json', body_bytes=fast_dumps(res, option=orjson_option))
+            resp = HTTPResponse(None, status=200, content_type='application/json', body_bytes=body)
         else:
-            resp = HTTPResponse(fast_dumps(res, option=orjson_option), status=200, content_type='application/json')
-        return resp
+            resp = HTTPResponse(body, status=200, content_type='application/json')
+        return add_validator_headers(resp, etag, last_modified)
 
     @ns.doc('post_station', params=OrderedDict([
         ("name", {"description": "Station Name",
@@ -189,6 +228,41 @@ class Stations(Resource):
         #Generates station number
         return text("OK")
 
+@ns.route('/stations/lastobservations')
+class StationsLastObservations(Resource):
+    '''Gets a JSON representation of every station with its most recent observation record.'''
+    accept_types = ["application/json"]
+
+    @ns.doc('get_stations_last_records', params=OrderedDict([
+        ("processing_level", {"description": "Query the table for this processing level.\n\n"
+                              "(0, 1, 2, 3, or 4).",
+                              "required": False, "type": "number", "format": "integer", "default": 4}),
+    ]))
+    @ns.produces(accept_types)
+    async def get(self, request, *args, **kwargs):
+        '''Get every cosmoz station with its most recent record.'''
+        timings = request_timings(request)
+        return_type = "application/json"
+        processing_level = request.args.getlist('processing_level', None)
+        if processing_level:
+            try:
+                processing_level = int(next(iter(processing_level)))
+            except ValueError:
+                raise InvalidUsage("processing_level must be an integer.")
+        else:
+            processing_level = 4
+        if not 0 <= processing_level <= 4:
+            raise InvalidUsage("Only levels 0, 1, 2, 3 or 4 are acceptable.")
+        res = await get_latest_observations(processing_level)
+        with timings.span("serialize"):
+            body = fast_dumps(res, option=orjson_option)
+        if use_body_bytes:
+            resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=body)
+        else:
+            resp = HTTPResponse(body, status=200, content_type=return_type)
+        return resp
+
+
 @ns.route('/stations/<station_no>')
 @ns.param('station_no', "Station Number", type="number", format="integer")
 @ns.response(404, 'Station not found')
@@ -204,6 +278,7 @@ class Station(Resource):
     @ns.produces(accept_types)
     async def get(self, request, *args, station_no=None, **kwargs):
         '''Get cosmoz station.'''
+        timings = request_timings(request)
         if station_no is None:
             raise RuntimeError("station_no is mandatory.")
         station_no = int(station_no)
@@ -228,26 +303,35 @@ class Station(Resource):
         obs_params = {
             "property_filter": property_filter,
         }
+        etag, last_modified = await stations_validators(request, return_type)
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
         json_safe = 'orjson' if return_type == "application/json" else False
         jinja_safe = 'txt' if return_type == "text/plain" else False
         res = await get_station_mongo(station_no, obs_params, json_safe=json_safe, jinja_safe=jinja_safe)
         if return_type == "application/json":
+            with timings.span("serialize"):
+                body = fast_dumps(res, option=orjson_option)
             if use_body_bytes:
-                resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=fast_dumps(res, option=orjson_option))
+                resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=body)
             else:
-                resp = HTTPResponse(fast_dumps(res, option=orjson_option), status=200, content_type=return_type)
-            return resp
+                resp = HTTPResponse(body, status=200, content_type=return_type)
+            return add_validator_headers(resp, etag, last_modified)
         elif return_type == "application/csv":
             raise NotImplementedError()
             #return build_csv(res)
         elif return_type == "text/plain":
             headers = {'Content-Type': return_type}
             jinja2 = get_jinja2_for_api(self.api)
+            headers.update(validator_headers(etag, last_modified))
             station = res['station']
-            if PY_36:
-                return await jinja2.render_async('site_values_txt.html', request, headers=headers, status=200, **station)
-            else:
-                return jinja2.render('site_values_txt.html', request, headers=headers, status=200, **station)
+            with timings.span("render"):
+                if PY_36:
+                    return await jinja2.render_async('site_values_txt.html', request, headers=headers, status=200,
+                                                     **station)
+                else:
+                    return jinja2.render('site_values_txt.html', request, headers=headers, status=200, **station)
 
     @ns.doc('put_station', params=OrderedDict([
         ("name", {"description": "Station Name",
@@ -276,6 +360,7 @@ class StationCalibration(Resource):
     @ns.produces(accept_types)
     async def get(self, request, *args, station_no=None, **kwargs):
         '''Get cosmoz station calibrations.'''
+        timings = request_timings(request)
         if station_no is None:
             raise RuntimeError("station_no is mandatory.")
         station_no = int(station_no)
@@ -304,25 +389,26 @@ class StationCalibration(Resource):
         json_safe = 'orjson' if return_type == "application/json" else False
         jinja_safe = 'txt' if return_type == "text/plain" else False
         jinja_safe = 'csv' if return_type == "text/csv" else jinja_safe
-        res = await get_station_calibration_mongo(station_no, obs_params, json_safe=json_safe, jinja_safe=jinja_safe)
+        res = await get_station_calibration_mongo(station_no, obs_params, json_safe=json_safe, jinja_safe=jinja_safe,
+                                                  timings=timings)
         if return_type == "application/json":
+            with timings.span("serialize"):
+                body = fast_dumps(res, option=orjson_option)
             if use_body_bytes:
-                resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=fast_dumps(res, option=orjson_option))
+                resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=body)
             else:
-                resp = HTTPResponse(fast_dumps(res, option=orjson_option), status=200, content_type=return_type)
+                resp = HTTPResponse(body, status=200, content_type=return_type)
             return resp
         headers = {'Content-Type': return_type}
-        jinja2 = get_jinja2_for_api(self.api)
         if return_type == "text/csv":
-            template = 'site_data_cal_csv.html'
+            serializer = calibration_serializers[CSV]
         elif return_type == "text/plain":
-            template = 'site_data_cal_txt.html'
+            serializer = calibration_serializers[TXT]
         else:
-            raise RuntimeError("Cannot determine template name to use for response type.")
-        if PY_36:
-            return await jinja2.render_async(template, request, headers=headers, **res)
-        else:
-            return jinja2.render(template, request, headers=headers, **res)
+            raise RuntimeError("Cannot determine serializer to use for response type.")
+        with timings.span("render"):
+            body = serializer.render_dicts(res['calibrations'])
+        return HTTPResponse(body, status=200, headers=headers, content_type=return_type)
 
     @ns.doc('put_station_cal', params=OrderedDict([
         ("name", {"description": "Station Name",
@@ -372,7 +458,7 @@ class StationCalibration(Resource):
 @ns.route('/stations/<station_no>/observations')
 @ns.param('station_no', "Station Number", type="number", format="integer")
 class Observations(Resource):
-    accept_types = ["application/json", "text/csv", "text/plain"]
+    accept_types = ["application/json", "text/csv", "text/plain"] + COLUMNAR_MIMETYPES
     '''Gets a JSON representation of observation records in the COSMOZ database.'''
 
     @ns.doc('get_records', params=OrderedDict([
@@ -395,12 +481,19 @@ class Observations(Resource):
                           "required": False, "type": "boolean", "default": False}),
         ("count", {"description": "Number of records to return.",
                    "required": False, "type": "number", "format": "integer", "default": 2000}),
+        ("layout", {"description": "Layout of observations in JSON responses.\n\n"
+                                   "`rows` for a list of records, `columns` for a list of values per property.",
+                    "required": False, "type": "string", "format": "text", "default": "rows"}),
         ("offset", {"description": "Skip number of records before reading count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Continue after the page that returned this `next_cursor`.\n\n"
+                                   "Faster than `offset` for deep pages.",
+                    "required": False, "type": "string", "format": "text"}),
     ]))
     @ns.produces(accept_types)
     async def get(self, request, *args, station_no=None, **kwargs):
         '''Get cosmoz records.'''
+        timings = request_timings(request)
         return_type = match_accept_mediatypes_to_provides(request,
                                                           self.accept_types)
         format = request.args.getlist('format', None)
@@ -408,6 +501,7 @@ class Observations(Resource):
             format = request.args.getlist('_format', None)
         if format:
             format = next(iter(format))
+            format = FORMAT_ALIASES.get(format, format)
             if format in self.accept_types:
                 return_type = format
         if return_type is None:
@@ -421,7 +515,8 @@ class Observations(Resource):
         else:
             processing_level = 4
         not_json = return_type != "application/json"
-        if not not_json:
+        columnar = return_type in COLUMNAR_MIMETYPES
+        if not not_json or columnar:
             property_filter = request.args.getlist('property_filter', None)
             if property_filter:
                 property_filter = str(next(iter(property_filter))).split(',')
@@ -468,6 +563,14 @@ class Observations(Resource):
                 offset = fallback_offset
         else:
             offset = fallback_offset
+        cursor = request.args.getlist('cursor', None)
+        if cursor:
+            try:
+                cursor = decode_cursor(next(iter(cursor)))
+            except ValueError as v:
+                raise InvalidUsage(str(v))
+        else:
+            cursor = None
         obs_params = {
             "processing_level": processing_level,
             "property_filter": property_filter,
@@ -476,60 +579,192 @@ class Observations(Resource):
             "enddate": enddate,
             "count": count,
             "offset": offset,
+            "cursor": cursor,
         }
         if not not_json:
             json_safe = 'orjson'
+            layout = request.args.getlist('layout', None)
+            if layout:
+                layout = next(iter(layout))
+                if layout not in ("rows", "columns"):
+                    raise InvalidUsage("layout must be rows or columns.")
+                obs_params['layout'] = layout
             try:
-                res = get_observations_influx(station_no, obs_params, json_safe, False)
+                res = await get_observations_influx(station_no, obs_params, json_safe, False, timings=timings)
+                with timings.span("serialize"):
+                    body = fast_dumps(res, option=orjson_option)
                 if use_body_bytes:
-                    resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=fast_dumps(res, option=orjson_option))
+                    resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=body)
                 else:
-                    resp = HTTPResponse(fast_dumps(res, option=orjson_option), status=200, content_type=return_type)
+                    resp = HTTPResponse(body, status=200, content_type=return_type)
                 return resp
             except Exception as e:
                 print(e)
                 raise e
+        if columnar:
+            headers = {'Content-Type': return_type,
+                       'Content-Disposition': "attachment; filename=\"station{}_level{}.{}\""
+                       .format(str(station_no), str(processing_level), FILE_EXTENSIONS[return_type])}
+
+            async def columnar_streaming_fn(response):
+                field_types, chunks = await stream_observation_columns_influx(station_no, obs_params,
+                                                                              timings=timings)
+                await write_columnar_chunks(response, return_type, chunks, field_types)
+
+            return stream(columnar_streaming_fn, status=200, headers=headers, content_type=return_type)
         headers = {'Content-Type': return_type}
-        jinja2 = get_jinja2_for_api(self.api)
         if return_type == "text/csv":
-            if processing_level == 0:
-                template = "raw_data_csv.html"
-            else:
-                template = "level{}_data_csv.html".format(processing_level)
+            serializer = observation_serializer(processing_level, CSV)
             headers['Content-Disposition'] = "attachment; filename=\"station{}_level{}.csv\"" \
                 .format(str(station_no), str(processing_level))
         elif return_type == "text/plain":
             headers = {'Content-Type': return_type}
-            if processing_level == 0:
-                template = "raw_data_txt.html"
-            else:
-                template = "level{}_data_txt.html".format(processing_level)
+            serializer = observation_serializer(processing_level, TXT)
             headers['Content-Disposition'] = "attachment; filename=\"station{}_level{}.txt\"" \
                 .format(str(station_no), str(processing_level))
         else:
             raise RuntimeError("Invalid Return Type")
 
         async def streaming_fn(response):
-            nonlocal template
+            nonlocal serializer
             nonlocal station_no
             nonlocal obs_params
-            nonlocal request
             nonlocal excel_compat
-            res = get_observations_influx(station_no, obs_params, False, excel_compat)
-            if PY_36:
-                r = await jinja2.render_string_async(template, request, **res)
-            else:
-                r = jinja2.render_string(template, request, **res)
-            await response.write(r)
+            chunks = stream_observations_influx(station_no, obs_params, excel_compat, timings=timings)
+            await write_serialized_chunks(serializer, response, chunks, timings=timings)
 
         return stream(streaming_fn, status=200, headers=headers, content_type=return_type)
 
 
+@ns.route('/observations')
+class BulkObservations(Resource):
+    '''Gets a JSON representation of observation records for several stations in the COSMOZ database.'''
+    accept_types = ["application/json"]
+
+    @ns.doc('get_bulk_records', params=OrderedDict([
+        ("stations", {"description": "Comma delimited list of station numbers.\n\n"
+                                     "_Eg: `1,2,5`_",
+                      "required": True, "type": "string", "format": "text"}),
+        ("processing_level", {"description": "Query the table for this processing level.\n\n"
+                              "(0, 1, 2, 3, or 4).",
+                              "required": False, "type": "number", "format": "integer", "default": 4}),
+        ("startdate", {"description": "Start of the date/time range, in ISO8601 format.\n\n"
+                       "_Eg: `2017-06-01T00:00:00Z`_\n\n",
+                       "required": False, "type": "string", "format": "text"}),
+        ("enddate", {"description": "End of the date/time range, in ISO8601 format.\n\n"
+                     "_Eg: `2017-07-01T23:59:59Z`_\n\n",
+                     "required": False, "type": "string", "format": "text"}),
+        ("property_filter", {"description": "Comma delimited list of properties to retrieve.\n\n"
+                             "_Enter * for all_.",
+                             "required": False, "type": "string", "format": "text"}),
+        ("aggregate", {"description": "Average observations over a given time period.\n\n"
+                                      "Eg. `2h` or `3m` or `1d`",
+                       "required": False, "type": "string", "format": "text"}),
+        ("count", {"description": "Number of records to return for each station.",
+                   "required": False, "type": "number", "format": "integer", "default": 2000}),
+        ("offset", {"description": "Skip number of records before reading count.",
+                    "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("layout", {"description": "Layout of observations in JSON responses.\n\n"
+                                   "`rows` for a list of records, `columns` for a list of values per property.",
+                    "required": False, "type": "string", "format": "text", "default": "rows"}),
+    ]))
+    @ns.produces(accept_types)
+    async def get(self, request, *args, **kwargs):
+        '''Get cosmoz records for several stations.'''
+        timings = request_timings(request)
+        return_type = "application/json"
+        stations = request.args.getlist('stations', None)
+        if not stations:
+            raise InvalidUsage("stations is mandatory.")
+        try:
+            stations = [int(s) for s in str(next(iter(stations))).split(',') if len(s)]
+        except ValueError:
+            raise InvalidUsage("stations must be a comma delimited list of station numbers.")
+        # Keep the order given, without repeats
+        stations = list(OrderedDict.fromkeys(stations))
+        if not stations:
+            raise InvalidUsage("stations is mandatory.")
+        if len(stations) > BULK_OBSERVATIONS_MAX_STATIONS:
+            raise InvalidUsage("At most {:d} stations can be requested at once."
+                               .format(BULK_OBSERVATIONS_MAX_STATIONS))
+        processing_level = request.args.getlist('processing_level', None)
+        if processing_level:
+            try:
+                processing_level = int(next(iter(processing_level)))
+            except ValueError:
+                raise InvalidUsage("processing_level must be an integer.")
+        else:
+            processing_level = 4
+        if not 0 <= processing_level <= 4:
+            raise InvalidUsage("Only levels 0, 1, 2, 3 or 4 are acceptable.")
+        property_filter = request.args.getlist('property_filter', None)
+        if property_filter:
+            property_filter = str(next(iter(property_filter))).split(',')
+            property_filter = [p for p in property_filter if len(p)]
+        aggregate = request.args.getlist('aggregate', None)
+        if aggregate:
+            aggregate = str(next(iter(aggregate)))
+        nowtime = datetime.utcnow().astimezone(timezone.utc)
+        startdate = request.args.getlist('startdate', None)
+        if startdate:
+            startdate = next(iter(startdate))
+        else:
+            startdate = (nowtime + timedelta(days=-365)) \
+                .replace(hour=0, minute=0, second=0, microsecond=0)
+        enddate = request.args.getlist('enddate', None)
+        if enddate:
+            enddate = next(iter(enddate))
+        else:
+            enddate = nowtime.replace(hour=23, minute=59, second=59, microsecond=0)
+        count = request.args.getlist('count', None)
+        fallback_count = 2000
+        if count:
+            try:
+                count = min(int(next(iter(count))), MAX_RETURN_COUNT)
+            except ValueError:
+                count = fallback_count
+        else:
+            count = fallback_count
+        offset = request.args.getlist('offset', None)
+        fallback_offset = 0
+        if offset:
+            try:
+                offset = min(int(next(iter(offset))), MAX_RETURN_COUNT)
+            except ValueError:
+                offset = fallback_offset
+        else:
+            offset = fallback_offset
+        obs_params = {
+            "processing_level": processing_level,
+            "property_filter": property_filter,
+            "aggregate": aggregate,
+            "startdate": startdate,
+            "enddate": enddate,
+            "count": count,
+            "offset": offset,
+        }
+        layout = request.args.getlist('layout', None)
+        if layout:
+            layout = next(iter(layout))
+            if layout not in ("rows", "columns"):
+                raise InvalidUsage("layout must be rows or columns.")
+            obs_params['layout'] = layout
+        json_safe = 'orjson'
+        res = await get_bulk_observations_influx(stations, obs_params, json_safe, False)
+        with timings.span("serialize"):
+            body = fast_dumps(res, option=orjson_option)
+        if use_body_bytes:
+            resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=body)
+        else:
+            resp = HTTPResponse(body, status=200, content_type=return_type)
+        return resp
+
+
 @ns.route('/stations/<station_no>/lastobservations')
 @ns.param('station_no', "Station Number", type="number", format="integer")
 class LastObservations(Resource):
     '''Gets a JSON representation of recent observation records in the COSMOZ database.'''
-    accept_types = ["application/json", "text/csv", "text/plain"]
+    accept_types = ["application/json", "text/csv", "text/plain"] + COLUMNAR_MIMETYPES
     @ns.doc('get_records', params=OrderedDict([
         ("processing_level", {"description": "Query the table for this processing level.\n\n"
                               "(0, 1, 2, 3, or 4).",
@@ -541,10 +776,14 @@ class LastObservations(Resource):
                           "required": False, "type": "boolean", "default": False}),
         ("count", {"description": "Number of records to return.",
                    "required": False, "type": "number", "format": "integer", "default": 1}),
+        ("layout", {"description": "Layout of observations in JSON responses.\n\n"
+                                   "`rows` for a list of records, `columns` for a list of values per property.",
+                    "required": False, "type": "string", "format": "text", "default": "rows"}),
     ]))
     @ns.produces(accept_types)
     async def get(self, request, *args, station_no=None, **kwargs):
         '''Get recent cosmoz records.'''
+        timings = request_timings(request)
         return_type = match_accept_mediatypes_to_provides(request,
                                                           self.accept_types)
         format = request.args.getlist('format', None)
@@ -552,6 +791,7 @@ class LastObservations(Resource):
             format = request.args.getlist('_format', None)
         if format:
             format = next(iter(format))
+            format = FORMAT_ALIASES.get(format, format)
             if format in self.accept_types:
                 return_type = format
         if return_type is None:
@@ -561,12 +801,18 @@ class LastObservations(Resource):
         station_no = int(station_no)
         processing_level = request.args.getlist('processing_level', None)
         if processing_level:
-            processing_level = int(next(iter(processing_level)))
+            try:
+                processing_level = int(next(iter(processing_level)))
+            except ValueError:
+                raise InvalidUsage("processing_level must be an integer.")
         else:
             processing_level = 4
+        if not 0 <= processing_level <= 4:
+            raise InvalidUsage("Only levels 0, 1, 2, 3 or 4 are acceptable.")
         excel_compat = request.args.getlist('excel_compat', [False])[0] in TRUTHS
         not_json = return_type != "application/json"
-        if not not_json:
+        columnar = return_type in COLUMNAR_MIMETYPES
+        if not not_json or columnar:
             property_filter = request.args.getlist('property_filter', None)
             if property_filter:
                 property_filter = str(next(iter(property_filter))).split(',')
@@ -590,60 +836,127 @@ class LastObservations(Resource):
             "property_filter": property_filter,
             "count": count,
         }
+        etag, last_modified = await last_observations_validators(request, station_no, processing_level, return_type)
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
         if not not_json:
             json_safe = 'orjson'
+            layout = request.args.getlist('layout', None)
+            if layout:
+                layout = next(iter(layout))
+                if layout not in ("rows", "columns"):
+                    raise InvalidUsage("layout must be rows or columns.")
+                obs_params['layout'] = layout
             try:
-                res = get_last_observations_influx(station_no, obs_params, json_safe, False)
+                res = await get_last_observations_influx(station_no, obs_params, json_safe, False, timings=timings)
+                with timings.span("serialize"):
+                    body = fast_dumps(res, option=orjson_option)
                 if use_body_bytes:
-                    resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=fast_dumps(res, option=orjson_option))
+                    resp = HTTPResponse(None, status=200, content_type=return_type, body_bytes=body)
                 else:
-                    resp = HTTPResponse(fast_dumps(res, option=orjson_option), status=200, content_type=return_type)
-                return resp
+                    resp = HTTPResponse(body, status=200, content_type=return_type)
+                return add_validator_headers(resp, etag, last_modified)
             except Exception as e:
                 print(e)
                 raise e
+        if columnar:
+            headers = {'Content-Type': return_type,
+                       'Content-Disposition': "attachment; filename=\"station{}_level{}.{}\""
+                       .format(str(station_no), str(processing_level), FILE_EXTENSIONS[return_type])}
+            headers.update(validator_headers(etag, last_modified))
+
+            async def columnar_streaming_fn(response):
+                field_types, chunks = await stream_last_observation_columns_influx(station_no, obs_params,
+                                                                                   timings=timings)
+                await write_columnar_chunks(response, return_type, chunks, field_types)
+
+            return stream(columnar_streaming_fn, status=200, headers=headers, content_type=return_type)
         headers = {'Content-Type': return_type}
-        jinja2 = get_jinja2_for_api(self.api)
         if return_type == "text/csv":
-            if processing_level == 0:
-                template = "raw_data_csv.html"
-            else:
-                template = "level{}_data_csv.html".format(processing_level)
+            serializer = observation_serializer(processing_level, CSV)
             headers['Content-Disposition'] = "attachment; filename=\"station{}_level{}.csv\"" \
                 .format(str(station_no), str(processing_level))
         elif return_type == "text/plain":
             headers = {'Content-Type': return_type}
-            if processing_level == 0:
-                template = "raw_data_txt.html"
-            else:
-                template = "level{}_data_txt.html".format(processing_level)
+            serializer = observation_serializer(processing_level, TXT)
             headers['Content-Disposition'] = "attachment; filename=\"station{}_level{}.txt\"" \
                 .format(str(station_no), str(processing_level))
         else:
             raise RuntimeError("Invalid Return Type")
+        headers.update(validator_headers(etag, last_modified))
 
         async def streaming_fn(response):
-            nonlocal template
+            nonlocal serializer
             nonlocal station_no
             nonlocal obs_params
-            nonlocal request
             nonlocal excel_compat
-            res = get_last_observations_influx(station_no, obs_params, False, excel_compat)
-            if PY_36:
-                r = await jinja2.render_string_async(template, request, **res)
-            else:
-                r = jinja2.render_string(template, request, **res)
-            await response.write(r)
+            chunks = stream_last_observations_influx(station_no, obs_params, excel_compat, timings=timings)
+            await write_serialized_chunks(serializer, response, chunks, timings=timings)
 
         return stream(streaming_fn, status=200, headers=headers, content_type=return_type)
 
+@ns.route("/cache/invalidate", doc=False)
+class CacheInvalidate(Resource):
+    async def post(self, request, *args, **kwargs):
+        '''Invalidate cached observations, called by the processing pipeline after it rewrites a level.'''
+        api_key = request.headers.get("X-API-Key", None)
+        if not api_key:
+            api_key = next(iter(request.args.getlist('api_key', [None])))
+        if not check_admin_apikey(api_key):
+            raise Unauthorized("Please include a valid admin X-API-Key")
+        station_no = request.args.getlist('station_no', None)
+        processing_level = request.args.getlist('processing_level', None)
+        try:
+            station_no = int(next(iter(station_no))) if station_no else None
+            processing_level = int(next(iter(processing_level))) if processing_level else None
+        except ValueError:
+            raise InvalidUsage("station_no and processing_level must be integers.")
+        since = request.args.getlist('since', None)
+        if since:
+            try:
+                since = datetime_from_iso(next(iter(since)))
+            except ValueError:
+                raise InvalidUsage("since must be an ISO8601 datetime.")
+        else:
+            since = None
+        # Rollups are moved back first, so no worker answers from a stale rollup after the invalidation.
+        await invalidate_rollups(station_no, processing_level, since)
+        invalidated = observations_cache.invalidate(station_no, processing_level)
+        request.app.add_task(rebuild_rollups(station_no, processing_level))
+        res = {"result": "success", "invalidated": invalidated}
+        if use_body_bytes:
+            resp = HTTPResponse(None, status=200, content_type='application/json', body_bytes=fast_dumps(res, option=orjson_option))
+        else:
+            resp = HTTPResponse(fast_dumps(res, option=orjson_option), status=200, content_type='application/json')
+        return resp
+
+
+@ns.route("/profiles/<profile_id>", doc=False)
+class Profile(Resource):
+    async def get(self, request, *args, profile_id=None, **kwargs):
+        '''Sampled profile of a request made with the X-Profile header, as collapsed stacks.'''
+        api_key = request.headers.get("X-API-Key", None)
+        if not api_key:
+            api_key = next(iter(request.args.getlist('api_key', [None])))
+        if not check_admin_apikey(api_key):
+            raise Unauthorized("Please include a valid admin X-API-Key")
+        try:
+            profile = load_profile(profile_id or "")
+        except LookupError as e:
+            raise NotFound(str(e))
+        return text(profile)
+
+
 @ns.route("/metrics", doc=False)
 class Metrics(Resource):
-    async def post(self, request, context):
-        rcontext = context.for_request(request)
-        shared_context = context.shared
-        shared_rcontext = shared_context.for_request(request)
+    async def get(self, request, context):
+        '''Request latency, backend query and cache metrics of every worker, in the Prometheus text format.'''
+        if not metrics_registry.enabled:
+            raise NotFound("Metrics are disabled.")
+        return HTTPResponse(metrics_registry.render(), status=200, content_type=PROMETHEUS_CONTENT_TYPE)
 
+    async def post(self, request, context):
         action = request.args.getlist('action', None)
         if action:
             action = next(iter(action))
@@ -689,7 +1002,8 @@ class Metrics(Resource):
             metrics_override['qs'] = query
         else:
             raise NotImplementedError(action)
-        shared_rcontext['override_metrics'] = metrics_override
+        # the access log writes this in place of the request's own details
+        request.ctx.override_metrics = metrics_override
         res = {"result": "success"}
         if use_body_bytes:
             resp = HTTPResponse(None, status=200, content_type='application/json', body_bytes=fast_dumps(res, option=orjson_option))
@@ -1,10 +1,14 @@
 from collections import OrderedDict
+import hmac
 import secrets
-import bson
+import time
+from bson.codec_options import CodecOptions
 import oauth1_routes
 import oauth2_routes
-from pymongo import MongoClient
 import config
+from cache import ValidationCache
+from clients import get_mongo_client
+from metrics_registry import registry, OAUTH_VERIFY_DURATION
 from util import datetime_to_iso, datetime_from_iso
 import datetime
 
@@ -12,8 +16,19 @@ import datetime
 # | apikey | access_token | access_token_secret | scopes | oauth_v | oauth_client | created | expires |
 ########
 
-def get_apikey_mongo(apikey, params):
-    client = MongoClient(config.MONGODB_HOST, config.MONGODB_PORT)  # 27017
+# apikey -> full record, shared by every request in this worker, callers must not modify them
+apikey_cache = ValidationCache(config.APIKEY_CACHE_MAX_SIZE, config.APIKEY_CACHE_TTL, config.APIKEY_NEGATIVE_CACHE_TTL,
+                               name="apikey")
+
+
+def _api_keys_collection():
+    mongo_client = get_mongo_client()
+    db = getattr(mongo_client, config.MONGODB_NAME)
+    # stored datetimes are UTC
+    return db.api_keys.with_options(codec_options=CodecOptions(tz_aware=True, tzinfo=datetime.timezone.utc))
+
+
+async def get_apikey_mongo(apikey, params):
     apikey = str(apikey)
     params = params or {}
     property_filter = params.get('property_filter', [])
@@ -29,24 +44,17 @@ def get_apikey_mongo(apikey, params):
             select_filter.move_to_end('_id', last=False)
     else:
         select_filter = None
-    db = getattr(client, config.MONGODB_NAME)
-    api_keys_collection = db.api_keys
-    row = api_keys_collection.find_one({'apikey': apikey}, projection=select_filter)
+    row = await _api_keys_collection().find_one({'apikey': apikey}, projection=select_filter)
     if row is None or len(row) < 1:
         raise LookupError("Cannot find apikey.")
     resp = row
     if select_filter is None or select_filter.get('_id', False) is False:
         if '_id' in resp:
             del resp['_id']
-    for k, v in resp.items():
-        if isinstance(v, datetime.datetime):
-            if v.tzinfo is None:
-                resp[k] = v.replace(tzinfo=datetime.timezone.utc)
     return resp
 
 
-def find_apikey_by_access_token_mongo(access_token, params):
-    client = MongoClient(config.MONGODB_HOST, config.MONGODB_PORT)  # 27017
+async def find_apikey_by_access_token_mongo(access_token, params):
     access_token = str(access_token)
     params = params or {}
     property_filter = params.get('property_filter', [])
@@ -64,24 +72,17 @@ def find_apikey_by_access_token_mongo(access_token, params):
             select_filter.move_to_end('_id', last=False)
     else:
         select_filter = None
-    db = getattr(client, config.MONGODB_NAME)
-    api_keys_collection = db.api_keys
-    row = api_keys_collection.find_one({'access_token': access_token}, projection=select_filter)
+    row = await _api_keys_collection().find_one({'access_token': access_token}, projection=select_filter)
     if row is None or len(row) < 1:
         raise LookupError("Cannot find apikey with that access token.")
     resp = row
     if select_filter is None or select_filter.get('_id', False) is False:
         if '_id' in resp:
             del resp['_id']
-    for k, v in resp.items():
-        if isinstance(v, datetime.datetime):
-            if v.tzinfo is None:
-                resp[k] = v.replace(tzinfo=datetime.timezone.utc)
     return resp
 
 
-def put_apikey_mongo(apikey, params, renew=False):
-    client = MongoClient(config.MONGODB_HOST, config.MONGODB_PORT)  # 27017
+async def put_apikey_mongo(apikey, params, renew=False):
     apikey = str(apikey)
     params = params or {}
     params['apikey'] = apikey
@@ -89,28 +90,83 @@ def put_apikey_mongo(apikey, params, renew=False):
     if renew:
         assert 'access_token' in params
         criteria['access_token'] = params['access_token']
-    db = getattr(client, config.MONGODB_NAME)
-    api_keys_collection = db.api_keys
-    row = api_keys_collection.update_one(criteria, {"$set": params}, upsert=(not renew))
+    row = await _api_keys_collection().update_one(criteria, {"$set": params}, upsert=(not renew))
+    apikey_cache.invalidate(apikey)
     if not row:
         raise LookupError("Cannot set apikey.")
     resp = params
     return resp
 
 
+async def get_apikey_record(apikey, refresh=False):
+    """
+    The whole apikey record, from the validation cache when it is there.
+    Unknown keys are cached too, for APIKEY_NEGATIVE_CACHE_TTL seconds.
+    :param refresh: skip the cached entry and read the record again
+    :return: dict, don't modify it
+    """
+    apikey = str(apikey)
+    if not refresh:
+        (hit, record) = apikey_cache.get(apikey)
+        if hit:
+            if record is None:
+                raise LookupError("Cannot find apikey.")
+            return record
+    try:
+        record = await get_apikey_mongo(apikey, {'property_filter': ['*']})
+    except LookupError:
+        apikey_cache.set(apikey, None)
+        raise
+    apikey_cache.set(apikey, record)
+    return record
+
+
+def _apikey_expired(record, now=None):
+    expires = record.get('expires', None)
+    if expires is None:
+        return False
+    if isinstance(expires, str):
+        expires = datetime_from_iso(expires)
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    return expires < now
+
+
+def check_admin_apikey(apikey):
+    """
+    Admin operations use a single static key from the environment (ADMIN_API_KEY), not an issued API Key.
+    Always fails when no admin key is configured.
+    :param apikey: str
+    :return: bool
+    """
+    admin_apikey = config.ADMIN_API_KEY
+    if not admin_apikey or not apikey:
+        return False
+    return hmac.compare_digest(str(apikey).encode('utf-8'), admin_apikey.encode('utf-8'))
+
+
+def cached_apikey_valid(apikey):
+    """
+    Checks an API Key against the validation cache only, it never reads the database.
+    :param apikey: str
+    :return: bool, False when the key isn't cached or isn't valid
+    """
+    (hit, record) = apikey_cache.get(str(apikey))
+    if not hit or record is None or _apikey_expired(record):
+        return False
+    return record.get('access_token', None) is not None
+
+
 async def check_apikey_valid(apikey):
-    params = {'property_filter': ['access_token', 'expires']}
     try:
-        record = get_apikey_mongo(apikey, params)
+        record = await get_apikey_record(apikey)
+        if _apikey_expired(record):
+            # it may have been renewed since it was cached, maybe by another worker
+            record = await get_apikey_record(apikey, refresh=True)
     except LookupError as lu:
         return False, "Not Found"
-    expires = record.get('expires', None)
-    if expires is not None:
-        if isinstance(expires, str):
-            expires = datetime_from_iso(expires)
-        now = datetime.datetime.now(datetime.timezone.utc)
-        if expires < now:
-            return False, "Expired"
+    if _apikey_expired(record):
+        return False, "Expired"
     access_token = record.get('access_token', None)
     if access_token is None:
         return False, "No access token"
@@ -118,9 +174,8 @@ async def check_apikey_valid(apikey):
 
 
 async def test_apikey(apikey):
-    params = {'property_filter': ['access_token', 'access_token_secret', 'oauth_v', 'oauth_client']}
     try:
-        record = get_apikey_mongo(apikey, params)
+        record = await get_apikey_record(apikey)
     except LookupError as lu:
         return False, "Not Found"
     access_token = record.get('access_token', None)
@@ -132,10 +187,16 @@ async def test_apikey(apikey):
     if is_v1 and access_token_secret is None:
         raise RuntimeError("Cannot test API-Key, required credentials missing")
     oauth_client = record.get('oauth_client', None)
-    if is_v1:
-        works = await oauth1_routes.test_oauth1_token(oauth_client, access_token, access_token_secret)
-    else:
-        works = await oauth2_routes.test_oauth2_token(oauth_client, access_token)
+    started = time.perf_counter()
+    result = "error"
+    try:
+        if is_v1:
+            works = await oauth1_routes.test_oauth1_token(oauth_client, access_token, access_token_secret)
+        else:
+            works = await oauth2_routes.test_oauth2_token(oauth_client, access_token)
+        result = "valid" if works else "invalid"
+    finally:
+        registry.observe(OAUTH_VERIFY_DURATION, ("1.0a" if is_v1 else "2", result), time.perf_counter() - started)
     if not works:
         return False, "API-Key associated oauth access_token does not work. Perhaps it has been revoked."
     return True, "OK"
@@ -158,7 +219,7 @@ async def create_apikey_from_access_token(oauth_client, oauth_v, oauth_resp):
         scopes_or_realms = oauth_resp.get('scope')
 
     try:
-        exists = find_apikey_by_access_token_mongo(access_token, None)
+        exists = await find_apikey_by_access_token_mongo(access_token, None)
     except LookupError:
         exists = False
     if exists:
@@ -176,7 +237,7 @@ async def create_apikey_from_access_token(oauth_client, oauth_v, oauth_resp):
         "created": now,
         "expires": now + datetime.timedelta(days=7)  # TODO, is 7 days right?
     }
-    new_record = put_apikey_mongo(apikey, params, renew=False)
+    new_record = await put_apikey_mongo(apikey, params, renew=False)
     return new_record['apikey']
 
 
@@ -199,5 +260,5 @@ async def renew_apikey_from_access_token(oauth_client, oauth_v, apikey, oauth_re
         "oauth_client": oauth_client,
         "expires": now + datetime.timedelta(days=7)  # TODO, is 7 days right?
     }
-    new_record = put_apikey_mongo(apikey, params, renew=True)
+    new_record = await put_apikey_mongo(apikey, params, renew=True)
     return new_record['apikey']
@@ -15,8 +15,10 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import asyncio
 import os
 import sys
+import time
 from os import putenv, getenv
 from urllib.parse import quote_plus
 from sanic.exceptions import Unauthorized
@@ -28,7 +30,6 @@ from spf.plugins.contextualize import contextualize
 from sanic_cors.extension import cors
 from sanic_restplus import restplus
 from sanic_jinja2_spf import sanic_jinja2
-from sanic_metrics import sanic_metrics
 from jinja2 import FileSystemLoader
 import config
 
@@ -36,8 +37,17 @@ HERE_DIR = os.path.dirname(__file__)
 if HERE_DIR not in sys.path:
     sys.path.append(os.path.dirname(HERE_DIR))
 from api import api
-from apikey import check_apikey_valid, test_apikey, create_apikey_from_access_token
+from clients import open_clients, close_clients
+from apikey import check_apikey_valid, test_apikey, create_apikey_from_access_token, check_admin_apikey
 from util import PY_36
+from rollups import maintain_rollups
+from latest import maintain_latest_observations
+from compression import compress_response
+from ratelimit import check_rate_limit
+from metrics_registry import registry as metrics_registry, maintain_metrics, observe_request
+from access_log import writer as access_log_writer, log_request
+from timing import start_request_timings, finish_request_timings
+from station_snapshot import maintain_station_snapshot
 import oauth1_routes
 import oauth2_routes
 
@@ -65,8 +75,6 @@ templates_dir = os.path.abspath(os.path.join(HERE_DIR, "templates"))
 jinja2_loader = FileSystemLoader(templates_dir)
 sanic_jinja2, jinja2_reg = spf.register_plugin(sanic_jinja2, enable_async=PY_36, loader=jinja2_loader)
 restplus, restplus_reg = spf.register_plugin(restplus, _url_prefix="rest")
-metrics_filename = os.path.join(config.METRICS_DIRECTORY, "access_{date:s}.txt")
-metrics = spf.register_plugin(sanic_metrics, opt={'type': 'out'}, log={'format': 'vcombined', 'filename': metrics_filename})
 _ = oauth1_routes.add_to_app(app)
 _ = oauth2_routes.add_to_app(app)
 file_loc = os.path.abspath(os.path.join(HERE_DIR, "static/material_swagger.css"))
@@ -75,6 +83,72 @@ app.static(uri="/static/material_swagger.css", file_or_directory=file_loc,
 restplus.register_api(restplus_reg, api)
 
 APIKEY_USE_OAUTH2 = False  # if False, use Oauth 1.0a
+# this worker's maintenance tasks, cancelled when the server stops
+background_tasks = []
+
+
+@app.listener('before_server_start')
+async def start_clients(_app, loop):
+    await open_clients(loop)
+
+
+@app.listener('after_server_stop')
+async def stop_clients(_app, loop):
+    await close_clients()
+
+
+@app.listener('after_server_start')
+async def start_background_tasks(_app, loop):
+    coros = [maintain_rollups(), maintain_latest_observations(), maintain_station_snapshot(),
+             maintain_metrics(), access_log_writer.run()]
+    for routes in (oauth1_routes, oauth2_routes):
+        if routes.session_interface is not None:
+            coros.append(routes.session_interface.maintain())
+    for coro in coros:
+        background_tasks.append(loop.create_task(coro))
+
+
+@app.listener('before_server_stop')
+async def stop_background_tasks(_app, loop):
+    for task in background_tasks:
+        task.cancel()
+    # wait for them to finish, so the final flushes below come after their last write
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    metrics_registry.flush()
+    await access_log_writer.flush()
+
+
+@app.middleware('request')
+async def start_request_timer(request):
+    request.ctx.started_at = time.time()
+    request.ctx.metrics_started = time.perf_counter()
+    profile = request.headers.get("X-Profile", None) in config.TRUTHS and \
+        check_admin_apikey(request.headers.get("X-API-Key", None))
+    start_request_timings(request, profile=profile)
+
+
+@app.middleware('request')
+async def rate_limit(request):
+    return await check_rate_limit(request)
+
+
+# response middleware run in reverse order, this one runs after compress, so it sees the bytes that are sent
+@app.middleware('response')
+async def record_request_metrics(request, response):
+    observe_request(request, response)
+    log_request(request, response)
+
+
+@app.middleware('response')
+async def server_timing(request, response):
+    await finish_request_timings(request, response)
+
+
+@app.middleware('response')
+async def compress(request, response):
+    compress_response(request, response)
+
 
 @ctx.route("/apikey", methods=["GET", "POST", "HEAD", "OPTIONS"])
 async def apikey(request, context):
@@ -87,7 +161,7 @@ async def apikey(request, context):
         return HTTPResponse(None, 200, None)
     existing_apikey = request.headers.get("X-API-Key")
     if existing_apikey:
-        return await checkaccesskey(request, existing_apikey)
+        return await check_access_key(request, existing_apikey)
     if request.method == "POST":
         # We want to trade in an existing OAuth2 token for an apikey
         access_token = request.form.get('access_token', request.token)
@@ -157,7 +231,7 @@ async def checkapikey(request):
         return HTTPResponse(None, 200, None)
     existing_apikey = request.headers.get("X-API-Key")
     if existing_apikey:
-        return await checkaccesskey(request, existing_apikey)
+        return await check_access_key(request, existing_apikey)
     raise Unauthorized("Please include X-API-Key")
 
 
@@ -165,6 +239,11 @@ async def checkapikey(request):
 async def checkaccesskey(request, api_key):
     if request.method == "OPTIONS":
         return HTTPResponse(None, 200, None)
+    return await check_access_key(request, api_key)
+
+
+async def check_access_key(request, api_key):
+    # app.route returns (routes, handler), so the other routes call this rather than checkaccesskey
     if api_key is None:
         raise Unauthorized("Please include API Key in query")
     valid, message = await check_apikey_valid(api_key)
@@ -193,4 +272,7 @@ if __name__ == "__main__":
     else:
         host = server_name
         port = 9001
-    app.run(host=host, port=port, debug=config.DEBUG, auto_reload=False)
+    host = config.LISTEN_HOST or host
+    port = int(config.LISTEN_PORT or port)
+    # every worker is a separate process, with its own clients made in start_clients
+    app.run(host=host, port=port, workers=config.WORKERS, debug=config.DEBUG, auto_reload=False)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+BSON decode-time type conversion for each output mode, so documents arrive from Mongo ready to serialise.
+"""
+import datetime
+from bson.codec_options import CodecOptions, TypeDecoder, TypeRegistry
+from bson.decimal128 import Decimal128
+
+from util import datetime_to_iso
+
+
+class FloatDecimalDecoder(TypeDecoder):
+    """
+    For orjson, which can't do Decimal. Converting to float is fine because Javascript numbers
+    are native double-float anyway.
+    """
+    bson_type = Decimal128
+
+    def transform_bson(self, value):
+        g = value.to_decimal()
+        if g.is_nan():
+            return 'NaN'
+        return float(g)
+
+
+class JSONDecimalDecoder(TypeDecoder):
+    bson_type = Decimal128
+
+    def transform_bson(self, value):
+        g = value.to_decimal()
+        if g.is_nan():
+            return 'NaN'
+        return g
+
+
+class DecimalDecoder(TypeDecoder):
+    bson_type = Decimal128
+
+    def transform_bson(self, value):
+        return value.to_decimal()
+
+
+class ISODatetimeDecoder(TypeDecoder):
+    bson_type = datetime.datetime
+
+    def transform_bson(self, value):
+        return datetime_to_iso(value)
+
+
+_codec_options = {}
+
+
+def codec_options_for(json_safe=True, jinja_safe=False):
+    """
+    CodecOptions for a Motor collection, matching the json_safe and jinja_safe arguments of the get_*_mongo functions.
+    "orjson": Decimal128 as float, NaN as 'NaN', datetimes stay native (orjson can handle them)
+    other json_safe: Decimal128 as Decimal, NaN as 'NaN', datetimes as ISO8601 strings
+    jinja_safe: Decimal128 as Decimal, datetimes as ISO8601 strings
+    Datetimes are always decoded as UTC aware.
+    """
+    if json_safe == "orjson":
+        mode = ("orjson", False)
+    elif json_safe:
+        mode = ("json", False)
+    else:
+        mode = (False, bool(jinja_safe))
+    options = _codec_options.get(mode, None)
+    if options is not None:
+        return options
+    if json_safe == "orjson":
+        decoders = [FloatDecimalDecoder()]
+    elif json_safe:
+        decoders = [JSONDecimalDecoder(), ISODatetimeDecoder()]
+    elif jinja_safe:
+        decoders = [DecimalDecoder(), ISODatetimeDecoder()]
+    else:
+        decoders = [DecimalDecoder()]
+    options = _codec_options[mode] = CodecOptions(type_registry=TypeRegistry(decoders),
+                                                  tz_aware=True, tzinfo=datetime.timezone.utc)
+    return options
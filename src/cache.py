@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import datetime
+import fcntl
+import os
+import time
+from cachetools import TTLCache
+from orjson import dumps as fast_dumps, loads as fast_loads
+
+import config
+from metrics_registry import count_cache_lookup
+
+
+def process_levels_generation(now=None):
+    """
+    Observation data only changes when the process_levels job runs.
+    Returns the (date, hour) of the most recent scheduled run, this changes every time the job runs.
+    The schedule is in server local time, same as the job scheduler.
+    :param now: datetime.datetime, defaults to local now
+    :return: tuple
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    hours = config.PROCESS_LEVELS_SCHEDULE_HOURS
+    if not hours:
+        return None
+    passed = [h for h in hours if h <= now.hour]
+    if passed:
+        return now.date().toordinal(), passed[-1]
+    return now.date().toordinal() - 1, hours[-1]
+
+
+def _freeze(v):
+    if isinstance(v, (list, tuple)):
+        return tuple(_freeze(i) for i in v)
+    elif isinstance(v, dict):
+        return tuple(sorted((k, _freeze(i)) for k, i in v.items()))
+    elif isinstance(v, datetime.datetime):
+        return v.isoformat()
+    return v
+
+
+class CacheInvalidations(object):
+    """
+    Invalidation times, shared by every worker through a small JSON file.
+    Keys are "<site_no>:<processing_level>", either side can be "*".
+    """
+    __slots__ = ("filename", "_mtime", "_times")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mtime = None
+        self._times = {}
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return self._times
+        if mtime != self._mtime:
+            with open(self.filename, 'rb') as f:
+                content = f.read()
+            self._times = fast_loads(content) if content else {}
+            self._mtime = mtime
+        return self._times
+
+    def invalidated_at(self, site_no, processing_level):
+        """
+        :return: unix timestamp of the newest invalidation that applies to this site and level
+        """
+        times = self._load()
+        if not times:
+            return 0.0
+        return max(times.get("*:*", 0.0),
+                   times.get("{}:*".format(site_no), 0.0),
+                   times.get("*:{}".format(processing_level), 0.0),
+                   times.get("{}:{}".format(site_no, processing_level), 0.0))
+
+    def level_invalidated_at(self, processing_level):
+        """
+        :return: unix timestamp of the newest invalidation of any site at this level
+        """
+        times = self._load()
+        level_suffixes = (":*", ":{}".format(processing_level))
+        return max((t for k, t in times.items() if k.endswith(level_suffixes)), default=0.0)
+
+    def invalidate(self, site_no=None, processing_level=None):
+        key ="{}:{}".format("*" if site_no is None else int(site_no),
+                             "*" if processing_level is None else int(processing_level))
+        lock_filename = self.filename + ".lock"
+        with open(lock_filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._mtime = None
+                times = dict(self._load())
+                times[key] = time.time()
+                tmp_filename = "{}.{}".format(self.filename, os.getpid())
+                with open(tmp_filename, 'wb') as f:
+                    f.write(fast_dumps(times))
+                os.replace(tmp_filename, self.filename)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return key
+
+
+class ObservationCache(object):
+    """
+    In-process cache of observation query results.
+    Bounded by the total number of cached observation rows, entries also expire after a TTL,
+    at the next scheduled process_levels run, or when the site/level is invalidated.
+    Cached results are shared, callers must not modify them.
+    """
+    __slots__ = ("_cache", "invalidations")
+
+    def __init__(self, max_rows, ttl, invalidations):
+        self._cache = TTLCache(maxsize=max_rows, ttl=ttl, getsizeof=self._rows_in)
+        self.invalidations = invalidations
+
+    @staticmethod
+    def _rows_in(entry):
+        (_, resp) = entry
+        return max(1, resp.get('meta', {}).get('count', 0))
+
+    @staticmethod
+    def make_key(kind, site_no, params, *variant):
+        params = params or {}
+        return (kind, int(site_no), params.get('processing_level', 3), process_levels_generation(),
+                _freeze(params), _freeze(variant))
+
+    def get(self, key):
+        entry = self._cache.get(key, None)
+        if entry is None:
+            count_cache_lookup(key[0], False)
+            return None
+        (created, resp) = entry
+        if created <= self.invalidations.invalidated_at(key[1], key[2]):
+            self._cache.pop(key, None)
+            count_cache_lookup(key[0], False)
+            return None
+        count_cache_lookup(key[0], True)
+        return resp
+
+    def set(self, key, resp, created=None):
+        """
+        :param created: unix time the query started, defaults to now
+        """
+        if created is None:
+            created = time.time()
+        try:
+            self._cache[key] = (created, resp)
+        except ValueError:
+            pass  # bigger than the whole cache, don't keep it
+
+    def invalidate(self, site_no=None, processing_level=None):
+        """
+        Invalidates cached results in every worker, for one site, one processing level, both, or everything.
+        :return: the invalidation key
+        """
+        return self.invalidations.invalidate(site_no, processing_level)
+
+
+class ValidationCache(object):
+    """
+    Small in-process cache for credential lookups, with a shorter TTL for negative results,
+    so unknown keys don't hit the database on every request but become valid soon after they are created.
+    """
+    __slots__ = ("name", "_found", "_missing")
+
+    def __init__(self, maxsize, ttl, negative_ttl, name="validation"):
+        """
+        :param name: the cache label of the hit/miss metrics
+        """
+        self.name = name
+        self._found = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._missing = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+
+    def get(self, key):
+        """
+        :return: (hit, value), value is None for a cached negative result
+        """
+        value = self._found.get(key, None)
+        if value is not None:
+            count_cache_lookup(self.name, True)
+            return True, value
+        if key in self._missing:
+            count_cache_lookup(self.name, True)
+            return True, None
+        count_cache_lookup(self.name, False)
+        return False, None
+
+    def set(self, key, value):
+        if value is None:
+            self._found.pop(key, None)
+            self._missing[key] = True
+        else:
+            self._missing.pop(key, None)
+            self._found[key] = value
+
+    def invalidate(self, key):
+        self._found.pop(key, None)
+        self._missing.pop(key, None)
+
+
+cache_invalidations = CacheInvalidations(config.CACHE_INVALIDATION_FILE)
+observations_cache = ObservationCache(config.OBSERVATIONS_CACHE_MAX_ROWS,
+                                      config.OBSERVATIONS_CACHE_TTL,
+                                      cache_invalidations)
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+from orjson import loads as fast_loads
+from motor.motor_asyncio import AsyncIOMotorClient as MotorClient
+import config
+
+persistent_clients = {
+    'influx_executor': None,
+    'mongo_client': None
+}
+# InfluxDBClient wraps a requests.Session, which is not safe to share between
+# threads, so every thread in the influx executor gets its own client.
+influx_thread_local = threading.local()
+# every client made by the influx executor threads, so they can be closed with the executor
+_influx_clients = []
+
+def _make_mongo_client(loop):
+    return MotorClient(
+        config.MONGODB_HOST, config.MONGODB_PORT,
+        maxPoolSize=config.MONGODB_MAX_POOL_SIZE,
+        minPoolSize=config.MONGODB_MIN_POOL_SIZE,
+        io_loop=loop)
+
+def get_mongo_client():
+    if persistent_clients['mongo_client'] is None:
+        persistent_clients['mongo_client'] = _make_mongo_client(asyncio.get_event_loop())
+    return persistent_clients['mongo_client']
+
+def get_influx_client():
+    client = getattr(influx_thread_local, 'client', None)
+    if client is None:
+        client = influx_thread_local.client = InfluxDBClient(
+            config.INFLUXDB_HOST, config.INFLUXDB_PORT,
+            config.INFLUXDB_USERNAME, config.INFLUXDB_PASSWORD,
+            config.INFLUXDB_NAME, timeout=config.INFLUXDB_TIMEOUT)
+        _influx_clients.append(client)
+    return client
+
+def get_influx_executor():
+    """
+    The influxdb client is blocking, so all queries run on this pool.
+    Its size is the upper limit of concurrent influx queries per worker,
+    any extra queries wait in the pool queue without blocking the event loop.
+    :return: concurrent.futures.ThreadPoolExecutor
+    """
+    if persistent_clients['influx_executor'] is None:
+        persistent_clients['influx_executor'] = ThreadPoolExecutor(
+            max_workers=config.INFLUXDB_MAX_CONCURRENCY,
+            thread_name_prefix="influx")
+    return persistent_clients['influx_executor']
+
+async def open_clients(loop):
+    """
+    Creates this worker's Mongo client and Influx executor on its own event loop.
+    Runs in before_server_start, once in every worker process.
+    """
+    persistent_clients['mongo_client'] = _make_mongo_client(loop)
+    get_influx_executor()
+
+async def close_clients():
+    """
+    Closes this worker's clients and pools. Runs in after_server_stop.
+    """
+    mongo_client = persistent_clients['mongo_client']
+    persistent_clients['mongo_client'] = None
+    if mongo_client is not None:
+        mongo_client.close()
+    executor = persistent_clients['influx_executor']
+    persistent_clients['influx_executor'] = None
+    if executor is not None:
+        executor.shutdown(wait=True)
+    while _influx_clients:
+        _influx_clients.pop().close()
+
+def _query_influx_sync(sql, **kwargs):
+    influx_client = get_influx_client()
+    return influx_client.query(sql, **kwargs)
+
+async def query_influx(sql, **kwargs):
+    """
+    Awaitable replacement for InfluxDBClient.query()
+    :param sql: InfluxQL query string
+    :return: influxdb.resultset.ResultSet
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_influx_executor(), partial(_query_influx_sync, sql, **kwargs))
+
+def _iter_influx_chunks_sync(sql, chunk_size, epoch=None):
+    influx_client = get_influx_client()
+    params = {'q': sql, 'db': config.INFLUXDB_NAME,
+              'chunked': 'true', 'chunk_size': chunk_size}
+    if epoch is not None:
+        params['epoch'] = epoch
+    response = influx_client.request(url="query", method='GET', params=params,
+                                     stream=True, expected_response_code=200)
+    try:
+        # Influx sends one JSON document per line, each holding a partial series of at most chunk_size points
+        for line in response.iter_lines():
+            if not line:
+                continue
+            data = fast_loads(line)
+            for result in data.get('results', []):
+                if 'error' in result:
+                    raise InfluxDBClientError(result['error'])
+                for series in result.get('series', []):
+                    yield series['columns'], series.get('values', [])
+    finally:
+        response.close()
+
+_chunks_done = object()
+
+async def iter_influx_chunks(sql, chunk_size=None, epoch=None):
+    """
+    Runs a chunked influx query, yields (columns, values) for each chunk as it arrives.
+    Only one chunk is held in memory at a time.
+    :param sql: InfluxQL query string
+    :param chunk_size: maximum number of points in each chunk
+    :param epoch: return times as integers with this precision ("ns", "s", ...) instead of RFC3339 strings
+    """
+    if chunk_size is None:
+        chunk_size = config.INFLUXDB_CHUNK_SIZE
+    loop = asyncio.get_event_loop()
+    executor = get_influx_executor()
+    chunks = _iter_influx_chunks_sync(sql, chunk_size, epoch)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(executor, next, chunks, _chunks_done)
+            if chunk is _chunks_done:
+                break
+            yield chunk
+    finally:
+        await loop.run_in_executor(executor, chunks.close)
+
+# measurement -> (loaded_at, {field key: field type})
+_field_types = {}
+
+async def get_influx_field_types(measurement, max_age=60):
+    """
+    :return: dict of field name to influx field type ("float", "integer", "string" or "boolean")
+    """
+    now = time.time()
+    cached = _field_types.get(measurement, None)
+    if cached is not None and now - cached[0] < max_age:
+        return cached[1]
+    result = await query_influx('SHOW FIELD KEYS FROM "{:s}";'.format(measurement))
+    field_types = {p['fieldKey']: p['fieldType'] for p in result.get_points()}
+    _field_types[measurement] = (now, field_types)
+    return field_types
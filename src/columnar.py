@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Apache Arrow IPC stream and Parquet output, built column-wise from influx chunks.
+These are only offered when pyarrow is installed, with the "columnar" extra.
+"""
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ARROW_STREAM_MIMETYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MIMETYPE = "application/x-parquet"
+COLUMNAR_MIMETYPES = [ARROW_STREAM_MIMETYPE, PARQUET_MIMETYPE] if pyarrow is not None else []
+FORMAT_ALIASES = {
+    'arrow': ARROW_STREAM_MIMETYPE,
+    'parquet': PARQUET_MIMETYPE,
+}
+FILE_EXTENSIONS = {
+    ARROW_STREAM_MIMETYPE: "arrow",
+    PARQUET_MIMETYPE: "parquet",
+}
+TAG_COLUMNS = ("site_no",)
+
+
+def _arrow_type(column, field_types):
+    if column == "time":
+        return pyarrow.timestamp("ns", tz="UTC")
+    if column in TAG_COLUMNS:
+        return pyarrow.string()
+    field_type = field_types.get(column, None)
+    if field_type is None:
+        # An aggregate column, mean_x, min_x, max_x, count_x or mean, mean_1, ...
+        if column.startswith("count"):
+            return pyarrow.int64()
+        return pyarrow.float64()
+    return {
+        "float": pyarrow.float64(),
+        "integer": pyarrow.int64(),
+        "string": pyarrow.string(),
+        "boolean": pyarrow.bool_(),
+    }.get(field_type, pyarrow.string())
+
+
+def arrow_schema(columns, field_types):
+    return pyarrow.schema([pyarrow.field(c, _arrow_type(c, field_types)) for c in columns])
+
+
+def record_batch(schema, values):
+    """
+    Builds a RecordBatch straight from an influx values array, one column at a time.
+    :param values: list of rows, as sent by influx
+    """
+    if values:
+        column_values = list(zip(*values))
+    else:
+        column_values = [() for _ in schema]
+    arrays = [pyarrow.array(v, type=f.type) for v, f in zip(column_values, schema)]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class ChunkSink(object):
+    """
+    Write-only file object for the arrow writers, it holds what was written until it is taken.
+    """
+    __slots__ = ("_parts", "_position", "closed")
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+async def write_columnar_chunks(response, return_type, chunks, field_types):
+    """
+    Writes influx chunks to a streaming response as Arrow IPC stream record batches or Parquet row groups,
+    one batch or row group per chunk.
+    :param chunks: async iterator of (columns, values), with times in epoch nanoseconds
+    :param field_types: influx field types of the measurement, see clients.get_influx_field_types
+    """
+    sink = ChunkSink()
+    out = pyarrow.PythonFile(sink, mode='w')
+    writer = None
+    schema = None
+    try:
+        async for columns, values in chunks:
+            if writer is None:
+                schema = arrow_schema(columns, field_types)
+                if return_type == PARQUET_MIMETYPE:
+                    writer = pyarrow.parquet.ParquetWriter(out, schema)
+                else:
+                    writer = pyarrow.ipc.new_stream(out, schema)
+            batch = record_batch(schema, values)
+            if return_type == PARQUET_MIMETYPE:
+                writer.write_table(pyarrow.Table.from_batches([batch], schema=schema))
+            else:
+                writer.write_batch(batch)
+            data = sink.take()
+            if data:
+                await response.write(data)
+        if writer is None:
+            # No rows, still send a valid empty file
+            schema = arrow_schema(["time"], field_types)
+            if return_type == PARQUET_MIMETYPE:
+                writer = pyarrow.parquet.ParquetWriter(out, schema)
+            else:
+                writer = pyarrow.ipc.new_stream(out, schema)
+    finally:
+        if writer is not None:
+            writer.close()
+    data = sink.take()
+    if data:
+        await response.write(data)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Accept-Encoding negotiation and response compression, gzip always, br and zstd when their packages are installed,
+with the "compression" extra.
+"""
+import zlib
+from sanic.response import StreamingHTTPResponse
+
+import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = {"application/json", "application/javascript", "application/xml", "image/svg+xml"}
+
+
+class GzipEncoder(object):
+    __slots__ = ("_z",)
+
+    def __init__(self):
+        # wbits 31 is a gzip header and trailer around the deflate stream
+        self._z = zlib.compressobj(config.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder(object):
+    __slots__ = ("_c",)
+
+    def __init__(self):
+        self._c = brotli.Compressor(quality=config.COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+class ZstdEncoder(object):
+    __slots__ = ("_c",)
+
+    def __init__(self):
+        self._c = zstandard.ZstdCompressor(level=config.COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self._c.compress(data)
+
+    def flush(self):
+        return self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._c.flush()
+
+
+# In server preference order
+ENCODERS = [("gzip", GzipEncoder)]
+if brotli is not None:
+    ENCODERS.insert(0, ("br", BrotliEncoder))
+if zstandard is not None:
+    ENCODERS.insert(0, ("zstd", ZstdEncoder))
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Picks the content-coding to use for an Accept-Encoding header.
+    :param accept_encoding: Accept-Encoding header value
+    :return: (name, encoder class) or None for identity
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        parts = part.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        qweight = 1.0
+        for p in parts[1:]:
+            p = p.strip()
+            if p.startswith("q="):
+                try:
+                    qweight = float(p[2:])
+                except ValueError:
+                    qweight = 0.0
+        weights[coding] = qweight
+    best = None
+    best_weight = 0.0
+    for name, encoder in ENCODERS:
+        qweight = weights.get(name, weights.get("*", 0.0))
+        if qweight > best_weight:
+            best = (name, encoder)
+            best_weight = qweight
+    return best
+
+
+def is_compressible(content_type):
+    if not content_type:
+        return False
+    mimetype = content_type.split(';', 1)[0].strip().lower()
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+class CompressedStreamWriter(object):
+    """
+    Stands in for the StreamingHTTPResponse given to a streaming_fn, every chunk written is
+    compressed and flushed straight away, so the client receives it without waiting for the rest.
+    """
+    __slots__ = ("response", "encoder")
+
+    def __init__(self, response, encoder):
+        self.response = response
+        self.encoder = encoder
+
+    async def write(self, data):
+        if not data:
+            return
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        out = self.encoder.compress(data) + self.encoder.flush()
+        if out:
+            await self.response.write(out)
+
+    async def finish(self):
+        out = self.encoder.finish()
+        if out:
+            await self.response.write(out)
+
+
+def _add_vary(response):
+    vary = response.headers.get("Vary", None)
+    if not vary:
+        response.headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        response.headers["Vary"] = "{}, Accept-Encoding".format(vary)
+
+
+def compress_response(request, response):
+    """
+    Compresses a response in place when the client accepts it.
+    HTTPResponse bodies smaller than COMPRESSION_MIN_SIZE are left alone,
+    streaming responses are compressed chunk by chunk as they are written.
+    """
+    if not config.COMPRESSION_ENABLED or response is None or request.method == "HEAD":
+        return response
+    if response.status != 200 or "Content-Encoding" in response.headers:
+        return response
+    content_type = response.headers.get("Content-Type", None) or response.content_type
+    if not is_compressible(content_type):
+        return response
+    _add_vary(response)
+    negotiated = negotiate_encoding(request.headers.get("Accept-Encoding", None))
+    if negotiated is None:
+        return response
+    name, encoder_class = negotiated
+    if isinstance(response, StreamingHTTPResponse):
+        streaming_fn = response.streaming_fn
+
+        async def compressed_streaming_fn(r):
+            writer = CompressedStreamWriter(r, encoder_class())
+            await streaming_fn(writer)
+            await writer.finish()
+
+        response.streaming_fn = compressed_streaming_fn
+    else:
+        body = response.body
+        if body is None or len(body) < config.COMPRESSION_MIN_SIZE:
+            return response
+        encoder = encoder_class()
+        response.body = encoder.compress(body) + encoder.finish()
+        response.headers.pop("Content-Length", None)
+    response.headers["Content-Encoding"] = name
+    return response
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Conditional GET, ETag and Last-Modified validators that are checked without running the full query.
+"""
+import datetime
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from sanic.response import HTTPResponse
+
+from cache import cache_invalidations
+from latest import get_latest_snapshot
+from station_snapshot import get_station_snapshot
+
+
+def make_etag(*parts):
+    """
+    Weak ETag, responses with the same validator parts are equivalent, but not byte-identical once compressed.
+    """
+    h = hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16)
+    return 'W/"{}"'.format(h.hexdigest())
+
+
+def _opaque_tag(etag):
+    etag = etag.strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    return etag
+
+
+def not_modified_response(request, etag, last_modified=None):
+    """
+    Checks If-None-Match, or If-Modified-Since when there is no If-None-Match.
+    :return: a 304 response when the client's copy is current, otherwise None
+    """
+    if_none_match = request.headers.get("If-None-Match", None)
+    if if_none_match is not None:
+        tags = [_opaque_tag(t) for t in if_none_match.split(",")]
+        if "*" not in tags and _opaque_tag(etag) not in tags:
+            return None
+    else:
+        if_modified_since = request.headers.get("If-Modified-Since", None)
+        if last_modified is None or if_modified_since is None:
+            return None
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return None
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        if last_modified.replace(microsecond=0) > since:
+            return None
+    return HTTPResponse(None, status=304, headers=validator_headers(etag, last_modified))
+
+
+def validator_headers(etag, last_modified=None):
+    headers = {'ETag': etag}
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(last_modified.astimezone(datetime.timezone.utc), usegmt=True)
+    return headers
+
+
+def add_validator_headers(response, etag, last_modified=None):
+    for k, v in validator_headers(etag, last_modified).items():
+        response.headers[k] = v
+    return response
+
+
+async def stations_validators(request, return_type):
+    """
+    Validators for /stations and /stations/{id}, based on the version of the station snapshot they are served from.
+    :return: (etag, last_modified)
+    """
+    snapshot = await get_station_snapshot()
+    return make_etag("stations", request.path, request.query_string, return_type, snapshot.version), None
+
+
+async def last_observations_validators(request, site_no, processing_level, return_type):
+    """
+    Validators for /stations/{id}/lastobservations, based on the time of the latest point of this site and level,
+    from the in-memory latest observations snapshot, and on the last invalidation of the site and level.
+    :return: (etag, last_modified)
+    """
+    snapshot = await get_latest_snapshot(processing_level)
+    latest_time = snapshot.site_times.get(int(site_no), None)
+    invalidated_at = cache_invalidations.invalidated_at(site_no, processing_level)
+    etag = make_etag("lastobservations", request.path, request.query_string, return_type,
+                     snapshot.generation, latest_time, invalidated_at)
+    last_modified = None
+    if latest_time is not None:
+        try:
+            last_modified = datetime.datetime.strptime(latest_time[:19], "%Y-%m-%dT%H:%M:%S")\
+                .replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            last_modified = None
+    if invalidated_at:
+        invalidated = datetime.datetime.fromtimestamp(invalidated_at, tz=datetime.timezone.utc)
+        if last_modified is None or invalidated > last_modified:
+            last_modified = invalidated
+    return etag, last_modified
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 #
 import sys
+import tempfile
 from util import load_env
-from os import getenv
+from os import getenv, path, cpu_count
 load_env()
 module = sys.modules[__name__]
 TRUTHS = {True, 1, '1', 'T', 't', 'true', 'TRUE', 'True'}
@@ -16,8 +17,88 @@ INFLUXDB_PORT = CONFIG['INFLUXDB_PORT'] = int(getenv("INFLUX_DB_PORT", 8086))
 INFLUXDB_USERNAME = CONFIG['INFLUXDB_USERNAME'] = getenv("INFLUX_DB_USERNAME", None)
 INFLUXDB_PASSWORD = CONFIG['INFLUXDB_PASSWORD'] = getenv("INFLUX_DB_PASSWORD", None)
 INFLUXDB_NAME = CONFIG['INFLUXDB_NAME'] = getenv("INFLUX_DB_NAME", "cosmoz")
+INFLUXDB_TIMEOUT = CONFIG['INFLUXDB_TIMEOUT'] = int(getenv("INFLUX_DB_TIMEOUT", 30))
+INFLUXDB_MAX_CONCURRENCY = CONFIG['INFLUXDB_MAX_CONCURRENCY'] = int(getenv("INFLUX_DB_MAX_CONCURRENCY", 8))
+INFLUXDB_CHUNK_SIZE = CONFIG['INFLUXDB_CHUNK_SIZE'] = int(getenv("INFLUX_DB_CHUNK_SIZE", 5000))
 MONGODB_HOST = CONFIG['MONGODB_HOST'] = getenv("MONGO_DB_HOST", "cosmoz.mongodb")
 MONGODB_PORT = CONFIG['MONGODB_PORT'] = int(getenv("MONGO_DB_PORT", 27017))
 MONGODB_NAME = CONFIG['MONGODB_NAME'] = getenv("MONGO_DB_NAME", "cosmoz")
+MONGODB_MAX_POOL_SIZE = CONFIG['MONGODB_MAX_POOL_SIZE'] = int(getenv("MONGO_DB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = CONFIG['MONGODB_MIN_POOL_SIZE'] = int(getenv("MONGO_DB_MIN_POOL_SIZE", 0))
 METRICS_DIRECTORY = CONFIG['METRICS_DIRECTORY'] = getenv("METRICS_DIRECTORY", ".")
+ADMIN_API_KEY = CONFIG['ADMIN_API_KEY'] = getenv("ADMIN_API_KEY", None)
+PROCESS_LEVELS_SCHEDULE_HOURS = CONFIG['PROCESS_LEVELS_SCHEDULE_HOURS'] = sorted(
+    int(h) for h in getenv("PROCESS_LEVELS_SCHEDULE_HOURS", "2,14").split(",") if h.strip())
+OBSERVATIONS_CACHE_TTL = CONFIG['OBSERVATIONS_CACHE_TTL'] = int(getenv("OBSERVATIONS_CACHE_TTL", 3600))
+OBSERVATIONS_CACHE_MAX_ROWS = CONFIG['OBSERVATIONS_CACHE_MAX_ROWS'] = int(getenv("OBSERVATIONS_CACHE_MAX_ROWS", 200000))
+CACHE_INVALIDATION_FILE = CONFIG['CACHE_INVALIDATION_FILE'] = getenv(
+    "CACHE_INVALIDATION_FILE", path.join(tempfile.gettempdir(), "cosmoz_cache_invalidations.json"))
+# opt-in, building rollups writes to influx (needs a user with WRITE on INFLUX_DB_NAME) and to mongo, see README.rst
+ROLLUPS_ENABLED = CONFIG['ROLLUPS_ENABLED'] = getenv("ROLLUPS_ENABLED", 'false') in TRUTHS
+ROLLUPS_REFRESH_INTERVAL = CONFIG['ROLLUPS_REFRESH_INTERVAL'] = int(getenv("ROLLUPS_REFRESH_INTERVAL", 3600))
+ROLLUPS_REBUILD_LOOKBACK_DAYS = CONFIG['ROLLUPS_REBUILD_LOOKBACK_DAYS'] = int(getenv("ROLLUPS_REBUILD_LOOKBACK_DAYS", 2))
+ROLLUPS_BUILD_WINDOW_DAYS = CONFIG['ROLLUPS_BUILD_WINDOW_DAYS'] = int(getenv("ROLLUPS_BUILD_WINDOW_DAYS", 365))
+ROLLUPS_WATERMARK_TTL = CONFIG['ROLLUPS_WATERMARK_TTL'] = int(getenv("ROLLUPS_WATERMARK_TTL", 60))
+ROLLUPS_LOCK_FILE = CONFIG['ROLLUPS_LOCK_FILE'] = getenv(
+    "ROLLUPS_LOCK_FILE", path.join(tempfile.gettempdir(), "cosmoz_rollups.lock"))
+BULK_OBSERVATIONS_MAX_STATIONS = CONFIG['BULK_OBSERVATIONS_MAX_STATIONS'] = int(getenv("BULK_OBSERVATIONS_MAX_STATIONS", 100))
+BULK_OBSERVATIONS_CONCURRENCY = CONFIG['BULK_OBSERVATIONS_CONCURRENCY'] = int(
+    getenv("BULK_OBSERVATIONS_CONCURRENCY", INFLUXDB_MAX_CONCURRENCY))
+LATEST_OBSERVATIONS_REFRESH_INTERVAL = CONFIG['LATEST_OBSERVATIONS_REFRESH_INTERVAL'] = int(
+    getenv("LATEST_OBSERVATIONS_REFRESH_INTERVAL", 300))
+LATEST_OBSERVATIONS_MAX_AGE = CONFIG['LATEST_OBSERVATIONS_MAX_AGE'] = int(getenv("LATEST_OBSERVATIONS_MAX_AGE", 900))
+COMPRESSION_ENABLED = CONFIG['COMPRESSION_ENABLED'] = getenv("COMPRESSION_ENABLED", 'true') in TRUTHS
+COMPRESSION_MIN_SIZE = CONFIG['COMPRESSION_MIN_SIZE'] = int(getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = CONFIG['COMPRESSION_GZIP_LEVEL'] = int(getenv("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = CONFIG['COMPRESSION_BROTLI_QUALITY'] = int(getenv("COMPRESSION_BROTLI_QUALITY", 4))
+COMPRESSION_ZSTD_LEVEL = CONFIG['COMPRESSION_ZSTD_LEVEL'] = int(getenv("COMPRESSION_ZSTD_LEVEL", 3))
+STATIONS_VERSION_TTL = CONFIG['STATIONS_VERSION_TTL'] = int(getenv("STATIONS_VERSION_TTL", 30))
+APIKEY_CACHE_TTL = CONFIG['APIKEY_CACHE_TTL'] = int(getenv("APIKEY_CACHE_TTL", 300))
+APIKEY_NEGATIVE_CACHE_TTL = CONFIG['APIKEY_NEGATIVE_CACHE_TTL'] = int(getenv("APIKEY_NEGATIVE_CACHE_TTL", 10))
+APIKEY_CACHE_MAX_SIZE = CONFIG['APIKEY_CACHE_MAX_SIZE'] = int(getenv("APIKEY_CACHE_MAX_SIZE", 10000))
+OAUTH_VERIFY_CACHE_TTL = CONFIG['OAUTH_VERIFY_CACHE_TTL'] = int(getenv("OAUTH_VERIFY_CACHE_TTL", 300))
+OAUTH_VERIFY_NEGATIVE_CACHE_TTL = CONFIG['OAUTH_VERIFY_NEGATIVE_CACHE_TTL'] = int(getenv("OAUTH_VERIFY_NEGATIVE_CACHE_TTL", 30))
+OAUTH_VERIFY_CACHE_MAX_SIZE = CONFIG['OAUTH_VERIFY_CACHE_MAX_SIZE'] = int(getenv("OAUTH_VERIFY_CACHE_MAX_SIZE", 10000))
+OAUTH_VERIFY_TIMEOUT = CONFIG['OAUTH_VERIFY_TIMEOUT'] = float(getenv("OAUTH_VERIFY_TIMEOUT", 10))
+OAUTH_VERIFY_BACKOFF = CONFIG['OAUTH_VERIFY_BACKOFF'] = float(getenv("OAUTH_VERIFY_BACKOFF", 2))
+OAUTH_VERIFY_BACKOFF_MAX = CONFIG['OAUTH_VERIFY_BACKOFF_MAX'] = float(getenv("OAUTH_VERIFY_BACKOFF_MAX", 60))
+# OAuth login sessions, shared by every worker on the node
+SESSION_STORE_FILE = CONFIG['SESSION_STORE_FILE'] = getenv(
+    "SESSION_STORE_FILE", path.join("/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                    "cosmoz_sessions.sqlite"))
+RATE_LIMIT_ENABLED = CONFIG['RATE_LIMIT_ENABLED'] = getenv("RATE_LIMIT_ENABLED", 'true') in TRUTHS
+RATE_LIMIT_FILE = CONFIG['RATE_LIMIT_FILE'] = getenv(
+    "RATE_LIMIT_FILE", path.join("/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                 "cosmoz_ratelimit.sqlite"))
+RATE_LIMIT_RATE = CONFIG['RATE_LIMIT_RATE'] = float(getenv("RATE_LIMIT_RATE", 10))
+RATE_LIMIT_BURST = CONFIG['RATE_LIMIT_BURST'] = float(getenv("RATE_LIMIT_BURST", 200))
+RATE_LIMIT_COST_CHEAP = CONFIG['RATE_LIMIT_COST_CHEAP'] = int(getenv("RATE_LIMIT_COST_CHEAP", 1))
+RATE_LIMIT_COST_OBSERVATIONS = CONFIG['RATE_LIMIT_COST_OBSERVATIONS'] = int(getenv("RATE_LIMIT_COST_OBSERVATIONS", 5))
+RATE_LIMIT_COST_EXPORT = CONFIG['RATE_LIMIT_COST_EXPORT'] = int(getenv("RATE_LIMIT_COST_EXPORT", 20))
+LISTEN_HOST = CONFIG['LISTEN_HOST'] = getenv("REST_API_LISTEN_HOST", None)
+LISTEN_PORT = CONFIG['LISTEN_PORT'] = getenv("REST_API_INTERNAL_PORT", None)
+# number of server processes, "auto" for one per CPU
+_workers = getenv("REST_API_WORKERS", "1")
+WORKERS = CONFIG['WORKERS'] = (cpu_count() or 1) if _workers == "auto" else max(1, int(_workers))
+METRICS_ENABLED = CONFIG['METRICS_ENABLED'] = getenv("METRICS_ENABLED", 'true') in TRUTHS
+# each worker writes its metrics here, the /rest/metrics scrape adds them up
+METRICS_STATE_DIRECTORY = CONFIG['METRICS_STATE_DIRECTORY'] = getenv(
+    "METRICS_STATE_DIRECTORY", path.join("/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                         "cosmoz_metrics"))
+METRICS_FLUSH_INTERVAL = CONFIG['METRICS_FLUSH_INTERVAL'] = float(getenv("METRICS_FLUSH_INTERVAL", 10))
+ACCESS_LOG_ENABLED = CONFIG['ACCESS_LOG_ENABLED'] = getenv("ACCESS_LOG_ENABLED", 'true') in TRUTHS
+# records held in memory per worker, when it is full "drop_newest" or "drop_oldest" decides which record is lost
+ACCESS_LOG_BUFFER_SIZE = CONFIG['ACCESS_LOG_BUFFER_SIZE'] = int(getenv("ACCESS_LOG_BUFFER_SIZE", 10000))
+ACCESS_LOG_OVERFLOW = CONFIG['ACCESS_LOG_OVERFLOW'] = getenv("ACCESS_LOG_OVERFLOW", "drop_newest")
+ACCESS_LOG_FLUSH_INTERVAL = CONFIG['ACCESS_LOG_FLUSH_INTERVAL'] = float(getenv("ACCESS_LOG_FLUSH_INTERVAL", 1))
+# rotate a day's file when it grows past this size, 0 to only rotate by date
+ACCESS_LOG_MAX_BYTES = CONFIG['ACCESS_LOG_MAX_BYTES'] = int(getenv("ACCESS_LOG_MAX_BYTES", 100 * 1024 * 1024))
+ACCESS_LOG_COMPRESS = CONFIG['ACCESS_LOG_COMPRESS'] = getenv("ACCESS_LOG_COMPRESS", 'true') in TRUTHS
+SERVER_TIMING_ENABLED = CONFIG['SERVER_TIMING_ENABLED'] = getenv("SERVER_TIMING_ENABLED", 'true') in TRUTHS
+# admins can ask for a sampled profile of one request with the "X-Profile: true" header
+PROFILE_SAMPLE_INTERVAL = CONFIG['PROFILE_SAMPLE_INTERVAL'] = float(getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_DIRECTORY = CONFIG['PROFILE_DIRECTORY'] = getenv(
+    "PROFILE_DIRECTORY", path.join("/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                   "cosmoz_profiles"))
+PROFILE_MAX_KEPT = CONFIG['PROFILE_MAX_KEPT'] = int(getenv("PROFILE_MAX_KEPT", 50))
 DEBUG = CONFIG['DEBUG'] = getenv("SANIC_DEBUG", '') in TRUTHS
@@ -1,5 +1,10 @@
+import asyncio
+import os
+import sqlite3
+import time
+from collections import OrderedDict
 from os import path
-from pickle import Pickler, Unpickler
+from pickle import Pickler, Unpickler, UnpicklingError, dumps as pickle_dumps, loads as pickle_loads
 
 from sanic_session.base import BaseSessionInterface
 from sanic_session.utils import ExpiringDict
@@ -69,8 +74,105 @@ class FilesystemSessionInterface(BaseSessionInterface):
         self._fss_pickler(_cache)
 
 
+class SqliteSessionInterface(BaseSessionInterface):
+    """
+    Sessions in a SQLite database, one row per session, so reads and writes only touch that session.
+    WAL mode lets every worker read and write it concurrently, expired rows are removed by sweep_expired().
+    """
+    def __init__(
+        self,
+        domain: str = None,
+        expiry: int = 2592000,
+        httponly: bool = True,
+        cookie_name: str = "session",
+        prefix: str = "session:",
+        sessioncookie: bool = False,
+        samesite: str = None,
+        session_name="session",
+        secure: bool = False,
+        directory: str = None,
+        filename: str = None,
+        sweep_interval: int = 600
+    ):
+
+        super().__init__(
+            expiry=expiry,
+            prefix=prefix,
+            cookie_name=cookie_name,
+            domain=domain,
+            httponly=httponly,
+            sessioncookie=sessioncookie,
+            samesite=samesite,
+            session_name=session_name,
+            secure=secure,
+        )
+        if directory is None:
+            directory = path.curdir
+        if filename is None:
+            filename = "sessionstore.sqlite"
+        self._sss_filename = path.join(directory, filename)
+        self._sss_conn = None
+        self._sss_pid = None
+        self.sweep_interval = sweep_interval
+
+    def _sss_connection(self):
+        # opened on first use in each process, connections can't be shared with forked workers
+        if self._sss_conn is None or self._sss_pid != os.getpid():
+            conn = sqlite3.connect(self._sss_filename, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions "
+                         "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+            self._sss_conn = conn
+            self._sss_pid = os.getpid()
+        return self._sss_conn
+
+    async def _get_value(self, prefix, sid):
+        row = self._sss_connection().execute(
+            "SELECT value FROM sessions WHERE key = ? AND expires > ?", (self.prefix + sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return pickle_loads(row[0])
+
+    async def _delete_key(self, key):
+        self._sss_connection().execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    async def _set_value(self, key, data):
+        self._sss_connection().execute(
+            "INSERT OR REPLACE INTO sessions (key, value, expires) VALUES (?, ?, ?)",
+            (key, pickle_dumps(data, 4), time.time() + self.expiry))
+
+    def sweep_expired(self):
+        """
+        :return: number of expired sessions removed
+        """
+        cursor = self._sss_connection().execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),))
+        return cursor.rowcount
+
+    async def maintain(self):
+        """
+        Background task, removes expired sessions every sweep_interval seconds.
+        """
+        if not self.sweep_interval or self.sweep_interval <= 0:
+            return
+        while True:
+            try:
+                self.sweep_expired()
+            except sqlite3.Error as e:
+                print("Session sweep failed: {}".format(repr(e)))
+            await asyncio.sleep(self.sweep_interval)
+
+
 class FileSystemCache(object):
-    __slots__ = ("_fsc_filename", "_fsc_threshold")
+    """
+    Bounded LRU cache with attribute access, kept in an OrderedDict so get, set and evict are all O(1).
+    Persisted as a snapshot file plus an append-only log of sets and deletes. The log is folded into a new
+    snapshot once it has `threshold` records, so each write only appends one record.
+    Read recency is only saved with the next snapshot.
+    """
+    __slots__ = ("_fsc_filename", "_fsc_log_filename", "_fsc_threshold", "_fsc_cache", "_fsc_log",
+                 "_fsc_log_records")
 
     def __init__(self, directory, filename=None, threshold=1000):
         self._fsc_threshold = threshold
@@ -79,59 +181,97 @@ class FileSystemCache(object):
         if filename is None:
             filename = "sanic_oauth_cache.pickle"
         self._fsc_filename = path.join(directory, filename)
+        self._fsc_log_filename = self._fsc_filename + ".log"
+        self._fsc_cache = OrderedDict()
+        self._fsc_log = None
+        self._fsc_log_records = 0
+        self._fsc_load()
+
+    def _fsc_load(self):
         try:
-            _cache = self._fss_unpickler()
+            with open(self._fsc_filename, 'rb') as f:
+                self._fsc_cache = OrderedDict(Unpickler(f).load())
         except FileNotFoundError:
-            _cache = dict()
-            _cache['_fsc_key_list'] = list()
-            self._fss_pickler(_cache)
+            pass
+        replayed = 0
+        try:
+            with open(self._fsc_log_filename, 'rb') as f:
+                u = Unpickler(f)
+                while True:
+                    try:
+                        (op, key, value) = u.load()
+                    except (EOFError, UnpicklingError):
+                        # the end of the log, or a record cut short by a crash
+                        break
+                    if op == "set":
+                        self._fsc_cache[key] = value
+                        self._fsc_cache.move_to_end(key)
+                    else:
+                        self._fsc_cache.pop(key, None)
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        self._adj_threshold()
+        if replayed or not path.exists(self._fsc_filename):
+            self._fsc_snapshot()
 
-    def _fsc_pickler(self, obj):
-        with open(self._fsc_filename, 'wb') as f:
-            p = Pickler(f, 4)
-            p.dump(obj)
+    def _fsc_snapshot(self):
+        """
+        Writes the whole cache to a new snapshot and starts an empty log.
+        """
+        if self._fsc_log is not None:
+            self._fsc_log.close()
+            self._fsc_log = None
+        tmp_filename = "{}.{}".format(self._fsc_filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            Pickler(f, 4).dump(list(self._fsc_cache.items()))
+        os.replace(tmp_filename, self._fsc_filename)
+        self._fsc_log = open(self._fsc_log_filename, 'wb')
+        self._fsc_log_records = 0
 
-    def _fsc_unpickler(self):
-        with open(self._fsc_filename, 'rb') as f:
-            p = Unpickler(f)
-            return p.load()
+    def _fsc_append(self, op, key, value=None):
+        if self._fsc_log is None:
+            self._fsc_log = open(self._fsc_log_filename, 'ab')
+        self._fsc_log.write(pickle_dumps((op, key, value), 4))
+        self._fsc_log.flush()
+        self._fsc_log_records += 1
+        if self._fsc_log_records >= self._fsc_threshold:
+            self._fsc_snapshot()
 
     def __getattr__(self, key):
+        # only called for names that are not set slots
+        if key.startswith("_fsc_"):
+            raise AttributeError(key)
         try:
-            return object.__getattribute__(self, key)
-        except AttributeError:
-            _cache = self._fsc_unpickler()
-            _fsc_key_list = _cache.get('_fsc_key_list')
-            try:
-                obj = self._cache[key]
-                if _fsc_key_list.index(key) < len(_fsc_key_list) - 1:
-                    _fsc_key_list.remove(key)
-                    _fsc_key_list.append(key)
-                    _cache['_fsc_key_list'] = _fsc_key_list
-                    self._fsc_pickler(_cache)
-                return obj
-            except KeyError:
-                raise AttributeError(key)
+            self._fsc_cache.move_to_end(key)
+        except KeyError:
+            raise AttributeError(key)
+        return self._fsc_cache[key]
 
     def __setattr__(self, key, value):
-        try:
+        if key in FileSystemCache.__slots__:
             object.__setattr__(self, key, value)
-        except (AttributeError, ValueError):
-            _cache = self._fsc_unpickler()
-            _fsc_key_list = _cache.get('_fsc_key_list')
-            try:
-                _fsc_key_list.remove(key)
-            except ValueError:
-                pass
-            _cache[key] = value
-            _fsc_key_list.append(key)
-            self._adj_threshold(_cache)
-            self._fsc_pickler(_cache)
-        return
-
-    def _adj_threshold(self, _cache):
-        _fsc_key_list = _cache.get('_fsc_key_list')
-        while len(_fsc_key_list) > self._fsc_threshold:
-            first_key = _fsc_key_list.pop(0)
-            _cache.__delitem__(first_key)
-        _cache['_fsc_key_list'] = _fsc_key_list
+            return
+        self._fsc_cache[key] = value
+        self._fsc_cache.move_to_end(key)
+        self._fsc_append("set", key, value)
+        self._adj_threshold()
+
+    def __delattr__(self, key):
+        try:
+            del self._fsc_cache[key]
+        except KeyError:
+            raise AttributeError(key)
+        self._fsc_append("del", key)
+
+    def __contains__(self, key):
+        return key in self._fsc_cache
+
+    def __len__(self):
+        return len(self._fsc_cache)
+
+    def _adj_threshold(self):
+        while len(self._fsc_cache) > self._fsc_threshold:
+            first_key, _ = self._fsc_cache.popitem(last=False)
+            if self._fsc_log is not None:
+                self._fsc_append("del", first_key)
@@ -1,32 +1,19 @@
 import asyncio
 import datetime
+import time
 from collections import OrderedDict
+from itertools import chain
 
-import bson
-from influxdb import InfluxDBClient
-from motor.motor_asyncio import AsyncIOMotorClient as MotorClient
 import config
-from util import datetime_to_iso, datetime_from_iso, datetime_to_date_string
-
-persistent_clients = {
-    'influx_client': None,
-    'mongo_client': None
-}
-
-def get_mongo_client():
-    if persistent_clients['mongo_client'] is None:
-        persistent_clients['mongo_client'] = MotorClient(
-            config.MONGODB_HOST, config.MONGODB_PORT,
-            io_loop=asyncio.get_event_loop())
-    return persistent_clients['mongo_client']
-
-def get_influx_client():
-    if persistent_clients['influx_client'] is None:
-        persistent_clients['influx_client'] = InfluxDBClient(
-            config.INFLUXDB_HOST, config.INFLUXDB_PORT,
-            config.INFLUXDB_USERNAME, config.INFLUXDB_PASSWORD,
-            config.INFLUXDB_NAME, timeout=30)
-    return persistent_clients['influx_client']
+from cache import observations_cache
+from clients import get_mongo_client, query_influx, iter_influx_chunks, get_influx_field_types
+from bson_codecs import codec_options_for
+from metrics_registry import observe_query
+from rollups import plan_rollup_query, align_values
+from station_snapshot import get_station_snapshot, project_station
+from timing import NO_TIMINGS
+from util import datetime_to_iso, datetime_from_iso, datetime_to_date_string, parse_influx_duration, encode_cursor, \
+    influx_measurement_for_level
 
 obsv_variable_to_column_map = {
     'timestamp': 'Timestamp',
@@ -79,63 +66,22 @@ station_variable_to_column_map = {
 station_column_to_variable_map = { v: k for k,v in station_variable_to_column_map.items() }
 
 async def get_station_mongo(station_number, params, json_safe=True, jinja_safe=False):
-    mongo_client = get_mongo_client()
     station_number = int(station_number)
     params = params or {}
     property_filter = params.get('property_filter', [])
-    if property_filter and len(property_filter) > 0:
-        if '*' in property_filter:
-            select_filter = None
-        else:
-            select_filter = OrderedDict({v: True for v in property_filter})
-            if "site_no" not in select_filter:
-                select_filter['site_no'] = True
-            select_filter.move_to_end('site_no', last=False)
-            if "_id" not in select_filter:
-                select_filter['_id'] = False
-            select_filter.move_to_end('_id', last=False)
-    else:
-        select_filter = None
-    db = getattr(mongo_client, config.MONGODB_NAME)
-    all_stations_collection = db.all_stations
-    s = await mongo_client.start_session()
-    try:
-        count = await all_stations_collection.count_documents({})
-        row = await all_stations_collection.find_one({'site_no': station_number}, projection=select_filter, session=s)
-    finally:
-        await s.end_session()
-    if row is None or len(row) < 1:
+    snapshot = await get_station_snapshot()
+    station = snapshot.find(station_number, json_safe, jinja_safe)
+    if station is None:
         raise LookupError("Cannot find site.")
-    resp = row
-    #resp = { station_column_to_variable_map[c]: v for c,v in row.items() if c in station_column_to_variable_map.keys() }
-    if select_filter is None or select_filter.get('_id', False) is False:
-        if '_id' in resp:
-            del resp['_id']
-    if jinja_safe and 'status' in resp:
-        resp['_status'] = resp['status']
-        del resp['status']
-    for r, v in resp.items():
-        if isinstance(v, datetime.datetime):
-            if (json_safe and json_safe != "orjson") or jinja_safe:  # orjson can handle native datetimes
-                v = datetime_to_iso(v)
-            resp[r] = v
-        elif isinstance(v, bson.decimal128.Decimal128):
-            g = v.to_decimal()
-            if json_safe and g.is_nan():
-                g = 'NaN'
-            elif json_safe == "orjson":  # orjson can't do decimal
-                g = float(g)  # converting to float is fine because Javascript numbers are native double-float anyway.
-            resp[r] = g
-    if json_safe and 'id' not in resp and 'site_no' in resp:
-        resp['id'] = resp['site_no']
     resp = {
-        'meta': {'total': count, },
-        'station': resp,
+        'meta': {'total': len(snapshot), },
+        'station': project_station(station, property_filter),
     }
     return resp
 
 
-async def get_station_calibration_mongo(station_number, params, json_safe=True, jinja_safe=False):
+async def get_station_calibration_mongo(station_number, params, json_safe=True, jinja_safe=False,
+                                        timings=NO_TIMINGS):
     mongo_client = get_mongo_client()
     station_number = int(station_number)
     params = params or {}
@@ -156,8 +102,10 @@ async def get_station_calibration_mongo(station_number, params, json_safe=True,
     if select_filter is None:
         select_filter = {'_id': False}
     db = getattr(mongo_client, config.MONGODB_NAME)
-    stations_calibration_collection = db.stations_calibration
+    stations_calibration_collection = db.stations_calibration.with_options(
+        codec_options=codec_options_for(json_safe, jinja_safe))
     s = await mongo_client.start_session()
+    started = time.perf_counter()
     try:
         total = await stations_calibration_collection.count_documents({'site_no': station_number})
         cursor = stations_calibration_collection.find({'site_no': station_number}, projection=select_filter)
@@ -171,21 +119,11 @@ async def get_station_calibration_mongo(station_number, params, json_safe=True,
         while (await cursor.fetch_next):
             resp = cursor.next_object()
             if "_id" in resp:
-                del resp['id']
-            for r, v in resp.items():
-                if isinstance(v, datetime.datetime):
-                    if (json_safe and json_safe != "orjson") or jinja_safe: # orjson can handle native datetimes
-                        v = datetime_to_iso(v)
-                    resp[r] = v
-                elif isinstance(v, bson.decimal128.Decimal128):
-                    g = v.to_decimal()
-                    if json_safe and g.is_nan():
-                        g = 'NaN'
-                    elif json_safe == "orjson":  # orjson can't do decimal
-                        g = float(g)  # converting to float is fine because Javascript numbers are native double-float anyway.
-                    resp[r] = g
-
+                del resp['_id']
             responses.append(resp)
+        elapsed = time.perf_counter() - started
+        timings.add("mongo", elapsed)
+        observe_query("mongo", "calibration", elapsed, len(responses))
     finally:
         await s.end_session()
     count = len(responses)
@@ -201,75 +139,30 @@ async def get_station_calibration_mongo(station_number, params, json_safe=True,
 
 
 async def get_stations_mongo(params, json_safe=True, jinja_safe=False):
-    mongo_client = get_mongo_client()
     params = params or {}
     property_filter = params.get('property_filter', [])
     count = params.get('count', 1000)
     offset = params.get('offset', 0)
-    if property_filter and len(property_filter) > 0:
-        if '*' in property_filter:
-            select_filter = None
-        else:
-            select_filter = OrderedDict({v: True for v in property_filter})
-            if "site_no" not in select_filter:
-                select_filter['site_no'] = True
-            select_filter.move_to_end('site_no', last=False)
-            if "_id" not in select_filter:
-                select_filter['_id'] = False
-            select_filter.move_to_end('_id', last=False)
-    else:
-        select_filter = None
-
-    db = getattr(mongo_client, config.MONGODB_NAME)
-    all_stations_collection = db.all_stations
-    s = await mongo_client.start_session()
-    try:
-        total_stations = await all_stations_collection.count_documents({})
-        all_stations_cur = all_stations_collection.find({}, projection=select_filter, skip=offset, limit=count, session=s)
-        if all_stations_cur is None:
-            raise LookupError("Cannot find any sites.")
-        count = 0
-        stations = []
-        while (await all_stations_cur.fetch_next):
-            station = all_stations_cur.next_object()
-            #station = { station_column_to_variable_map[c]: v
-            #            for c,v in _row.items() if c in station_column_to_variable_map.keys() }
-            if jinja_safe and 'status' in station:
-                station['_status'] = station['status']
-                del station['status']
-            for r, v in station.items():
-                if isinstance(v, datetime.datetime):
-                    if (json_safe and json_safe != "orjson") or jinja_safe: #orjson can handle native datetimes
-                        v = datetime_to_iso(v)
-                    station[r] = v
-                elif isinstance(v, bson.decimal128.Decimal128):
-                    g = v.to_decimal()
-                    if json_safe and g.is_nan():
-                        g = 'NaN'
-                    elif json_safe == "orjson":  # orjson can't do decimal
-                        g = float(g)  # converting to float is fine because Javascript numbers are native double-float anyway.
-                    station[r] = g
-            if select_filter is None or select_filter.get('_id', False) is False:
-                if '_id' in station:
-                    del station['_id']
-            if json_safe and 'id' not in station and 'site_no' in station:
-                station['id'] = station['site_no']
-            stations.append(station)
-            count += 1
-    finally:
-        await s.end_session()
+    snapshot = await get_station_snapshot()
+    stations = [project_station(station, property_filter)
+                for station in snapshot.page(offset, count, json_safe, jinja_safe)]
     resp = {
         'meta': {
-            'total': total_stations,
-            'count': count,
+            'total': len(snapshot),
+            'count': len(stations),
             'offset': offset,
         },
         'stations': stations,
     }
     return resp
 
-def get_last_observations_influx(site_number, params, json_safe=True, excel_safe=False):
-    influx_client = get_influx_client()
+def excel_safe_time(observation):
+    if 'time' in observation:
+        # hack to very quickly convert iso 8601 to yyyy-MM-dd hh:mm:ss for excel
+        observation['time'] = observation['time'].replace('T', ' ')[:19]
+    return observation
+
+def build_last_observations_query(site_number, params):
     site_number = int(site_number)
     params = params or {}
     processing_level = params.get('processing_level', 3)
@@ -277,18 +170,14 @@ def get_last_observations_influx(site_number, params, json_safe=True, excel_safe
     count = params.get('count', 1)
 
     assert 0 <= processing_level <= 4, "Only levels 0, 1, 2, 3, 4 are acceptable."
-    if processing_level < 1:
-        db_measurement = "raw_values"
-    else:
-        db_measurement = "level{:d}".format(processing_level)
+    db_measurement = influx_measurement_for_level(processing_level)
 
-    all_rows = None
     get_all = "*"
     if property_filter and len(property_filter) > 0:
         if '*' in property_filter:
             select_string = get_all
         else:
-            select_cols = property_filter
+            select_cols = list(property_filter)
             if "time" not in select_cols:
                 select_cols.insert(0, "time")
             select_string = ",".join(select_cols)
@@ -296,36 +185,13 @@ def get_last_observations_influx(site_number, params, json_safe=True, excel_safe
         select_string = get_all
     sql = 'SELECT {:s} FROM "{:s}" WHERE "site_no"=\'{:d}\' ORDER BY "time" DESC LIMIT {:d};' \
           .format(select_string, db_measurement, site_number, count)
-    result = influx_client.query(sql)
-    points = result.get_points()
-    count = 0
-    observations = []
-    for _row in points:
-        observation = _row
-        if 'time' in observation and excel_safe:
-            # hack to very quickly convert iso 8601 to yyyy-MM-dd hh:mm:ss for excel
-            dt = observation['time'].replace('T', ' ')[:19]
-            observation['time'] = dt
-        #observation = {obsv_column_to_variable_map[c]: v
-        #               for c, v in _row.items() if c in obsv_column_to_variable_map.keys()}
-        #if 'time' in observation:
-        #    observation['time'] = datetime_to_iso(observation['timestamp'])
-        observations.append(observation)
-        count = count+1
-    resp = {
-        'meta': {
+    query = {
         'site_no': site_number,
         'processing_level': processing_level,
-        'count': count,
-        #'start_date': datetime_to_iso(startdate) if startdate else '',
-        #'end_date': datetime_to_iso(enddate) if enddate else '',
-        },
-        'observations': observations,
     }
-    return resp
+    return sql, query
 
-def get_observations_influx(site_number, params, json_safe=True, excel_safe=False):
-    influx_client = get_influx_client()
+def build_observations_query(site_number, params):
     site_number = int(site_number)
     params = params or {}
     processing_level = params.get('processing_level', 3)
@@ -341,14 +207,12 @@ def get_observations_influx(site_number, params, json_safe=True, excel_safe=Fals
         startdate = datetime_from_iso(startdate)
     if enddate is not None and isinstance(enddate, str):
         enddate = datetime_from_iso(enddate)
+    # cursor is a decoded (op, time_string) pair, see util.decode_cursor
+    cursor = params.get('cursor', None)
 
     assert 0 <= processing_level <= 4, "Only levels 0, 1, 2, 3 or 4 are acceptable."
-    if processing_level < 1:
-        db_measurement = "raw_values"
-    else:
-        db_measurement = "level{:d}".format(processing_level)
+    db_measurement = influx_measurement_for_level(processing_level)
 
-    all_rows = None
     if startdate is None:
         since_query = ""
     else:
@@ -371,6 +235,11 @@ def get_observations_influx(site_number, params, json_safe=True, excel_safe=Fals
             raise RuntimeError()
         before_query = " AND time <= \'{:s}\' ".format(end_datetime_string)
 
+    if cursor is not None:
+        # Keyset pagination, the page starts right after the previous one, so influx doesn't scan skipped points.
+        op, cursor_time = cursor
+        since_query = "{:s} AND time {:s} \'{:s}\' ".format(since_query, ">" if op == "gt" else ">=", cursor_time)
+
     if aggregate:
         get_all = "MEAN(*),MIN(*),MAX(*),COUNT(*)"
     else:
@@ -382,7 +251,7 @@ def get_observations_influx(site_number, params, json_safe=True, excel_safe=Fals
             if aggregate:
                 select_cols = ["MEAN({v:s}),MIN({v:s}),MAX({v:s}),COUNT({v:s})".format(v=v) for v in property_filter]
             else:
-                select_cols = property_filter
+                select_cols = list(property_filter)
             if "time" not in select_cols:
                 select_cols.insert(0, "time")
             select_string = ",".join(select_cols)
@@ -394,33 +263,148 @@ def get_observations_influx(site_number, params, json_safe=True, excel_safe=Fals
     else:
         sql = 'SELECT {:s} FROM "{:s}" WHERE "site_no"=\'{:d}\'{:s}{:s}ORDER BY "time" ASC LIMIT {:d} OFFSET {:d}; ' \
               .format(select_string, db_measurement, site_number, since_query, before_query, count, offset)
-    result = influx_client.query(sql)
-    points = result.get_points()
+    query = {
+        'site_no': site_number,
+        'processing_level': processing_level,
+        'count': count,
+        'offset': offset,
+        'aggregate': aggregate,
+        'startdate': startdate,
+        'enddate': enddate,
+        'cursor': cursor,
+        'property_filter': property_filter,
+        'time_filter': since_query + before_query,
+        'since_filter': since_query,
+        'before_filter': before_query,
+        'select_string': select_string,
+    }
+    return sql, query
+
+async def get_last_observations_influx(site_number, params, json_safe=True, excel_safe=False, timings=NO_TIMINGS):
+    looked_up = time.perf_counter()
+    key = observations_cache.make_key("last_observations", site_number, params, json_safe, excel_safe)
+    resp = observations_cache.get(key)
+    timings.add("cache", time.perf_counter() - looked_up, "miss" if resp is None else "hit")
+    if resp is None:
+        started = time.time()
+        resp = await query_last_observations_influx(site_number, params, json_safe, excel_safe, timings=timings)
+        observations_cache.set(key, resp, started)
+    return resp
+
+async def query_last_observations_influx(site_number, params, json_safe=True, excel_safe=False, timings=NO_TIMINGS):
+    sql, query = build_last_observations_query(site_number, params)
+    started = time.perf_counter()
+    result = await query_influx(sql)
+    elapsed = time.perf_counter() - started
+    timings.add("influx", elapsed)
+    if (params or {}).get('layout', None) == "columns":
+        columns, values = influx_result_values(result)
+        observations = observation_columns(columns, values)
+        count = len(values)
+        points = ()
+    else:
+        points = result.get_points()
+        count = 0
+        observations = []
+    for _row in points:
+        observation = _row
+        if excel_safe:
+            excel_safe_time(observation)
+        #observation = {obsv_column_to_variable_map[c]: v
+        #               for c, v in _row.items() if c in obsv_column_to_variable_map.keys()}
+        #if 'time' in observation:
+        #    observation['time'] = datetime_to_iso(observation['timestamp'])
+        observations.append(observation)
+        count = count+1
+    timings.add("process", time.perf_counter() - started - elapsed)
+    observe_query("influx", "last_observations", elapsed, count)
+    resp = {
+        'meta': {
+        'site_no': query['site_no'],
+        'processing_level': query['processing_level'],
+        'count': count,
+        #'start_date': datetime_to_iso(startdate) if startdate else '',
+        #'end_date': datetime_to_iso(enddate) if enddate else '',
+        },
+        'observations': observations,
+    }
+    return resp
+
+async def get_observations_influx(site_number, params, json_safe=True, excel_safe=False, timings=NO_TIMINGS):
+    looked_up = time.perf_counter()
+    key = observations_cache.make_key("observations", site_number, params, json_safe, excel_safe)
+    resp = observations_cache.get(key)
+    timings.add("cache", time.perf_counter() - looked_up, "miss" if resp is None else "hit")
+    if resp is None:
+        started = time.time()
+        resp = await query_observations_influx(site_number, params, json_safe, excel_safe, timings=timings)
+        observations_cache.set(key, resp, started)
+    return resp
+
+async def query_observations_influx(site_number, params, json_safe=True, excel_safe=False, timings=NO_TIMINGS):
+    sql, query = build_observations_query(site_number, params)
+    rollup_plan = await plan_rollup_query(query)
+    if rollup_plan is not None:
+        sql = rollup_plan.sql
+    started = time.perf_counter()
+    result = await query_influx(sql)
+    tail_result = None
+    if rollup_plan is not None and rollup_plan.tail_sql is not None:
+        tail_result = await query_influx(rollup_plan.tail_sql)
+    elapsed = time.perf_counter() - started
+    timings.add("influx", elapsed)
     count = 0
     observations = []
+    last_time = None
+    if (params or {}).get('layout', None) == "columns":
+        columns, values = influx_result_values(result)
+        if tail_result is not None:
+            tail_columns, tail_values = influx_result_values(tail_result)
+            if columns:
+                values.extend(align_values(columns, tail_columns, tail_values))
+            else:
+                columns, values = tail_columns, tail_values
+        if rollup_plan is not None:
+            rollup_plan.fix_values(columns, values)
+        observations = observation_columns(columns, values)
+        count = len(values)
+        if values and 'time' in columns:
+            last_time = values[-1][columns.index('time')]
+        points = ()
+    elif tail_result is not None:
+        points = chain(result.get_points(), tail_result.get_points())
+    else:
+        points = result.get_points()
     for _row in points:
         observation = _row
-        if 'time' in observation and excel_safe:
-            # hack to very quickly convert iso 8601 to yyyy-MM-dd hh:mm:ss for excel
-            dt = observation['time'].replace('T', ' ')[:19]
-            observation['time'] = dt
+        if rollup_plan is not None:
+            rollup_plan.fix_row(observation)
+        last_time = observation.get('time', None)
+        if excel_safe:
+            excel_safe_time(observation)
         #observation = {obsv_column_to_variable_map[c]: v
         #               for c, v in _row.items() if c in obsv_column_to_variable_map.keys()}
         #if 'time' in observation:
         #    observation['time'] = datetime_to_iso(observation['timestamp'])
         observations.append(observation)
         count = count+1
+    timings.add("process", time.perf_counter() - started - elapsed)
+    observe_query("influx", "observations", elapsed, count)
+    startdate = query['startdate']
+    enddate = query['enddate']
     if json_safe and json_safe != 'orjson':
         startdate = datetime_to_iso(startdate) if startdate else ''
         enddate = datetime_to_iso(enddate) if enddate else '',
+    aggregate = query['aggregate']
     resp = {
         'meta': {
-        'site_no': site_number,
-        'processing_level': processing_level,
+        'site_no': query['site_no'],
+        'processing_level': query['processing_level'],
         'count': count,
-        'offset': offset,
+        'offset': query['offset'],
         'start_date': startdate,
-        'end_date': enddate
+        'end_date': enddate,
+        'next_cursor': next_observations_cursor(last_time, aggregate) if count >= query['count'] else None,
         },
         'observations': observations,
     }
@@ -428,4 +412,147 @@ def get_observations_influx(site_number, params, json_safe=True, excel_safe=Fals
         resp['meta']['aggregation'] = str(aggregate)
     return resp
 
+async def get_bulk_observations_influx(site_numbers, params, json_safe=True, excel_safe=False):
+    """
+    Runs get_observations_influx for several stations concurrently, at most
+    BULK_OBSERVATIONS_CONCURRENCY at a time, each one still uses the results cache and rollups.
+    :param site_numbers: list of station numbers
+    :return: response with the observations response of each station, keyed by station number
+    """
+    semaphore = asyncio.Semaphore(config.BULK_OBSERVATIONS_CONCURRENCY)
+
+    async def _one_station(site_number):
+        async with semaphore:
+            return await get_observations_influx(site_number, params, json_safe, excel_safe)
+
+    site_numbers = [int(s) for s in site_numbers]
+    results = await asyncio.gather(*[_one_station(s) for s in site_numbers])
+    stations = OrderedDict((str(s), r) for s, r in zip(site_numbers, results))
+    resp = {
+        'meta': {
+        'site_nos': site_numbers,
+        'processing_level': params.get('processing_level', 3),
+        'count': sum(r['meta']['count'] for r in results),
+        },
+        'stations': stations,
+    }
+    return resp
+
+def influx_result_values(result):
+    """
+    :param result: influx ResultSet of a single series query
+    :return: (columns, values) straight from the influx response
+    """
+    columns = []
+    values = []
+    for series in result.raw.get('series', []):
+        columns = series.get('columns', columns)
+        values.extend(series.get('values', []))
+    return columns, values
+
+def observation_columns(columns, values):
+    """
+    Builds the columns layout, {column: [value, ...]}, by transposing the influx values,
+    without building a dict for each row.
+    """
+    if not values:
+        return {c: [] for c in columns}
+    return {c: list(v) for c, v in zip(columns, zip(*values))}
+
+def next_observations_cursor(last_time, aggregate=None):
+    """
+    Builds the cursor for the page after the one ending at last_time.
+    :param last_time: influx time string of the last row on this page
+    :param aggregate: aggregation interval, the last row is then the start of a bucket
+    :return: str
+    """
+    if last_time is None:
+        return None
+    if not aggregate:
+        return encode_cursor("gt", last_time)
+    next_bucket = datetime_from_iso(last_time) + parse_influx_duration(aggregate)
+    return encode_cursor("ge", datetime_to_iso(next_bucket))
+
+async def _iter_planned_chunks(sql, rollup_plan, epoch):
+    """
+    Chunks of the query, then of the rollup plan's live tail, in the columns of the first.
+    """
+    first_columns = None
+    async for columns, values in iter_influx_chunks(sql, epoch=epoch):
+        first_columns = columns
+        yield columns, values
+    if rollup_plan is None or rollup_plan.tail_sql is None:
+        return
+    async for columns, values in iter_influx_chunks(rollup_plan.tail_sql, epoch=epoch):
+        if first_columns is not None:
+            values = align_values(first_columns, columns, values)
+            columns = first_columns
+        yield columns, values
+
+async def _stream_observation_values(sql, operation, excel_safe=False, rollup_plan=None, epoch=None,
+                                     timings=NO_TIMINGS):
+    # only the time spent waiting on influx counts, not the time the consumer takes with each chunk
+    waited = 0.0
+    rows = 0
+    resumed = time.perf_counter()
+    try:
+        async for columns, values in _iter_planned_chunks(sql, rollup_plan, epoch):
+            received = time.perf_counter()
+            waited += received - resumed
+            rows += len(values)
+            if rollup_plan is not None:
+                rollup_plan.fix_values(columns, values)
+            if excel_safe and 'time' in columns:
+                # same as excel_safe_time, on the time column
+                t = columns.index('time')
+                for v in values:
+                    v[t] = v[t].replace('T', ' ')[:19]
+            timings.add("process", time.perf_counter() - received)
+            yield columns, values
+            resumed = time.perf_counter()
+    finally:
+        timings.add("influx", waited)
+        observe_query("influx", operation, waited, rows)
+
+def stream_last_observations_influx(site_number, params, excel_safe=False, timings=NO_TIMINGS):
+    """
+    Like get_last_observations_influx, but yields the raw influx (columns, values) chunks
+    of up to INFLUX_DB_CHUNK_SIZE rows, without building a dict for each row.
+    """
+    sql, _ = build_last_observations_query(site_number, params)
+    return _stream_observation_values(sql, "stream_last_observations", excel_safe, timings=timings)
+
+async def stream_observations_influx(site_number, params, excel_safe=False, timings=NO_TIMINGS):
+    """
+    Like get_observations_influx, but yields the raw influx (columns, values) chunks
+    of up to INFLUX_DB_CHUNK_SIZE rows, without building a dict for each row.
+    """
+    sql, query = build_observations_query(site_number, params)
+    rollup_plan = await plan_rollup_query(query)
+    if rollup_plan is not None:
+        sql = rollup_plan.sql
+    async for columns, values in _stream_observation_values(sql, "stream_observations", excel_safe, rollup_plan,
+                                                            timings=timings):
+        yield columns, values
+
+async def stream_last_observation_columns_influx(site_number, params, timings=NO_TIMINGS):
+    """
+    Like stream_last_observations_influx, but with times as epoch nanoseconds, for the columnar output formats.
+    :return: (field_types, chunks)
+    """
+    sql, query = build_last_observations_query(site_number, params)
+    field_types = await get_influx_field_types(influx_measurement_for_level(query['processing_level']))
+    return field_types, _stream_observation_values(sql, "stream_last_observations", epoch="ns", timings=timings)
 
+async def stream_observation_columns_influx(site_number, params, timings=NO_TIMINGS):
+    """
+    Like stream_observations_influx, but with times as epoch nanoseconds, for the columnar output formats.
+    :return: (field_types, chunks)
+    """
+    sql, query = build_observations_query(site_number, params)
+    field_types = await get_influx_field_types(influx_measurement_for_level(query['processing_level']))
+    rollup_plan = await plan_rollup_query(query)
+    if rollup_plan is not None:
+        sql = rollup_plan.sql
+    return field_types, _stream_observation_values(sql, "stream_observations", rollup_plan=rollup_plan,
+                                                   epoch="ns", timings=timings)
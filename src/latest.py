@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Latest observation of every station, kept in memory for the network map.
+"""
+import asyncio
+import time
+
+import config
+from cache import cache_invalidations, process_levels_generation
+from clients import query_influx
+from functions import get_stations_mongo
+from rollups import PROCESSING_LEVELS
+from util import influx_measurement_for_level
+
+# processing_level -> LatestSnapshot
+_snapshots = {}
+_refresh_locks = {}
+
+
+class LatestSnapshot(object):
+    __slots__ = ("processing_level", "built_at", "generation", "resp", "latest_time", "site_times")
+
+    def __init__(self, processing_level, built_at, generation, resp, latest_time, site_times):
+        self.processing_level = processing_level
+        self.built_at = built_at
+        self.generation = generation
+        self.resp = resp
+        self.latest_time = latest_time
+        # site_no -> time string of its latest observation
+        self.site_times = site_times
+
+    def is_current(self):
+        if self.generation != process_levels_generation():
+            return False
+        if time.time() - self.built_at > config.LATEST_OBSERVATIONS_MAX_AGE:
+            return False
+        return self.built_at > cache_invalidations.level_invalidated_at(self.processing_level)
+
+
+async def query_latest_observations_influx(processing_level):
+    """
+    One query for the whole network, the newest point of each site_no series.
+    :return: dict of site_no to observation
+    """
+    sql = 'SELECT * FROM "{:s}" GROUP BY "site_no" ORDER BY "time" DESC LIMIT 1;' \
+          .format(influx_measurement_for_level(processing_level))
+    result = await query_influx(sql)
+    latest = {}
+    for series in result.raw.get('series', []):
+        values = series.get('values', None)
+        if not values:
+            continue
+        site_no = int(series.get('tags', {}).get('site_no'))
+        latest[site_no] = dict(zip(series['columns'], values[0]))
+    return latest
+
+
+async def build_latest_snapshot(processing_level):
+    started = time.time()
+    generation = process_levels_generation()
+    latest = await query_latest_observations_influx(processing_level)
+    stations = await get_stations_mongo({'count': 0}, json_safe='orjson')
+    latest_time = None
+    for station in stations['stations']:
+        site_no = station.get('site_no', None)
+        observation = latest.get(int(site_no), None) if site_no is not None else None
+        station['last_observation'] = observation
+        if observation is not None:
+            t = observation.get('time', None)
+            if t is not None and (latest_time is None or t > latest_time):
+                latest_time = t
+    resp = {
+        'meta': {
+            'processing_level': processing_level,
+            'count': stations['meta']['count'],
+            'latest_time': latest_time,
+        },
+        'stations': stations['stations'],
+    }
+    site_times = {site_no: o.get('time', None) for site_no, o in latest.items()}
+    snapshot = LatestSnapshot(processing_level, started, generation, resp, latest_time, site_times)
+    _snapshots[processing_level] = snapshot
+    return snapshot
+
+
+async def get_latest_snapshot(processing_level):
+    """
+    Returns the in-memory snapshot, only querying when there is none yet, or the data has changed since.
+    Concurrent requests share the same refresh. Only the PROCESSING_LEVELS have a snapshot.
+    """
+    if processing_level not in PROCESSING_LEVELS:
+        raise ValueError("Only levels 0, 1, 2, 3 or 4 are acceptable.")
+    snapshot = _snapshots.get(processing_level, None)
+    if snapshot is not None and snapshot.is_current():
+        return snapshot
+    lock = _refresh_locks.get(processing_level, None)
+    if lock is None:
+        lock = _refresh_locks[processing_level] = asyncio.Lock()
+    async with lock:
+        snapshot = _snapshots.get(processing_level, None)
+        if snapshot is not None and snapshot.is_current():
+            return snapshot
+        return await build_latest_snapshot(processing_level)
+
+
+async def get_latest_observations(processing_level):
+    snapshot = await get_latest_snapshot(processing_level)
+    return snapshot.resp
+
+
+async def maintain_latest_observations():
+    """
+    Background task, rebuilds the snapshot of every processing level each LATEST_OBSERVATIONS_REFRESH_INTERVAL seconds,
+    so requests never wait on the query.
+    """
+    interval = config.LATEST_OBSERVATIONS_REFRESH_INTERVAL
+    if interval <= 0:
+        return
+    while True:
+        for processing_level in PROCESSING_LEVELS:
+            try:
+                await build_latest_snapshot(processing_level)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Latest observations refresh failed: {}".format(repr(e)))
+        await asyncio.sleep(interval)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+In-process counters and histograms, served in the Prometheus text format by GET /rest/metrics.
+Each worker writes its own values to a file in METRICS_STATE_DIRECTORY every METRICS_FLUSH_INTERVAL seconds,
+the worker that answers the scrape adds up the files of every worker.
+"""
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from orjson import dumps as fast_dumps, loads as fast_loads
+
+import config
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+REQUEST_DURATION = "cosmoz_http_request_duration_seconds"
+RESPONSE_SIZE = "cosmoz_http_response_size_bytes"
+BACKEND_DURATION = "cosmoz_backend_query_duration_seconds"
+BACKEND_ROWS = "cosmoz_backend_rows_total"
+OAUTH_VERIFY_DURATION = "cosmoz_oauth_verify_duration_seconds"
+CACHE_REQUESTS = "cosmoz_cache_requests_total"
+ACCESS_LOG_DROPPED = "cosmoz_access_log_dropped_total"
+
+# name -> (type, help, label names, histogram buckets)
+DEFINITIONS = {
+    REQUEST_DURATION: ("histogram", "Time from routing a request to its response being ready, streamed "
+                                    "responses stop at the headers.", ("route", "method", "status"), LATENCY_BUCKETS),
+    RESPONSE_SIZE: ("histogram", "Response body size after compression, streamed responses are not included.",
+                    ("route", "method"), SIZE_BUCKETS),
+    BACKEND_DURATION: ("histogram", "Influx and Mongo query time, including reading the results.",
+                       ("backend", "operation"), LATENCY_BUCKETS),
+    BACKEND_ROWS: ("counter", "Rows read from Influx and documents read from Mongo.", ("backend", "operation"), None),
+    OAUTH_VERIFY_DURATION: ("histogram", "Time to check the OAuth token behind an API Key, cached or not.",
+                            ("oauth_v", "result"), LATENCY_BUCKETS),
+    CACHE_REQUESTS: ("counter", "Cache lookups.", ("cache", "result"), None),
+    ACCESS_LOG_DROPPED: ("counter", "Access log records lost because the buffer was full.", (), None),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class MetricsRegistry(object):
+    """
+    Counters and histograms of one worker, keyed by (name, label values in DEFINITIONS order).
+    A histogram is a list of per-bucket counts, the +Inf count, then the sum of the observed values.
+    """
+    __slots__ = ("enabled", "directory", "_counters", "_histograms")
+
+    def __init__(self, enabled, directory):
+        self.enabled = enabled
+        self.directory = directory
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels, value=1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        if not self.enabled:
+            return
+        buckets = DEFINITIONS[name][3]
+        key = (name, labels)
+        histogram = self._histograms.get(key, None)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def snapshot(self):
+        return {
+            'counters': [[name, list(labels), v] for (name, labels), v in self._counters.items()],
+            'histograms': [[name, list(labels), h] for (name, labels), h in self._histograms.items()],
+        }
+
+    def _filename(self, pid):
+        return os.path.join(self.directory, "{:d}.json".format(pid))
+
+    def flush(self):
+        """
+        Writes this worker's values to its file, for the other workers to read.
+        """
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self._filename(os.getpid())
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'wb') as f:
+            f.write(fast_dumps(self.snapshot()))
+        os.replace(tmp_filename, filename)
+
+    def remove_stale(self):
+        """
+        Removes the files of processes that are gone, so a restarted server starts counting from zero.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            pid = name.split(".", 1)[0]
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+            except PermissionError:
+                pass
+
+    def collect(self):
+        """
+        Adds up the values of every worker, this one's are current, the others' are up to METRICS_FLUSH_INTERVAL old.
+        :return: (counters, histograms), dicts keyed by (name, label values)
+        """
+        self.flush()
+        counters = {}
+        histograms = {}
+        states = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    states.append(fast_loads(f.read()))
+            except (FileNotFoundError, ValueError):
+                continue
+        for state in states:
+            for name, labels, v in state.get('counters', []):
+                key = (name, tuple(labels))
+                counters[key] = counters.get(key, 0) + v
+            for name, labels, h in state.get('histograms', []):
+                key = (name, tuple(labels))
+                total = histograms.get(key, None)
+                if total is None or len(total) != len(h):
+                    histograms[key] = list(h)
+                else:
+                    histograms[key] = [a + b for a, b in zip(total, h)]
+        return counters, histograms
+
+    def render(self):
+        """
+        :return: str, every worker's metrics in the Prometheus text exposition format
+        """
+        counters, histograms = self.collect()
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in DEFINITIONS.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            if kind == "counter":
+                for (n, labels), v in sorted(counters.items()):
+                    if n == name:
+                        lines.append("{}{} {}".format(name, _format_labels(label_names, labels), _format_number(v)))
+                continue
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, count in zip(buckets + ("+Inf",), h[:-1]):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        name, _format_labels(label_names, labels, ("le", _format_number(le))), cumulative))
+                lines.append("{}_sum{} {}".format(name, _format_labels(label_names, labels), _format_number(h[-1])))
+                lines.append("{}_count{} {}".format(name, _format_labels(label_names, labels), cumulative))
+        return "\n".join(lines) + "\n"
+
+
+def observe_request(request, response):
+    """
+    Records the latency and response size of a request, started by start_request_timer.
+    """
+    started = getattr(request.ctx, 'metrics_started', None)
+    if started is None:
+        return
+    route = request.uri_template or "unmatched"
+    status = str(response.status) if response is not None else "none"
+    registry.observe(REQUEST_DURATION, (route, request.method, status), time.perf_counter() - started)
+    body = getattr(response, 'body', None)
+    if body is not None:
+        registry.observe(RESPONSE_SIZE, (route, request.method), len(body))
+
+
+def observe_query(backend, operation, seconds, rows):
+    """
+    :param backend: "influx" or "mongo"
+    :param operation: what the query is for, eg "observations"
+    """
+    registry.observe(BACKEND_DURATION, (backend, operation), seconds)
+    registry.inc(BACKEND_ROWS, (backend, operation), rows)
+
+
+def count_cache_lookup(cache, hit):
+    registry.inc(CACHE_REQUESTS, (cache, "hit" if hit else "miss"))
+
+
+async def maintain_metrics():
+    """
+    Background task, writes this worker's metrics to its file every METRICS_FLUSH_INTERVAL seconds.
+    """
+    interval = config.METRICS_FLUSH_INTERVAL
+    if not registry.enabled or interval <= 0:
+        return
+    registry.remove_stale()
+    while True:
+        try:
+            registry.flush()
+        except OSError as e:
+            print("Writing metrics failed: {}".format(repr(e)))
+        await asyncio.sleep(interval)
+
+
+registry = MetricsRegistry(config.METRICS_ENABLED, config.METRICS_STATE_DIRECTORY)
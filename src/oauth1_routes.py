@@ -15,15 +15,18 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from functools import partial
 from inspect import isawaitable
-from os import getenv
+from os import getenv, path
 from sanic.response import redirect, json, text
 from spf import SanicPluginsFramework
 from spf.plugins.contextualize import contextualize
 from sanic_oauthlib.client import oauthclient
 from sanic_session_spf import session as session_plugin
-from filesystem_session_interface import FilesystemSessionInterface
+from filesystem_session_interface import SqliteSessionInterface
+from oauth_verification import token_verifier, ProviderError
 from util import load_env
+import config
 
 
 #having these in a module-local _hopefully_ shouldn't be a problem
@@ -58,7 +61,12 @@ def create_oauth1_remote(app, oauth=None):
     return remote
 
 
+# set by add_to_app when this module registered the session plugin
+session_interface = None
+
+
 def add_to_app(app, oauth=None, remote=None):
+    global session_interface
     load_env()
     if not oauth:
         oauth = add_oauth_plugin(app)
@@ -66,8 +74,11 @@ def add_to_app(app, oauth=None, remote=None):
         remote = create_oauth1_remote(app, oauth)
     spf = SanicPluginsFramework(app)
     try:
-        session_interface = FilesystemSessionInterface()
-        spf.register_plugin(session_plugin, interface=session_interface)
+        interface = SqliteSessionInterface(directory=path.dirname(config.SESSION_STORE_FILE),
+                                           filename=path.basename(config.SESSION_STORE_FILE))
+        spf.register_plugin(session_plugin, interface=interface)
+        # its sweep is started with the other background tasks in app.py
+        session_interface = interface
     except ValueError:
         pass
     try:
@@ -154,7 +165,6 @@ def add_to_app(app, oauth=None, remote=None):
     return remote
 
 
-#TODO: maybe cache this to prevent repeated hits to the api?
 async def test_oauth1_token(client_name, access_token, access_token_secret):
     if client_name is None or client_name.startswith("_") or \
             client_name.lower() == "none":
@@ -163,7 +173,13 @@ async def test_oauth1_token(client_name, access_token, access_token_secret):
     remote = OAUTH1_REMOTES.get(client_name, None)
     if remote is None:
         raise RuntimeError("Cannot get oauth1 remote with name \"{}\"".format(client_name))
-    resp = await remote.get("/api/method", token=(access_token, access_token_secret))
+    return await token_verifier.verify(client_name, (access_token, access_token_secret), partial(_check_token, remote, (access_token, access_token_secret)))
+
+
+async def _check_token(remote, token):
+    resp = await remote.get("/api/method", token=token)
+    if resp.status >= 500:
+        raise ProviderError("Provider returned status {}".format(resp.status))
     if resp.status in (200, 201):
         if resp.data is not None and isinstance(resp.data, dict):
             method = str(resp.data.get("method")).upper()
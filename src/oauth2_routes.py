@@ -15,15 +15,18 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from functools import partial
 from inspect import isawaitable
-from os import getenv
+from os import getenv, path
 from sanic.response import redirect, text
 from spf import SanicPluginsFramework
 from spf.plugins.contextualize import contextualize
 from sanic_oauthlib.client import oauthclient
 from sanic_session_spf import session as session_plugin
-from filesystem_session_interface import FilesystemSessionInterface
+from filesystem_session_interface import SqliteSessionInterface
+from oauth_verification import token_verifier, ProviderError
 from util import load_env
+import config
 
 
 #having these in a module-local _hopefully_ shouldn't be a problem
@@ -57,7 +60,12 @@ def create_oauth2_remote(app, oauth=None):
     return remote
 
 
+# set by add_to_app when this module registered the session plugin
+session_interface = None
+
+
 def add_to_app(app, oauth=None, remote=None):
+    global session_interface
     load_env()
     if not oauth:
         oauth = add_oauth_plugin(app)
@@ -65,8 +73,11 @@ def add_to_app(app, oauth=None, remote=None):
         remote = create_oauth2_remote(app, oauth)
     spf = SanicPluginsFramework(app)
     try:
-        session_interface = FilesystemSessionInterface()
-        spf.register_plugin(session_plugin, interface=session_interface)
+        interface = SqliteSessionInterface(directory=path.dirname(config.SESSION_STORE_FILE),
+                                           filename=path.basename(config.SESSION_STORE_FILE))
+        spf.register_plugin(session_plugin, interface=interface)
+        # its sweep is started with the other background tasks in app.py
+        session_interface = interface
     except ValueError:
         pass
     try:
@@ -153,7 +164,6 @@ def add_to_app(app, oauth=None, remote=None):
     return remote
 
 
-#TODO: maybe cache this to prevent repeated hits to the api?
 async def test_oauth2_token(client_name, access_token):
     if client_name is None or client_name.startswith("_") or \
             client_name.lower() == "none":
@@ -162,7 +172,13 @@ async def test_oauth2_token(client_name, access_token):
     remote = OAUTH2_REMOTES.get(client_name, None)
     if remote is None:
         raise RuntimeError("Cannot get oauth2 remote with name \"{}\"".format(client_name))
-    resp = await remote.get("/api/method", token=access_token)
+    return await token_verifier.verify(client_name, (access_token,), partial(_check_token, remote, access_token))
+
+
+async def _check_token(remote, token):
+    resp = await remote.get("/api/method", token=token)
+    if resp.status >= 500:
+        raise ProviderError("Provider returned status {}".format(resp.status))
     if resp.status in (200, 201):
         if resp.data is not None and isinstance(resp.data, dict):
             method = str(resp.data.get("method")).upper()
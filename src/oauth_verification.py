@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Verification of OAuth access tokens against the provider's /api/method, shared by the oauth1 and oauth2 routes.
+"""
+import asyncio
+import hashlib
+import time
+from sanic.exceptions import ServiceUnavailable
+
+import config
+from cache import ValidationCache
+
+
+class ProviderError(Exception):
+    """
+    The provider failed to answer, as opposed to answering that the token doesn't work.
+    """
+    pass
+
+
+def _token_key(provider, token_parts):
+    # tokens are credentials, only keep a digest of them
+    h = hashlib.blake2b(digest_size=20)
+    for p in (provider,) + tuple(token_parts):
+        h.update(str(p).encode('utf-8'))
+        h.update(b"\0")
+    return h.digest()
+
+
+class TokenVerifier(object):
+    """
+    Caches verification results, working tokens for OAUTH_VERIFY_CACHE_TTL and failed ones for
+    OAUTH_VERIFY_NEGATIVE_CACHE_TTL seconds. Concurrent checks of the same token share one upstream call.
+    A provider that times out or errors is backed off exponentially, checks fail fast with 503 until then.
+    """
+    __slots__ = ("results", "timeout", "backoff", "backoff_max", "_inflight", "_failures")
+
+    def __init__(self, maxsize, ttl, negative_ttl, timeout, backoff, backoff_max):
+        self.results = ValidationCache(maxsize, ttl, negative_ttl, name="oauth_verification")
+        self.timeout = timeout
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._inflight = {}
+        # provider -> (consecutive failures, retry at)
+        self._failures = {}
+
+    def _check_backoff(self, provider):
+        failures = self._failures.get(provider, None)
+        if failures is not None and time.monotonic() < failures[1]:
+            raise ServiceUnavailable("The OAuth provider is not responding, try again later.")
+
+    def _failed(self, provider):
+        (count, _) = self._failures.get(provider, (0, 0.0))
+        count += 1
+        delay = min(self.backoff * (2 ** (count - 1)), self.backoff_max)
+        self._failures[provider] = (count, time.monotonic() + delay)
+
+    async def _verify_upstream(self, provider, key, check):
+        try:
+            works = await asyncio.wait_for(check(), self.timeout)
+        except (asyncio.TimeoutError, ProviderError, OSError) as e:
+            self._failed(provider)
+            print("OAuth token verification with \"{}\" failed: {}".format(provider, repr(e)))
+            raise ServiceUnavailable("The OAuth provider is not responding, try again later.")
+        self._failures.pop(provider, None)
+        self.results.set(key, True if works else None)
+        return bool(works)
+
+    async def verify(self, provider, token_parts, check):
+        """
+        :param provider: name of the oauth remote, backoff is tracked per provider
+        :param token_parts: tuple of the token and secret, identifies the cache entry
+        :param check: coroutine function making the upstream call, returns bool
+        :return: bool
+        """
+        key = _token_key(provider, token_parts)
+        (hit, works) = self.results.get(key)
+        if hit:
+            return works is not None
+        task = self._inflight.get(key, None)
+        if task is None:
+            self._check_backoff(provider)
+            task = asyncio.ensure_future(self._verify_upstream(provider, key, check))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # one caller going away must not cancel the check for the others
+        return await asyncio.shield(task)
+
+
+token_verifier = TokenVerifier(config.OAUTH_VERIFY_CACHE_MAX_SIZE,
+                               config.OAUTH_VERIFY_CACHE_TTL,
+                               config.OAUTH_VERIFY_NEGATIVE_CACHE_TTL,
+                               config.OAUTH_VERIFY_TIMEOUT,
+                               config.OAUTH_VERIFY_BACKOFF,
+                               config.OAUTH_VERIFY_BACKOFF_MAX)
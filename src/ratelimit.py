@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Token-bucket rate limiting, per API Key or per client IP.
+Buckets are kept in a small SQLite database, on /dev/shm by default, so every worker on the node shares them.
+"""
+import hashlib
+import math
+import os
+import sqlite3
+import time
+from sanic.response import HTTPResponse
+from orjson import dumps as fast_dumps
+
+import config
+from columnar import ARROW_STREAM_MIMETYPE, PARQUET_MIMETYPE
+from apikey import check_admin_apikey, check_apikey_valid, cached_apikey_valid
+
+EXPORT_MIMETYPES = ("text/csv", "text/plain", ARROW_STREAM_MIMETYPE, PARQUET_MIMETYPE)
+EXPORT_FORMATS = frozenset(("csv", "txt", "arrow", "parquet") + EXPORT_MIMETYPES)
+# forget full buckets after this many calls in a worker
+SWEEP_EVERY = 1000
+
+
+def _first_accept_mediatype(request):
+    accept = request.headers.get("Accept", "")
+    return accept.split(",", 1)[0].split(";", 1)[0].strip()
+
+
+def request_cost(request):
+    """
+    How many tokens a request takes. Observation queries cost more than station lookups,
+    exports and aggregates (CSV, TXT, Arrow, Parquet) of observations or last observations cost the most,
+    an export of last observations streams the whole history by default. Bulk queries are charged per station.
+    :return: int, 0 for requests that are not limited
+    """
+    if request.method == "OPTIONS":
+        return 0
+    path = request.path.rstrip("/")
+    last_observations = path.endswith("/lastobservations")
+    if not last_observations and not path.endswith("/observations"):
+        return config.RATE_LIMIT_COST_CHEAP
+    args = request.args
+    format = next(iter(args.getlist('format', None) or args.getlist('_format', None) or [""]))
+    if format in EXPORT_FORMATS or args.get('aggregate', None) or \
+            _first_accept_mediatype(request) in EXPORT_MIMETYPES:
+        cost = config.RATE_LIMIT_COST_EXPORT
+    elif last_observations:
+        cost = config.RATE_LIMIT_COST_CHEAP
+    else:
+        cost = config.RATE_LIMIT_COST_OBSERVATIONS
+    stations = args.getlist('stations', None)
+    if stations:
+        cost *= max(1, len([s for s in str(next(iter(stations))).split(',') if s]))
+    return cost
+
+
+class TokenBuckets(object):
+    """
+    Buckets hold up to `burst` tokens and refill at `rate` tokens per second.
+    Each take is one short write transaction, the database lives in memory-backed storage so this is
+    well under a millisecond and is run inline on the event loop.
+    """
+    __slots__ = ("filename", "rate", "burst", "_conn", "_pid", "_calls")
+
+    def __init__(self, filename, rate, burst):
+        self.filename = filename
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._conn = None
+        self._pid = None
+        self._calls = 0
+
+    def _connection(self):
+        # connections can't be shared with forked workers
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=0.1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets "
+                         "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def take(self, key, cost, now=None):
+        """
+        :return: (allowed, seconds until the request would be allowed)
+        """
+        if now is None:
+            now = time.time()
+        # a request can never cost more than a full bucket
+        cost = min(float(cost), self.burst)
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                tokens = self.burst
+            else:
+                (tokens, updated) = row
+                tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._calls += 1
+        if self._calls % SWEEP_EVERY == 0:
+            self.sweep(now)
+        if allowed:
+            return True, 0.0
+        return False, (cost - tokens) / self.rate
+
+    def sweep(self, now=None):
+        """
+        Removes buckets that have refilled completely, they are the same as a new one.
+        """
+        if now is None:
+            now = time.time()
+        try:
+            self._connection().execute("DELETE FROM buckets WHERE updated < ?", (now - self.burst / self.rate,))
+        except sqlite3.OperationalError:
+            pass  # busy, try again next time
+
+
+def rate_limit_key(request):
+    """
+    API Keys the validation cache knows are valid get their own bucket. Anything else, including keys
+    that haven't been looked up yet, is limited by client IP, so made-up keys neither get a fresh bucket
+    nor a lookup the client isn't charged for.
+    :return: bucket key, or None for admin requests which are not limited
+    """
+    apikey = request.headers.get("X-API-Key", None)
+    if apikey:
+        if check_admin_apikey(apikey):
+            return None
+        if cached_apikey_valid(apikey):
+            return "key:" + hashlib.blake2b(apikey.encode('utf-8'), digest_size=16).hexdigest()
+    # remote_addr is only set when the proxy headers are configured (PROXIES_COUNT, REAL_IP_HEADER)
+    return "ip:" + (request.remote_addr or request.ip)
+
+
+async def check_rate_limit(request):
+    """
+    Request middleware, returns a 429 response when the client has run out of tokens.
+    """
+    if not config.RATE_LIMIT_ENABLED:
+        return None
+    cost = request_cost(request)
+    if not cost:
+        return None
+    key = rate_limit_key(request)
+    if key is None:
+        return None
+    try:
+        allowed, retry_after = rate_limit_buckets.take(key, cost)
+    except sqlite3.OperationalError as e:
+        # don't turn a busy or broken limiter into an outage
+        print("Rate limiter failed: {}".format(repr(e)))
+        return None
+    if allowed:
+        apikey = request.headers.get("X-API-Key", None)
+        if apikey and key.startswith("ip:"):
+            # the IP paid for this lookup, from the next request on a valid key gets its own bucket
+            try:
+                await check_apikey_valid(apikey)
+            except Exception:
+                pass
+        return None
+    retry_after = max(1, int(math.ceil(retry_after)))
+    body = fast_dumps({"message": "Too many requests, try again in {} seconds.".format(retry_after)})
+    return HTTPResponse(body, status=429, headers={"Retry-After": str(retry_after)},
+                        content_type="application/json")
+
+
+rate_limit_buckets = TokenBuckets(config.RATE_LIMIT_FILE, config.RATE_LIMIT_RATE, config.RATE_LIMIT_BURST)
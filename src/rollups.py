@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Materialized rollups of the observation levels.
+Each (site, level, grain) is aggregated into its own influx measurement, eg "level3_rollup_1h",
+holding sum_*, min_*, max_* and count_* fields per bucket.
+An `aggregate` interval that is a multiple of a grain is answered by re-aggregating that rollup,
+the part of the range the rollup isn't built for yet, usually the last day, comes from a live query.
+"""
+import asyncio
+import datetime
+import fcntl
+import time
+from collections import OrderedDict
+
+import config
+from cache import cache_invalidations
+from clients import get_mongo_client, query_influx, get_influx_field_types
+from util import influx_measurement_for_level, parse_influx_duration, datetime_from_iso
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+# Coarsest first. InfluxQL has no calendar month duration, so a week is the coarsest fixed grain.
+ROLLUP_GRAINS = OrderedDict([
+    ("1w", datetime.timedelta(weeks=1)),
+    ("1d", datetime.timedelta(days=1)),
+    ("1h", datetime.timedelta(hours=1)),
+])
+PROCESSING_LEVELS = (0, 1, 2, 3, 4)
+
+# (site_no, processing_level, grain) -> (loaded_at, watermark document or None)
+_watermarks = {}
+
+
+class RollupPlan(object):
+    """
+    sql reads the rollup up to the watermark, tail_sql, when not None, is the live query for the rest
+    of the range. Its rows follow the rollup's rows, LIMIT and OFFSET of both are split to match
+    the single live query.
+    """
+    __slots__ = ("sql", "count_columns", "tail_sql")
+
+    def __init__(self, sql, count_columns, tail_sql=None):
+        self.sql = sql
+        self.count_columns = count_columns
+        self.tail_sql = tail_sql
+
+    def fix_row(self, observation):
+        # COUNT() gives 0 for an empty bucket, SUM() of the stored counts gives null.
+        for c in self.count_columns:
+            if observation.get(c, 0) is None:
+                observation[c] = 0
+        return observation
+
+    def fix_values(self, columns, values):
+        indexes = [i for i, c in enumerate(columns) if c in self.count_columns]
+        for v in values:
+            for i in indexes:
+                if v[i] is None:
+                    v[i] = 0
+        return values
+
+
+def align_values(columns, tail_columns, tail_values):
+    """
+    Reorders rows of the live tail query to the rollup query's columns.
+    :return: list of values rows
+    """
+    if tail_columns == columns:
+        return tail_values
+    indexes = [tail_columns.index(c) if c in tail_columns else None for c in columns]
+    return [[v[i] if i is not None else None for i in indexes] for v in tail_values]
+
+
+def rollup_measurement(processing_level, grain):
+    return "{:s}_rollup_{:s}".format(influx_measurement_for_level(processing_level), grain)
+
+def _utc(d):
+    if d.tzinfo is None:
+        return d.replace(tzinfo=datetime.timezone.utc)
+    return d.astimezone(datetime.timezone.utc)
+
+def floor_to_grain(d, grain_delta):
+    # influx aligns GROUP BY time() buckets to the unix epoch
+    d = _utc(d)
+    return d - ((d - EPOCH) % grain_delta)
+
+def is_aligned(d, grain_delta):
+    return floor_to_grain(d, grain_delta) == _utc(d)
+
+def _influx_time(d):
+    return _utc(d).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _rollups_collection():
+    mongo_client = get_mongo_client()
+    db = getattr(mongo_client, config.MONGODB_NAME)
+    return db.observation_rollups
+
+
+async def get_watermark(site_no, processing_level, grain, fresh=False):
+    """
+    :return: {'built_from': datetime, 'built_until': datetime, 'generation': int} or None if never built.
+             The rollup is complete for built_from <= time < built_until.
+    """
+    key = (site_no, processing_level, grain)
+    now = time.time()
+    cached = _watermarks.get(key, None)
+    if cached is not None and not fresh:
+        loaded_at, doc = cached
+        if now - loaded_at < config.ROLLUPS_WATERMARK_TTL and \
+                loaded_at > cache_invalidations.invalidated_at(site_no, processing_level):
+            return doc
+    doc = await _rollups_collection().find_one(
+        {'site_no': site_no, 'processing_level': processing_level, 'grain': grain},
+        projection={'_id': False})
+    if doc is not None:
+        doc['built_from'] = _utc(doc['built_from'])
+        doc['built_until'] = _utc(doc['built_until'])
+    _watermarks[key] = (now, doc)
+    return doc
+
+
+def _rollup_select(fields, property_filter):
+    """
+    Builds select columns that re-aggregate a rollup with the same column names
+    as MEAN(),MIN(),MAX(),COUNT() over the raw level.
+    :return: (select_string, count_columns) or (None, None) if the rollup can't answer this
+    """
+    base = sorted(f[len("count_"):] for f in fields if f.startswith("count_"))
+    numeric = set(b for b in base if {"sum_" + b, "min_" + b, "max_" + b} <= fields)
+    if not base:
+        return None, None
+    if not property_filter or '*' in property_filter:
+        means = ['SUM("sum_{0}")/SUM("count_{0}") AS "mean_{0}"'.format(b) for b in base if b in numeric]
+        mins = ['MIN("min_{0}") AS "min_{0}"'.format(b) for b in base if b in numeric]
+        maxs = ['MAX("max_{0}") AS "max_{0}"'.format(b) for b in base if b in numeric]
+        counts = ['SUM("count_{0}") AS "count_{0}"'.format(b) for b in base]
+        return ",".join(means + mins + maxs + counts), ["count_{}".format(b) for b in base]
+    select_cols = []
+    count_columns = []
+    for i, v in enumerate(property_filter):
+        if v not in numeric:
+            return None, None
+        # influx names repeated functions mean, mean_1, mean_2...
+        suffix = "" if i == 0 else "_{:d}".format(i)
+        select_cols.append('SUM("sum_{v}")/SUM("count_{v}") AS "mean{s}",MIN("min_{v}") AS "min{s}",'
+                           'MAX("max_{v}") AS "max{s}",SUM("count_{v}") AS "count{s}"'.format(v=v, s=suffix))
+        count_columns.append("count{}".format(suffix))
+    return ",".join(select_cols), count_columns
+
+
+def _lower_bound(query):
+    """
+    :return: the earliest time the query asks for, or None if it has no lower bound
+    """
+    lower = query['startdate']
+    lower = _utc(lower) if lower is not None else None
+    cursor = query.get('cursor', None)
+    if cursor is not None:
+        cursor_time = _utc(datetime_from_iso(cursor[1]))
+        lower = cursor_time if lower is None else max(lower, cursor_time)
+    return lower
+
+
+async def plan_rollup_query(query):
+    """
+    Decides whether an aggregated observations query can be answered from a rollup.
+    The range is split at the watermark, floored to the aggregate interval so no bucket is in both parts,
+    the rollup answers the part before and a live query the part after. Splitting needs a lower bound
+    on the range, influx returns a row for every bucket from it, so the rows in the rollup part are known
+    up front and the tail's LIMIT and OFFSET can be worked out.
+    :param query: the query dict from functions.build_observations_query
+    :return: RollupPlan, or None to use the live query
+    """
+    if not config.ROLLUPS_ENABLED or not query.get('aggregate'):
+        return None
+    try:
+        interval = parse_influx_duration(query['aggregate'])
+    except ValueError:
+        return None
+    startdate = query['startdate']
+    enddate = query['enddate']
+    cursor = query.get('cursor', None)
+    if enddate is None or (cursor is not None and cursor[0] != "ge"):
+        return None
+    # enddate is inclusive to the second, so a day ends at 23:59:59
+    end = _utc(enddate) + datetime.timedelta(seconds=1)
+    site_no = query['site_no']
+    processing_level = query['processing_level']
+    lower = _lower_bound(query)
+    count = query['count']
+    offset = query['offset']
+    for grain, grain_delta in ROLLUP_GRAINS.items():
+        if interval < grain_delta or interval % grain_delta:
+            continue
+        watermark = await get_watermark(site_no, processing_level, grain)
+        if watermark is None:
+            continue
+        if startdate is not None and _utc(startdate) > watermark['built_from'] \
+                and not is_aligned(startdate, grain_delta):
+            continue
+        if watermark['built_until'] >= end and is_aligned(end, grain_delta):
+            split = None
+        elif lower is None:
+            continue
+        else:
+            split = floor_to_grain(min(watermark['built_until'], end), interval)
+            if split <= lower:
+                continue
+        measurement = rollup_measurement(processing_level, grain)
+        fields = set(await get_influx_field_types(measurement, config.ROLLUPS_WATERMARK_TTL))
+        select_string, count_columns = _rollup_select(fields, query['property_filter'])
+        if select_string is None:
+            continue
+        if split is None:
+            sql = 'SELECT {:s} FROM "{:s}" WHERE "site_no"=\'{:d}\'{:s}GROUP BY time({:s}) ORDER BY "time" ASC LIMIT {:d} OFFSET {:d}; ' \
+                  .format(select_string, measurement, site_no, query['time_filter'], query['aggregate'],
+                          count, offset)
+            return RollupPlan(sql, count_columns)
+        split_filter = " AND time < \'{:s}\' ".format(_influx_time(split))
+        sql = 'SELECT {:s} FROM "{:s}" WHERE "site_no"=\'{:d}\'{:s}{:s}GROUP BY time({:s}) ORDER BY "time" ASC LIMIT {:d} OFFSET {:d}; ' \
+              .format(select_string, measurement, site_no, query['since_filter'], split_filter, query['aggregate'],
+                      count, offset)
+        # one row per bucket from the one holding the lower bound up to the split
+        rollup_buckets = -(-(split - floor_to_grain(lower, interval)) // interval)
+        rollup_rows = max(0, min(count, rollup_buckets - offset))
+        tail_sql = None
+        if rollup_rows < count:
+            tail_filter = " AND time >= \'{:s}\' ".format(_influx_time(split))
+            tail_sql = 'SELECT {:s} FROM "{:s}" WHERE "site_no"=\'{:d}\'{:s}{:s}{:s}GROUP BY time({:s}) ORDER BY "time" ASC LIMIT {:d} OFFSET {:d}; ' \
+                       .format(query['select_string'], influx_measurement_for_level(processing_level), site_no,
+                               query['since_filter'], tail_filter, query['before_filter'], query['aggregate'],
+                               count - rollup_rows, max(0, offset - rollup_buckets))
+        return RollupPlan(sql, count_columns, tail_sql)
+    return None
+
+
+async def _first_point_time(site_no, processing_level):
+    sql = 'SELECT * FROM "{:s}" WHERE "site_no"=\'{:d}\' ORDER BY "time" ASC LIMIT 1;' \
+          .format(influx_measurement_for_level(processing_level), site_no)
+    result = await query_influx(sql, epoch='s')
+    for p in result.get_points():
+        return datetime.datetime.fromtimestamp(p['time'], tz=datetime.timezone.utc)
+    return None
+
+
+async def build_rollups(site_no, processing_level):
+    """
+    Incrementally builds every rollup grain for one site and level, in windows of ROLLUPS_BUILD_WINDOW_DAYS.
+    Buckets from ROLLUPS_REBUILD_LOOKBACK_DAYS before the watermark are rebuilt, to pick up recent reprocessing.
+    """
+    site_no = int(site_no)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    source = influx_measurement_for_level(processing_level)
+    collection = _rollups_collection()
+    window = datetime.timedelta(days=config.ROLLUPS_BUILD_WINDOW_DAYS)
+    lookback = datetime.timedelta(days=config.ROLLUPS_REBUILD_LOOKBACK_DAYS)
+    first_point = None
+    for grain, grain_delta in ROLLUP_GRAINS.items():
+        watermark = await get_watermark(site_no, processing_level, grain, fresh=True)
+        if watermark is None:
+            if first_point is None:
+                first_point = await _first_point_time(site_no, processing_level)
+                if first_point is None:
+                    return
+            built_from = start = floor_to_grain(first_point, grain_delta)
+            generation = 0
+        else:
+            built_from = watermark['built_from']
+            start = floor_to_grain(max(built_from, watermark['built_until'] - lookback), grain_delta)
+            generation = watermark.get('generation', 0)
+        end = floor_to_grain(now, grain_delta)
+        upsert = watermark is None
+        while start < end:
+            window_end = min(end, floor_to_grain(start + window, grain_delta))
+            if window_end <= start:
+                window_end = end
+            sql = 'SELECT SUM(*),MIN(*),MAX(*),COUNT(*) INTO "{:s}" FROM "{:s}" WHERE "site_no"=\'{:d}\' ' \
+                  'AND time >= \'{:s}\' AND time < \'{:s}\' GROUP BY time({:s}),"site_no" fill(none);' \
+                  .format(rollup_measurement(processing_level, grain), source, site_no,
+                          _influx_time(start), _influx_time(window_end), grain)
+            await query_influx(sql, method="POST")
+            # An invalidation bumps the generation, then this stale build must not move the watermark forward.
+            res = await collection.update_one(
+                {'site_no': site_no, 'processing_level': processing_level, 'grain': grain,
+                 'generation': generation},
+                {'$set': {'built_from': built_from, 'built_until': window_end}},
+                upsert=upsert)
+            if res.matched_count < 1 and res.upserted_id is None:
+                break
+            upsert = False
+            start = window_end
+        _watermarks.pop((site_no, processing_level, grain), None)
+
+
+async def invalidate_rollups(site_no=None, processing_level=None, since=None):
+    """
+    Moves watermarks back so reprocessed data is rebuilt. Until it is, those ranges use the live query.
+    :param since: earliest reprocessed time, defaults to ROLLUPS_REBUILD_LOOKBACK_DAYS ago
+    """
+    if not config.ROLLUPS_ENABLED:
+        return
+    if since is None:
+        since = datetime.datetime.now(datetime.timezone.utc) - \
+                datetime.timedelta(days=config.ROLLUPS_REBUILD_LOOKBACK_DAYS)
+    # floored to the coarsest grain, that is aligned for every grain
+    bound = floor_to_grain(since, next(iter(ROLLUP_GRAINS.values())))
+    criteria = {'built_until': {'$gt': bound}}
+    if site_no is not None:
+        criteria['site_no'] = int(site_no)
+    if processing_level is not None:
+        criteria['processing_level'] = int(processing_level)
+    await _rollups_collection().update_many(criteria, {'$set': {'built_until': bound}, '$inc': {'generation': 1}})
+    _watermarks.clear()
+
+
+async def _all_site_numbers():
+    mongo_client = get_mongo_client()
+    db = getattr(mongo_client, config.MONGODB_NAME)
+    return sorted(await db.all_stations.distinct('site_no'))
+
+
+async def rebuild_rollups(site_no=None, processing_level=None):
+    """
+    Builds rollups for one or every site and level. Only one worker on a node builds at a time.
+    :return: False if another worker is already building, or rollups are disabled
+    """
+    if not config.ROLLUPS_ENABLED:
+        return False
+    lock = open(config.ROLLUPS_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return False
+    try:
+        sites = [int(site_no)] if site_no is not None else await _all_site_numbers()
+        levels = [int(processing_level)] if processing_level is not None else PROCESSING_LEVELS
+        for s in sites:
+            for l in levels:
+                await build_rollups(s, l)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    return True
+
+
+async def maintain_rollups():
+    """
+    Background task, keeps rollups up to date every ROLLUPS_REFRESH_INTERVAL seconds.
+    """
+    interval = config.ROLLUPS_REFRESH_INTERVAL
+    if not config.ROLLUPS_ENABLED or interval <= 0:
+        return
+    while True:
+        try:
+            await rebuild_rollups()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Rollup build failed: {}".format(repr(e)))
+        await asyncio.sleep(interval)
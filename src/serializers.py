@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+CSV and TXT serializers for observation and calibration exports.
+Each one is compiled from a declarative column spec into a single %-format line, and produces
+the same bytes as the matching Jinja template in templates/, a whole chunk of rows at a time.
+"""
+from operator import itemgetter
+
+CSV = "csv"
+TXT = "txt"
+
+# Number formats, the time and flag columns are strings
+_F3 = "%.3f"
+
+# processing_level -> (column spec, csv header, txt header)
+# column spec entries are (source field, csv format, txt format)
+OBSERVATION_SPECS = {
+    0: (
+        [("time", "%s", "%20s"),
+         ("count", _F3, "%10.3f"),
+         ("pressure1", _F3, "%10.3f"),
+         ("internal_temperature", _F3, "%7.3f"),
+         ("internal_humidity", _F3, "%7.3f"),
+         ("battery", _F3, "%7.3f"),
+         ("tube_temperature", _F3, "%7.3f"),
+         ("tube_humidity", _F3, "%7.3f"),
+         ("rain", _F3, "%7.3f"),
+         ("vwc1", _F3, "%7.3f"),
+         ("vwc2", _F3, "%7.3f"),
+         ("vwc3", _F3, "%7.3f"),
+         ("pressure2", _F3, "%7.3f"),
+         ("external_temperature", _F3, "%7.3f"),
+         ("external_humidity", _F3, "%7.3f")],
+        "UTC_TIMESTAMP,COUNT,PRESSURE_mb,INTERNAL_TEMPERATURE_oC,INTERNAL_RH_%,BATTERY_V,CAPSULE_TEMPERATURE_oC,"
+        "CAPSULE_RH_%,RAIN_COUNT,TDR1_us,TDR2_us,TDR3_us,PRESSURE2_mb,EXTERNAL_TEMPERATURE_oC,EXTERNAL_RH_%\n",
+        "UTC_TIMESTAMP              COUNT       PRESS    I_TEM     I_RH     BATT    C_TEM     C_RH    RAIN      "
+        "TDR1     TDR2     TDR3    PRES2   EX_TEM    EX_RH\n"
+        "YYYY-MM-DDTHH:MM:SSZ         /hr          mb        C        %        V        C        %    COUNT       "
+        "us       us       us       mb        C        %\n",
+    ),
+    1: (
+        [("time", "%s", "%20s"),
+         ("count", _F3, "%10.3f"),
+         ("pressure1", _F3, "%10.3f"),
+         ("internal_temperature", _F3, "%7.3f"),
+         ("internal_humidity", _F3, "%7.3f"),
+         ("battery", _F3, "%7.3f"),
+         ("tube_temperature", _F3, "%7.3f"),
+         ("tube_humidity", _F3, "%7.3f"),
+         ("rain", _F3, "%7.3f"),
+         ("vwc1", _F3, "%7.3f"),
+         ("vwc2", _F3, "%7.3f"),
+         ("vwc3", _F3, "%7.3f"),
+         ("pressure2", _F3, "%7.3f"),
+         ("external_temperature", _F3, "%7.3f"),
+         ("external_humidity", _F3, "%7.3f"),
+         ("flag", "%s", "%4s")],
+        "UTC_TIMESTAMP,COUNT,PRESSURE_mb,INTERNAL_TEMPERATURE_oC,INTERNAL_RH_%,BATTERY_V,CAPSULE_TEMPERATURE_oC,"
+        "CAPSULE_RH_%,RAIN_COUNT,TDR1_us,TDR2_us,TDR3_us,PRESSURE2_mb,EXTERNAL_TEMPERATURE_oC,EXTERNAL_RH_%,FLAG\n",
+        "UTC_TIMESTAMP              COUNT       PRESS    I_TEM     I_RH     BATT    C_TEM     C_RH    RAIN      "
+        "TDR1     TDR2     TDR3    PRES2   EX_TEM    EX_RH   FLAG\n"
+        "YYYY-MM-DDTHH:MM:SSZ         /hr          mb        C        %        V        C        %    COUNT       "
+        "us       us       us       mb        C        %\n",
+    ),
+    2: (
+        [("time", "%s", "%20s"),
+         ("count", _F3, "%10.3f"),
+         ("press_corr", _F3, "%8.3f"),
+         ("wv_corr", _F3, "%8.3f"),
+         ("intensity_corr", _F3, "%8.3f"),
+         ("corr_count", _F3, "%9.3f"),
+         ("rain", _F3, "%7.3f"),
+         ("flag", "%s", "%4s")],
+        "UTC_TIMESTAMP,COUNT,PRESSURE_CORRECTION,WV_CORRECTION,INTENSITY_CORRECTION,CORRECTED_COUNT,RAIN_COUNT,FLAG\n",
+        "UTC_TIMESTAMP              COUNT     PRESS    WVCORR INTENSITY  CORRCOUNT     RAIN   FLAG\n"
+        "YYYY-MM-DDTHH:MM:SSZ         /hr      CORR                CORR        /hr     COUNT\n",
+    ),
+    3: (
+        [("time", "%s", "%20s"),
+         ("soil_moist", _F3, "%10.3f"),
+         ("effective_depth", _F3, "%10.3f"),
+         ("rainfall", _F3, "%10.3f"),
+         ("flag", "%s", "%4s")],
+        "UTC_TIMESTAMP,SOIL_MOISTURE_percent,EFFECTIVE_DEPTH_cm,RAIN_mm,FLAG\n",
+        "UTC_TIMESTAMP          SOILMOIST       DEPTH        RAIN  FLAG\n"
+        "YYYY-MM-DDTHH:MM:SSZ           %          cm          mm\n",
+    ),
+    4: (
+        [("time", "%s", "%20s"),
+         ("soil_moist", _F3, "%10.3f"),
+         ("effective_depth", _F3, "%10.3f"),
+         ("rainfall", _F3, "%10.3f"),
+         ("soil_moist_filtered", _F3, "%11.3f"),
+         ("depth_filtered", _F3, "%10.3f")],
+        "UTC_TIMESTAMP,SOIL_MOISTURE_percent,EFFECTIVE_DEPTH_cm,RAIN_mm,7H_SOIL_MOISTURE_percent,7H_DEPTH_cm\n",
+        "UTC_TIMESTAMP          SOILMOIST       DEPTH        RAIN  7HSOILMOIST     7HDEPTH\n"
+        "YYYY-MM-DDTHH:MM:SSZ           %          cm          mm            %          cm\n",
+    ),
+}
+
+
+def _truncate_date(value):
+    # same as the jinja truncate(10, end="") filter, with its default leeway of 5
+    if len(value) <= 15:
+        return value
+    return value[:10].rsplit(" ", 1)[0]
+
+
+# column spec entries are (source field, csv format, txt format, txt transform)
+CALIBRATION_SPEC = (
+    [("date", "%s", "%10s", _truncate_date),
+     ("label", "\"%s\"", "%7s", None),
+     ("loc", "\"%s\"", "%6s", None),
+     ("depth", "\"%s\"", "%12s", None),
+     ("vol", "\"%s\"", "%7s", None),
+     ("total_wet", "%.2f", "%7.2f", None),
+     ("total_dry", "%.2f", "%7.2f", None),
+     ("tare", "%.2f", "%7.2f", None),
+     ("soil_wet", "%.2f", "%7.2f", None),
+     ("soil_dry", "%.2f", "%7.2f", None),
+     ("gwc", "%.2f", "%7.2f", None),
+     ("bd", "%.2f", "%7.2f", None),
+     ("vwc", "%.2f", "%7.2f", None)],
+    "date, label, loc, depth, vol, total_wet, total_dry, tare, soil_wet, soil_dry, gwc, bd, vwc\n",
+    "YYYY-MM-DD    LABEL     LOC         DEPTH     VOL?    TOTAL    TOTAL     TARE     SOIL     SOIL      GWC       "
+    "BD      VWC\n"
+    "       UTC                                             WET      DRY               WET      DRY\n",
+)
+
+
+class TextSerializer(object):
+    """
+    Writes rows through one compiled %-format line.
+    Number cells use their %-format, like the templates' "%.3f"|format(), so a missing number raises TypeError
+    just like the template does. A missing string cell is written empty, like an undefined template variable.
+    """
+    __slots__ = ("header", "fields", "line_format", "transforms", "string_fields")
+
+    def __init__(self, header, fields, formats, separator, transforms=None):
+        self.header = header
+        self.fields = tuple(fields)
+        self.line_format = separator.join(formats) + "\n"
+        # position -> function applied to that value before formatting
+        self.transforms = tuple((i, t) for i, t in enumerate(transforms or ()) if t is not None)
+        self.string_fields = frozenset(fd for fd, f in zip(fields, formats) if f.rstrip("\"").endswith("s"))
+
+    def _missing_value(self, field):
+        return "" if field in self.string_fields else None
+
+    def _format_rows(self, rows):
+        line_format = self.line_format
+        transforms = self.transforms
+        if not transforms:
+            return "".join([line_format % r for r in rows])
+        lines = []
+        for r in rows:
+            r = list(r)
+            for i, t in transforms:
+                r[i] = t(r[i])
+            lines.append(line_format % tuple(r))
+        return "".join(lines)
+
+    def rows_from_values(self, columns, values):
+        """
+        Formats an influx chunk without building a dict for each row.
+        :param columns: influx column names
+        :param values: list of rows, in columns order
+        """
+        if not values:
+            return ""
+        index = {c: i for i, c in enumerate(columns)}
+        if all(f in index for f in self.fields):
+            if len(self.fields) == 1:
+                i = index[self.fields[0]]
+                rows = ((v[i],) for v in values)
+            else:
+                getter = itemgetter(*[index[f] for f in self.fields])
+                rows = map(getter, values)
+        else:
+            picks = [(index[f], None) if f in index else (None, self._missing_value(f)) for f in self.fields]
+            rows = (tuple(v[i] if i is not None else d for i, d in picks) for v in values)
+        return self._format_rows(rows)
+
+    def rows_from_dicts(self, rows):
+        """
+        :param rows: list of dicts, like the templates' observations or calibrations
+        """
+        fields = [(f, self._missing_value(f)) for f in self.fields]
+        return self._format_rows(tuple(r.get(f, d) for f, d in fields) for r in rows)
+
+    def render_dicts(self, rows):
+        return self.header + self.rows_from_dicts(rows)
+
+
+def _build(spec, kind):
+    columns, csv_header, txt_header = spec
+    if len(columns[0]) == 3:
+        columns = [c + (None,) for c in columns]
+    fields = [c[0] for c in columns]
+    if kind == CSV:
+        return TextSerializer(csv_header, fields, [c[1] for c in columns], ", ")
+    elif kind == TXT:
+        return TextSerializer(txt_header, fields, [c[2] for c in columns], "  ", [c[3] for c in columns])
+    raise ValueError("kind must be csv or txt.")
+
+
+_observation_serializers = {}
+
+
+def observation_serializer(processing_level, kind):
+    """
+    :param kind: CSV or TXT
+    """
+    key = (processing_level, kind)
+    serializer = _observation_serializers.get(key, None)
+    if serializer is None:
+        serializer = _observation_serializers[key] = _build(OBSERVATION_SPECS[processing_level], kind)
+    return serializer
+
+
+calibration_serializers = {
+    CSV: _build(CALIBRATION_SPEC, CSV),
+    TXT: _build(CALIBRATION_SPEC, TXT),
+}
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+In-memory snapshot of the all_stations collection.
+The station list rarely changes, so it is loaded once, checked against the collection version
+every STATIONS_VERSION_TTL seconds, and only reloaded when that changes.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from bson import decode as bson_decode
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+import config
+from bson_codecs import codec_options_for
+from clients import get_mongo_client
+
+_snapshot = [None]
+_load_lock = [None]
+
+
+def _all_stations_collection():
+    mongo_client = get_mongo_client()
+    db = getattr(mongo_client, config.MONGODB_NAME)
+    return db.all_stations
+
+
+async def get_stations_version():
+    """
+    A hash of the all_stations collection content, it changes whenever any station document changes.
+    """
+    mongo_client = get_mongo_client()
+    db = getattr(mongo_client, config.MONGODB_NAME)
+    res = await db.command("dbHash", collections=["all_stations"])
+    return res.get('collections', {}).get('all_stations', None) or res.get('md5', "")
+
+
+def convert_station(station, json_safe=True, jinja_safe=False):
+    """
+    Decodes a raw station document with the codecs for the output mode.
+    :param station: RawBSONDocument
+    """
+    codec_options = codec_options_for(json_safe, jinja_safe).with_options(document_class=OrderedDict)
+    station = bson_decode(station.raw, codec_options=codec_options)
+    if jinja_safe and 'status' in station:
+        station['_status'] = station['status']
+        del station['status']
+    if json_safe and 'id' not in station and 'site_no' in station:
+        station['id'] = station['site_no']
+    return station
+
+
+class StationSnapshot(object):
+    """
+    The raw station documents, in collection order and indexed by site_no,
+    with a decoded copy of every document for each output mode, made the first time that mode is used.
+    """
+    __slots__ = ("version", "checked_at", "stations", "by_site_no", "_converted")
+
+    def __init__(self, version, stations):
+        self.version = version
+        self.checked_at = time.time()
+        self.stations = stations
+        self.by_site_no = {int(s['site_no']): i for i, s in enumerate(stations) if s.get('site_no', None) is not None}
+        self._converted = {}
+
+    def __len__(self):
+        return len(self.stations)
+
+    def converted(self, json_safe=True, jinja_safe=False):
+        mode = (json_safe, jinja_safe)
+        stations = self._converted.get(mode, None)
+        if stations is None:
+            stations = self._converted[mode] = [convert_station(s, json_safe, jinja_safe) for s in self.stations]
+        return stations
+
+    def find(self, site_no, json_safe=True, jinja_safe=False):
+        i = self.by_site_no.get(int(site_no), None)
+        if i is None:
+            return None
+        return self.converted(json_safe, jinja_safe)[i]
+
+    def page(self, offset=0, count=0, json_safe=True, jinja_safe=False):
+        """
+        :param count: 0 for no limit, like the Mongo find limit
+        """
+        stations = self.converted(json_safe, jinja_safe)
+        if count:
+            return stations[offset:offset + count]
+        return stations[offset:]
+
+
+def project_station(station, property_filter):
+    """
+    Copies the station with only the properties in the filter, and site_no, in document order.
+    :param property_filter: list of property names, None or containing "*" for all of them
+    """
+    if not property_filter or '*' in property_filter:
+        return OrderedDict(station)
+    wanted = set(property_filter)
+    wanted.add('site_no')
+    if 'status' in wanted:
+        wanted.add('_status')
+    if 'site_no' in station:
+        # the id alias of site_no is added for JSON
+        wanted.add('id')
+    return OrderedDict((k, v) for k, v in station.items() if k in wanted)
+
+
+async def load_station_snapshot(version=None):
+    if version is None:
+        version = await get_stations_version()
+    collection = _all_stations_collection().with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    cursor = collection.find({}, projection={'_id': False})
+    stations = await cursor.to_list(length=None)
+    snapshot = StationSnapshot(version, stations)
+    _snapshot[0] = snapshot
+    return snapshot
+
+
+async def refresh_station_snapshot():
+    """
+    Reloads the snapshot only when the collection version has changed.
+    """
+    version = await get_stations_version()
+    snapshot = _snapshot[0]
+    if snapshot is not None and snapshot.version == version:
+        snapshot.checked_at = time.time()
+        return snapshot
+    return await load_station_snapshot(version)
+
+
+async def get_station_snapshot():
+    snapshot = _snapshot[0]
+    if snapshot is not None:
+        return snapshot
+    if _load_lock[0] is None:
+        _load_lock[0] = asyncio.Lock()
+    async with _load_lock[0]:
+        snapshot = _snapshot[0]
+        if snapshot is None:
+            snapshot = await load_station_snapshot()
+    return snapshot
+
+
+async def maintain_station_snapshot():
+    """
+    Background task, checks the collection version every STATIONS_VERSION_TTL seconds.
+    """
+    interval = config.STATIONS_VERSION_TTL
+    if interval <= 0:
+        return
+    while True:
+        try:
+            await refresh_station_snapshot()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Station snapshot refresh failed: {}".format(repr(e)))
+        await asyncio.sleep(interval)
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2019 CSIRO Land and Water
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Per-request timing spans, sent back in a Server-Timing header (and trailer, for streamed responses),
+and the opt-in sampling profiler.
+An admin (X-API-Key of ADMIN_API_KEY) sending "X-Profile: true" gets a sampled CPU profile of that request,
+saved as collapsed stacks and fetched with GET /rest/profiles/<id>, the id is in the X-Profile-Id header.
+"""
+import asyncio
+import os
+import secrets
+import sys
+import threading
+import time
+from sanic.response import StreamingHTTPResponse
+
+import config
+
+PROFILE_ID_LENGTH = 16
+_current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+
+
+class _Span(object):
+    __slots__ = ("timings", "name", "started")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timings.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class ServerTimings(object):
+    """
+    Time spent in each stage of one request. A span that happens more than once, like the
+    processing of each streamed chunk, adds up. Names must be HTTP tokens.
+    """
+    __slots__ = ("started", "spans", "descriptions")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # name -> seconds, in the order the stages first ran
+        self.spans = {}
+        self.descriptions = {}
+
+    def add(self, name, seconds, description=None):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+        if description is not None:
+            self.descriptions[name] = description
+
+    def span(self, name):
+        """
+        :return: context manager that adds the time spent inside it to the named span
+        """
+        return _Span(self, name)
+
+    def header_value(self):
+        """
+        :return: str, the Server-Timing header value, durations in milliseconds, with the total so far
+        """
+        parts = []
+        for name, seconds in self.spans.items():
+            description = self.descriptions.get(name, None)
+            if description is None:
+                parts.append("{};dur={:.1f}".format(name, seconds * 1000.0))
+            else:
+                parts.append("{};desc=\"{}\";dur={:.1f}".format(name, description, seconds * 1000.0))
+        parts.append("total;dur={:.1f}".format((time.perf_counter() - self.started) * 1000.0))
+        return ", ".join(parts)
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class NoTimings(ServerTimings):
+    """
+    Stands in when the caller isn't collecting timings, eg. background tasks.
+    """
+    __slots__ = ()
+    _no_span = _NoSpan()
+
+    def add(self, name, seconds, description=None):
+        pass
+
+    def span(self, name):
+        return self._no_span
+
+
+NO_TIMINGS = NoTimings()
+
+
+def request_timings(request):
+    """
+    :return: the request's ServerTimings, or NO_TIMINGS when start_request_timings didn't run for it
+    """
+    return getattr(request.ctx, 'timings', NO_TIMINGS)
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the event loop thread every `interval` seconds while one request runs.
+    Only stacks of the request's own task are recorded in full. Samples where the loop runs another task
+    are counted as "(other tasks)", and samples outside of any task, when the loop is waiting on sockets
+    or on the Influx executor threads, as "(waiting)". Work done on executor threads isn't sampled.
+    """
+    def __init__(self, task, interval):
+        super(SamplingProfiler, self).__init__(name="request-profiler", daemon=True)
+        self.task = task
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.interval = interval
+        self.samples = {}
+        self._done = threading.Event()
+
+    def run(self):
+        current_frames = sys._current_frames
+        while not self._done.wait(self.interval):
+            current = _current_task(self.loop)
+            if current is None:
+                stack = "(waiting)"
+            elif current is not self.task:
+                stack = "(other tasks)"
+            else:
+                frame = current_frames().get(self.loop_thread_id, None)
+                if frame is None:
+                    continue
+                stack = _collapse(frame)
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def collapsed(self):
+        """
+        :return: str, one "frame;frame;... count" line per distinct stack, for flamegraph.pl or speedscope
+        """
+        return "".join("{} {:d}\n".format(stack, count) for stack, count in sorted(self.samples.items()))
+
+
+def _profile_filename(profile_id):
+    return os.path.join(config.PROFILE_DIRECTORY, "{}.folded".format(profile_id))
+
+
+def new_profile_id():
+    return secrets.token_hex(PROFILE_ID_LENGTH // 2)
+
+
+def save_profile(profile_id, profiler):
+    """
+    Writes the profile where any worker can serve it, keeping the newest PROFILE_MAX_KEPT.
+    """
+    os.makedirs(config.PROFILE_DIRECTORY, exist_ok=True)
+    with open(_profile_filename(profile_id), 'w') as f:
+        f.write(profiler.collapsed())
+    profiles = [os.path.join(config.PROFILE_DIRECTORY, n) for n in os.listdir(config.PROFILE_DIRECTORY)
+                if n.endswith(".folded")]
+    if len(profiles) > config.PROFILE_MAX_KEPT:
+        profiles.sort(key=os.path.getmtime)
+        for filename in profiles[:len(profiles) - config.PROFILE_MAX_KEPT]:
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass
+
+
+def load_profile(profile_id):
+    """
+    :return: str, the collapsed stacks
+    """
+    if len(profile_id) != PROFILE_ID_LENGTH or not all(c in "0123456789abcdef" for c in profile_id):
+        raise LookupError("Cannot find profile.")
+    try:
+        with open(_profile_filename(profile_id)) as f:
+            return f.read()
+    except FileNotFoundError:
+        raise LookupError("Cannot find profile.")
+
+
+def start_request_timings(request, profile=False):
+    """
+    Called from request middleware, the handlers read request.ctx.timings.
+    :param profile: also sample this request's CPU time
+    """
+    request.ctx.timings = ServerTimings()
+    if profile:
+        profiler = SamplingProfiler(_current_task(), config.PROFILE_SAMPLE_INTERVAL)
+        profiler.start()
+        request.ctx.profiler = profiler
+
+
+def _finish_streamed(response, timings, profiler, profile_id, trailer):
+    """
+    Wraps the streaming_fn, so the profile covers the whole body and is saved once the stream ends,
+    and the full Server-Timing goes out in the trailer of the chunked body.
+    """
+    streaming_fn = response.streaming_fn
+
+    async def timed_streaming_fn(r):
+        try:
+            await streaming_fn(r)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                save_profile(profile_id, profiler)
+        if trailer and r.chunked:
+            # the last chunk with the trailer in it, Sanic would otherwise end the body with an empty one
+            value = timings.header_value().encode('latin-1')
+            await r.protocol.push_data(b"0\r\nServer-Timing: %b\r\n\r\n" % value)
+            r.chunked = False
+
+    response.streaming_fn = timed_streaming_fn
+
+
+async def finish_request_timings(request, response):
+    """
+    Called from response middleware, after compression. Adds the Server-Timing header.
+    The header of a streamed response only has the spans up to the start of the stream, the spans of
+    the whole response are sent again in an HTTP trailer (announced with "Trailer: Server-Timing")
+    when the stream finishes. There is no trailer over HTTP/1.0, which has no chunked bodies.
+    The X-Profile-Id of a profiled streamed response is sent up front, its profile is saved when the stream
+    finishes, until then GET /rest/profiles/<id> is a 404.
+    """
+    timings = getattr(request.ctx, 'timings', None)
+    profiler = getattr(request.ctx, 'profiler', None)
+    if response is None:
+        if profiler is not None:
+            profiler.stop()
+        return
+    if timings is None:
+        return
+    send_timings = config.SERVER_TIMING_ENABLED or profiler is not None
+    profile_id = None
+    if profiler is not None:
+        profile_id = new_profile_id()
+        response.headers["X-Profile-Id"] = profile_id
+    if isinstance(response, StreamingHTTPResponse):
+        trailer = send_timings and response.chunked and request.version == "1.1"
+        if trailer:
+            response.headers["Trailer"] = "Server-Timing"
+        if trailer or profiler is not None:
+            _finish_streamed(response, timings, profiler, profile_id, trailer)
+    elif profiler is not None:
+        profiler.stop()
+        save_profile(profile_id, profiler)
+    if send_timings:
+        response.headers["Server-Timing"] = timings.header_value()
@@ -15,7 +15,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import datetime
+import re
 import sys
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 PY_36 = sys.version_info[0:3] >= (3, 6, 0)
 
 
@@ -41,6 +43,55 @@ def datetime_from_iso(_d):
         _d =datetime.datetime.strptime(_d, "%Y-%m-%dT%H:%M:%SZ")
     return _d.replace(tzinfo=datetime.timezone.utc)
 
+def influx_measurement_for_level(processing_level):
+    if processing_level < 1:
+        return "raw_values"
+    return "level{:d}".format(processing_level)
+
+
+INFLUX_DURATION_UNITS = {
+    'ns': datetime.timedelta(microseconds=0.001),
+    'u': datetime.timedelta(microseconds=1),
+    'µ': datetime.timedelta(microseconds=1),
+    'ms': datetime.timedelta(milliseconds=1),
+    's': datetime.timedelta(seconds=1),
+    'm': datetime.timedelta(minutes=1),
+    'h': datetime.timedelta(hours=1),
+    'd': datetime.timedelta(days=1),
+    'w': datetime.timedelta(weeks=1),
+}
+influx_duration_part = re.compile(r"(\d+)(ns|u|µ|ms|s|m|h|d|w)")
+
+def parse_influx_duration(_s):
+    """
+    Parses an InfluxQL duration literal, eg "2h", "1d", "1h30m"
+    :param _s: duration string
+    :return: datetime.timedelta
+    """
+    _s = str(_s).strip()
+    parts = influx_duration_part.findall(_s)
+    if not parts or "".join(n + u for n, u in parts) != _s:
+        raise ValueError("Not a valid duration: \"{}\"".format(_s))
+    return sum((INFLUX_DURATION_UNITS[u] * int(n) for n, u in parts), datetime.timedelta(0))
+
+
+#Page cursors are opaque to the client. They hold a time bound for the next page,
+#either "gt" (time > t, after a raw point) or "ge" (time >= t, the start of the next aggregate bucket).
+
+def encode_cursor(op, time_string):
+    raw = "{}:{}".format(op, time_string).encode('utf-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        cursor = str(cursor)
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        op, time_string = raw.split(':', 1)
+    except Exception:
+        raise ValueError("Not a valid cursor.")
+    if op not in ("gt", "ge") or not re.match(r"^\d{4}-\d{2}-\d{2}T[\d:.]+Z$", time_string):
+        raise ValueError("Not a valid cursor.")
+    return op, time_string
 
 
 def load_env():